@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Compare the legacy temp-file based merge/split pipeline with the in-memory one.
+
+Usage: python benchmarks/inmemory.py [--kernel-source DIR] [--arch ARCH] [--iterations N]
+"""
+
+import argparse
+import io
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import typing as T
+
+import kconfgen
+
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+DEFAULT_KERNEL = ROOT / 'tests' / 'kconf'
+
+
+# {{{1 Legacy pipeline
+# ===================
+# The temp-file based implementation, as it was before the in-memory pipeline.
+
+
+def legacy_merge(kconf, sources: T.List[pathlib.Path]) -> T.Text:
+    for path in sources:
+        kconf.load_config(str(path.absolute()), replace=False)  # read + parse, per fragment
+    with tempfile.NamedTemporaryFile(mode='r') as f:
+        kconf.write_min_config(f.name, header='')  # write temp defconfig
+        return f.read()  # read it back
+
+
+def legacy_split(kconf, source: T.Text) -> T.List[T.Text]:
+    with tempfile.TemporaryDirectory() as d:
+        config_path = os.path.join(d, '.config')
+        defconfig_path = os.path.join(d, 'defconfig')
+        with open(config_path, 'w', encoding='utf-8') as f:
+            f.write(source)  # copy source to temp .config
+        kconf.load_config(config_path)  # read + parse .config
+        kconf.write_min_config(defconfig_path)  # write temp defconfig
+        kconf.load_config(defconfig_path)  # read + parse defconfig
+    return [sym.config_string for sym in kconf.unique_defined_syms if sym.user_value is not None]
+
+
+# {{{1 In-memory pipeline
+# ======================
+
+
+def inmemory_merge(kconf, sources: T.List[pathlib.Path]) -> T.Text:
+    return kconfgen.defconfig_merge(kconf=kconf, sources=sources, fail_on_unknown=False).output
+
+
+def inmemory_split(kconf, source: T.Text) -> T.List[T.Text]:
+    kconfgen.apply_config(kconf, kconfgen.parse_config(io.StringIO(source)), filename='<source>', replace=True)
+    minimal = kconfgen.min_config(kconf).splitlines()
+    kconfgen.apply_config(kconf, kconfgen.parse_config(minimal), filename='<minimal>', replace=True)
+    return [sym.config_string for sym in kconf.unique_defined_syms if sym.user_value is not None]
+
+
+# {{{1 Runner
+# ==========
+
+
+def timeit(fn: T.Callable[[], T.Any], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kernel-source', '-k', type=pathlib.Path, default=DEFAULT_KERNEL)
+    parser.add_argument('--arch', default='x86')
+    parser.add_argument('--iterations', '-n', type=int, default=50)
+    args = parser.parse_args()
+
+    kconf = kconfgen.load_kconf(kernel_sources=args.kernel_source, arch=args.arch)
+    kconf.warn = False
+
+    with tempfile.TemporaryDirectory() as d:
+        # Use the full default configuration, split in 4 fragments, as workload.
+        full_config = kconf._config_contents(header='')
+        lines = full_config.splitlines(keepends=True)
+        fragments = []
+        for i in range(4):
+            path = pathlib.Path(d) / 'defconfig.{}'.format(i)
+            path.write_text(''.join(lines[i::4]), encoding='utf-8')
+            fragments.append(path)
+
+        def reset(fn):
+            def wrapped():
+                kconfgen.reset_kconf(kconf)
+                return fn()
+            return wrapped
+
+        checks = [
+            (
+                'merge',
+                reset(lambda: legacy_merge(kconf, fragments)),
+                reset(lambda: inmemory_merge(kconf, fragments)),
+            ),
+            (
+                'split',
+                reset(lambda: legacy_split(kconf, full_config)),
+                reset(lambda: inmemory_split(kconf, full_config)),
+            ),
+        ]
+        removed = {
+            'merge': "1 temp file write, 1 temp file read",
+            'split': "2 temp file writes, 2 file reads, 1 full Kconfig.load_config() of the defconfig",
+        }
+
+        sys.stdout.write("{:<8} {:>12} {:>12} {:>8}  removed steps\n".format('', 'legacy', 'in-memory', 'speedup'))
+        for name, legacy, inmemory in checks:
+            if legacy() != inmemory():
+                sys.exit("Legacy and in-memory {} results differ!".format(name))
+            legacy_time = timeit(legacy, args.iterations)
+            inmemory_time = timeit(inmemory, args.iterations)
+            sys.stdout.write("{:<8} {:>10.2f}ms {:>10.2f}ms {:>7.2f}x  {}\n".format(
+                name, legacy_time * 1000, inmemory_time * 1000, legacy_time / inmemory_time, removed[name],
+            ))
+
+
+if __name__ == '__main__':
+    main()
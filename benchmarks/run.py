@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Time kconfgen's main operations on a synthetic large kernel tree.
+
+Usage:
+    python benchmarks/run.py [--symbols N] [--profiles N] [--output results.json]
+    python benchmarks/run.py --compare baseline.json [--output results.json]
+
+Each benchmark is run --repeat times; the JSON results hold every run, and
+their min / median. With --compare, medians are compared to a previous
+results file, and the script exits with an error if any benchmark is slower
+than --max-regression times its baseline.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import typing as T
+
+import kconfiglib
+import toml
+
+import kconfgen
+import synthetic
+
+
+Benchmark = T.Callable[[], T.Any]
+
+
+def measure(fn: Benchmark, repeat: int, setup: T.Optional[Benchmark] = None) -> T.Dict[T.Text, T.Any]:
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'runs': runs,
+    }
+
+
+def run_benchmarks(tree: synthetic.SyntheticTree, args: argparse.Namespace) -> T.Dict[T.Text, T.Any]:
+    results: T.Dict[T.Text, T.Any] = {}
+    config = kconfgen.load_configuration(toml.load(str(tree.root / kconfgen.PROFILES_FILENAME)))
+    profiles = {
+        name: kconfgen.defconfig_for_target(config, name, tree.root, extra_include=[])
+        for name in tree.profiles
+    }
+    target = tree.profiles[0]
+    arch = profiles[target].arch
+
+    def report(name: T.Text, result: T.Dict[T.Text, T.Any]) -> None:
+        results[name] = result
+        sys.stderr.write("{:<24} min {:>9.1f}ms  median {:>9.1f}ms\n".format(
+            name, result['min'] * 1000, result['median'] * 1000,
+        ))
+
+    report('load_profiles', measure(lambda: kconfgen.load_profiles(tree.root), repeat=args.repeat))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        kconfgen.load_profiles(tree.root, cache_dir=pathlib.Path(cache_dir))
+        report('load_profiles_cached', measure(
+            lambda: kconfgen.load_profiles(tree.root, cache_dir=pathlib.Path(cache_dir)),
+            repeat=args.repeat,
+        ))
+
+    report('load_kconf', measure(
+        lambda: kconfgen.load_kconf(kernel_sources=tree.kernel_sources, arch=arch),
+        repeat=args.repeat,
+    ))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        kconfgen.load_kconf(kernel_sources=tree.kernel_sources, arch=arch, cache_dir=pathlib.Path(cache_dir))
+        report('load_kconf_cached', measure(
+            lambda: kconfgen.load_kconf(
+                kernel_sources=tree.kernel_sources, arch=arch, cache_dir=pathlib.Path(cache_dir),
+            ),
+            repeat=args.repeat,
+        ))
+
+    kconf = kconfgen.load_kconf(kernel_sources=tree.kernel_sources, arch=arch)
+    kconf.warn = False
+
+    report('defconfig_merge', measure(
+        lambda: kconfgen.defconfig_merge(kconf=kconf, sources=profiles[target].files, fail_on_unknown=False),
+        setup=lambda: kconfgen.reset_kconf(kconf),
+        repeat=args.repeat,
+    ))
+
+    kconfgen.reset_kconf(kconf)
+    kconfgen.defconfig_merge(kconf=kconf, sources=profiles[target].files, fail_on_unknown=False)
+    full_config = kconf._config_contents(header='')
+    with tree.categories.open('r', encoding='utf-8') as f:
+        categories = kconfgen.CategoryIndex(f)
+    with tempfile.TemporaryDirectory() as destdir:
+        report('defconfig_split', measure(
+            lambda: kconfgen.defconfig_split(
+                kconf=kconf,
+                fail_on_unknown=False,
+                categories=categories,
+                destdir=pathlib.Path(destdir),
+                source=io.StringIO(full_config),
+                prefix='defconfig',
+            ),
+            setup=lambda: kconfgen.reset_kconf(kconf),
+            repeat=args.repeat,
+        ))
+
+    def assemble(jobs: int) -> None:
+        for _ in kconfgen.assemble_profiles(
+                config=config,
+                targets=tree.profiles,
+                root=tree.root,
+                kernel_sources=tree.kernel_sources,
+                fail_on_unknown=False,
+                extra_include=[],
+                jobs=jobs,
+        ):
+            pass
+
+    report('assemble_all', measure(lambda: assemble(1), repeat=args.repeat))
+    if args.jobs > 1:
+        report('assemble_all_j{}'.format(args.jobs), measure(lambda: assemble(args.jobs), repeat=args.repeat))
+
+    return results
+
+
+def compare(results: T.Dict[T.Text, T.Any], baseline: T.Dict[T.Text, T.Any], max_regression: float) -> bool:
+    if baseline['parameters'] != results['parameters']:
+        sys.stderr.write("Warning: parameters differ from the baseline: {} != {}\n".format(
+            results['parameters'], baseline['parameters'],
+        ))
+    ok = True
+    sys.stdout.write("{:<24} {:>12} {:>12} {:>8}\n".format('', 'baseline', 'current', 'ratio'))
+    for name, result in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['median']
+        ratio = result['median'] / before
+        flag = ''
+        if ratio > max_regression:
+            flag = '  REGRESSION'
+            ok = False
+        sys.stdout.write("{:<24} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x{}\n".format(
+            name, before * 1000, result['median'] * 1000, ratio, flag,
+        ))
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=15000)
+    parser.add_argument('--profiles', type=int, default=300)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', '-n', type=int, default=3)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Also time assembly with N worker processes")
+    parser.add_argument('--workdir', type=pathlib.Path, default=None,
+                        help="Generate (or reuse) the synthetic tree there, instead of a temporary directory")
+    parser.add_argument('--output', '-o', type=pathlib.Path, default=None, help="Write JSON results there")
+    parser.add_argument('--compare', type=pathlib.Path, default=None, help="Baseline JSON results")
+    parser.add_argument('--max-regression', type=float, default=1.15)
+    args = parser.parse_args()
+
+    parameters = {
+        'symbols': args.symbols,
+        'profiles': args.profiles,
+        'depth': args.depth,
+        'seed': args.seed,
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or pathlib.Path(tmpdir)
+        stamp = workdir / 'parameters.json'
+        if stamp.exists() and json.loads(stamp.read_text(encoding='utf-8')) == parameters:
+            with (workdir / 'profiles' / kconfgen.PROFILES_FILENAME).open('r', encoding='utf-8') as f:
+                names = list(toml.load(f)['profile'])
+            tree = synthetic.SyntheticTree(
+                kernel_sources=workdir / 'linux',
+                root=workdir / 'profiles',
+                categories=workdir / 'profiles' / 'categories',
+                symbols=[],
+                profiles=names,
+            )
+        else:
+            sys.stderr.write("Generating a synthetic tree with {} symbols...\n".format(args.symbols))
+            tree = synthetic.generate(workdir, symbols=args.symbols, profiles=args.profiles,
+                                      depth=args.depth, seed=args.seed)
+            stamp.write_text(json.dumps(parameters), encoding='utf-8')
+
+        results = {
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'parameters': parameters,
+            'environment': {
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'kconfgen': kconfgen.__version__,
+                'kconfiglib': '.'.join(str(part) for part in kconfiglib.VERSION),
+            },
+            'benchmarks': run_benchmarks(tree, args),
+        }
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2, sort_keys=True), encoding='utf-8')
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text(encoding='utf-8'))
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
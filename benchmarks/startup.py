@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Time the startup of trivial kconfgen commands, against time budgets.
+
+Usage: python benchmarks/startup.py [--repeat N] [--budget MS]
+
+Each command is run --repeat times in a fresh interpreter; its median wall
+time, minus the median startup time of a bare interpreter, must stay within
+--budget milliseconds. Trivial commands must not import kconfiglib or toml.
+The script exits with an error if any command is over budget.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+import typing as T
+
+
+COMMANDS = {
+    'version': ['version'],
+    'help': ['help'],
+    'no_command': [],
+}
+
+# Modules which trivial commands should not load
+HEAVY_MODULES = ['kconfiglib', 'toml', 'kconfgen.core']
+
+RUNNER = """
+import sys
+from kconfgen import cli
+sys.argv = ['kconfgen'] + sys.argv[1:]
+try:
+    cli.main()
+finally:
+    sys.stdout.flush()
+    sys.stderr.write(' '.join(name for name in {heavy!r} if name in sys.modules) + '\\n')
+"""
+
+
+def run(argv: T.List[T.Text], repeat: int) -> T.Tuple[float, T.Text]:
+    """Median wall time of a command, and the heavy modules it loaded."""
+    runs = []
+    loaded = ''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            argv,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        runs.append(time.perf_counter() - start)
+        loaded = process.stderr.decode('utf-8').strip()
+    return statistics.median(runs), loaded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', '-n', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=100.0,
+                        help="Maximum time of a command over a bare interpreter start, in milliseconds")
+    args = parser.parse_args()
+
+    baseline, _ = run([sys.executable, '-c', 'pass'], args.repeat)
+    sys.stderr.write("{:<24} {:>9.1f}ms\n".format('python', baseline * 1000))
+
+    ok = True
+    runner = RUNNER.format(heavy=HEAVY_MODULES)
+    for name, command in sorted(COMMANDS.items()):
+        duration, loaded = run([sys.executable, '-c', runner] + command, args.repeat)
+        overhead = (duration - baseline) * 1000
+        flags = []
+        if overhead > args.budget:
+            flags.append('OVER BUDGET')
+        if loaded:
+            flags.append('LOADED {}'.format(loaded))
+        ok = ok and not flags
+        sys.stdout.write("{:<24} {:>9.1f}ms  +{:>7.1f}ms  {}\n".format(
+            name, duration * 1000, overhead, ', '.join(flags),
+        ))
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
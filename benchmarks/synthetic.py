@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""Generate a synthetic kernel-like Kconfig tree, with a matching profiles repository.
+
+Usage: python benchmarks/synthetic.py DEST [--symbols N] [--profiles N] [--seed N]
+
+The generated layout mimics a real kernel:
+
+- ``DEST/linux/Kconfig`` sources ``arch/$(SRCARCH)/Kconfig``, ``lib/Kconfig``,
+  then one Kconfig per subsystem, each sourcing its subdirectories down to ``--depth``;
+- each directory holds a gating ``menuconfig`` and bool/tristate/int/hex/string
+  symbols, depending on earlier symbols, selecting ``lib/`` symbols, and some choices;
+- ``DEST/profiles`` holds fragments (one per include group, plus per-profile extras),
+  a ``profiles.toml`` and a ``categories`` file suitable for ``kconfgen split``.
+"""
+
+import argparse
+import os
+import pathlib
+import random
+import sys
+import typing as T
+
+
+ARCHES = ('x86', 'arm64', 'riscv', 'powerpc')
+SUBSYSTEMS = ('drivers', 'fs', 'net', 'crypto', 'sound', 'security', 'block', 'kernel', 'mm', 'virt')
+TYPES = (
+    # type, weight
+    ('bool', 60),
+    ('tristate', 30),
+    ('int', 5),
+    ('hex', 2),
+    ('string', 3),
+)
+
+
+class Symbol(T.NamedTuple):
+    name: T.Text
+    type: T.Text
+    directory: T.Text
+
+
+class SyntheticTree(T.NamedTuple):
+    kernel_sources: pathlib.Path
+    root: pathlib.Path
+    categories: pathlib.Path
+    symbols: T.List[Symbol]
+    profiles: T.List[T.Text]
+
+
+# {{{1 Kconfig tree
+# ================
+
+
+def _directories(depth: int, branching: int) -> T.List[T.Text]:
+    """All directories of the tree, parents first."""
+    directories = []
+    level = list(SUBSYSTEMS)
+    for _ in range(depth):
+        directories.extend(level)
+        level = [
+            '{}/{}{}'.format(parent, parent.rsplit('/', 1)[-1][:3], i)
+            for parent in level
+            for i in range(branching)
+        ]
+    return directories
+
+
+def _symbol_prefix(directory: T.Text) -> T.Text:
+    return directory.replace('/', '_').upper()
+
+
+def _default(rng: random.Random, kind: T.Text) -> T.Text:
+    if kind == 'int':
+        return str(rng.randrange(1, 4096))
+    elif kind == 'hex':
+        return hex(rng.randrange(0x1000, 0x100000))
+    elif kind == 'string':
+        return '"value{}"'.format(rng.randrange(100))
+    else:
+        return rng.choice(('y', 'n', 'm' if kind == 'tristate' else 'y'))
+
+
+def generate_kernel(
+        dest: pathlib.Path,
+        symbols: int,
+        depth: int = 5,
+        branching: int = 3,
+        lib_symbols: int = 500,
+        seed: int = 0,
+) -> T.List[Symbol]:
+    """Write a Kconfig tree with about `symbols` user-visible symbols under dest."""
+    rng = random.Random(seed)
+    directories = _directories(depth, branching)
+    children: T.Dict[T.Text, T.List[T.Text]] = {directory: [] for directory in directories}
+    for directory in directories:
+        if '/' in directory:
+            children[directory.rsplit('/', 1)[0]].append(directory)
+    per_directory = max(2, (symbols - lib_symbols) // len(directories))
+    generated: T.List[Symbol] = []
+
+    def write(path: T.Text, contents: T.List[T.Text]) -> None:
+        full_path = dest / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text('\n'.join(contents) + '\n', encoding='utf-8')
+
+    write('Kconfig', [
+        'mainmenu "Synthetic Linux/$(SRCARCH) Kernel Configuration"',
+        '',
+        'config MODULES',
+        '\tbool "Enable loadable module support"',
+        '\toption modules',
+        '\tdefault y',
+        '',
+        'source "arch/$(SRCARCH)/Kconfig"',
+        'source "lib/Kconfig"',
+    ] + ['source "{}/Kconfig"'.format(subsystem) for subsystem in SUBSYSTEMS])
+
+    for arch in ARCHES:
+        write('arch/{}/Kconfig'.format(arch), [
+            'config {}'.format(arch.upper()),
+            '\tdef_bool y',
+            '',
+            'config ARCH_NR_CPUS',
+            '\tint "Maximum number of CPUs"',
+            '\tdefault {}'.format(rng.choice((8, 64, 512))),
+        ])
+
+    lib = []
+    for i in range(lib_symbols):
+        lib.extend(['config LIB_{}'.format(i), '\tbool', ''])
+    write('lib/Kconfig', lib)
+    generated.extend(Symbol('LIB_{}'.format(i), 'bool', 'lib') for i in range(lib_symbols))
+
+    kinds = [kind for kind, _ in TYPES]
+    weights = [weight for _, weight in TYPES]
+    for directory in directories:
+        prefix = _symbol_prefix(directory)
+        gate = prefix
+        lines = [
+            'menuconfig {}'.format(gate),
+            '\tbool "{} support"'.format(directory),
+        ]
+        if '/' in directory:
+            lines.append('\tdepends on {}'.format(_symbol_prefix(directory.rsplit('/', 1)[0])))
+        lines.extend(['\tdefault y', '', 'if {}'.format(gate), ''])
+        generated.append(Symbol(gate, 'bool', directory))
+
+        names: T.List[T.Text] = []
+        i = 0
+        while i < per_directory:
+            if rng.random() < 0.02:
+                # A choice between 3 options.
+                lines.extend(['choice', '\tprompt "{} mode"'.format(directory), ''])
+                for option in range(3):
+                    name = '{}_MODE_{}'.format(prefix, i + option)
+                    lines.extend(['config {}'.format(name), '\tbool "Mode {}"'.format(option), ''])
+                    generated.append(Symbol(name, 'bool', directory))
+                lines.extend(['endchoice', ''])
+                i += 3
+                continue
+
+            kind = rng.choices(kinds, weights)[0]
+            name = '{}_{}'.format(prefix, i)
+            lines.extend(['config {}'.format(name), '\t{} "{} {}"'.format(kind, directory, i)])
+            if names and rng.random() < 0.5:
+                # Only depend on earlier symbols, to avoid dependency loops.
+                lines.append('\tdepends on {}'.format(rng.choice(names)))
+            if kind in ('bool', 'tristate') and rng.random() < 0.3:
+                lines.append('\tselect LIB_{}'.format(rng.randrange(lib_symbols)))
+            if kind not in ('bool', 'tristate') or rng.random() < 0.4:
+                lines.append('\tdefault {}'.format(_default(rng, kind)))
+            lines.extend(['\thelp', '\t  Synthetic symbol {}.'.format(name), ''])
+            if kind in ('bool', 'tristate'):
+                names.append(name)
+            generated.append(Symbol(name, kind, directory))
+            i += 1
+
+        lines.extend(['endif', ''])
+        lines.extend('source "{}/Kconfig"'.format(child) for child in children[directory])
+        write('{}/Kconfig'.format(directory), lines)
+
+    return generated
+
+
+# {{{1 Profiles repository
+# =======================
+
+
+def _assignment(rng: random.Random, symbol: Symbol) -> T.Text:
+    if symbol.type in ('bool', 'tristate'):
+        value = rng.choice(('y', 'm', 'n') if symbol.type == 'tristate' else ('y', 'n'))
+        if value == 'n':
+            return '# CONFIG_{} is not set'.format(symbol.name)
+        return 'CONFIG_{}={}'.format(symbol.name, value)
+    return 'CONFIG_{}={}'.format(symbol.name, _default(rng, symbol.type))
+
+
+def generate_profiles(
+        dest: pathlib.Path,
+        symbols: T.List[Symbol],
+        profiles: int,
+        groups: int = 120,
+        group_size: int = 60,
+        seed: int = 0,
+) -> T.List[T.Text]:
+    """Write fragments, profiles.toml and a categories file under dest."""
+    rng = random.Random(seed)
+    dest.mkdir(parents=True, exist_ok=True)
+    visible = [symbol for symbol in symbols if symbol.directory != 'lib']
+    by_subsystem: T.Dict[T.Text, T.List[Symbol]] = {}
+    for symbol in visible:
+        by_subsystem.setdefault(symbol.directory.split('/', 1)[0], []).append(symbol)
+
+    # Fragments assign disjoint sets of symbols, as long as there are enough
+    # symbols: overriding values across fragments triggers (legitimate) warnings.
+    remaining = list(visible)
+    rng.shuffle(remaining)
+    for pool in by_subsystem.values():
+        rng.shuffle(pool)
+    used: T.Set[T.Text] = set()
+
+    def write_fragment(name: T.Text, pool: T.List[Symbol], size: int) -> None:
+        chosen: T.List[Symbol] = []
+        while pool and len(chosen) < size:
+            symbol = pool.pop()
+            if symbol.name not in used:
+                used.add(symbol.name)
+                chosen.append(symbol)
+        if len(chosen) < size:
+            chosen.extend(rng.sample(visible, min(size - len(chosen), len(visible))))
+        (dest / name).write_text(
+            ''.join('{}\n'.format(_assignment(rng, symbol)) for symbol in chosen),
+            encoding='utf-8',
+        )
+
+    lines = ['[core]', 'fragments_dir = "fragments"', '']
+    (dest / 'fragments').mkdir(exist_ok=True)
+
+    group_names = []
+    write_fragment('fragments/defconfig.base', remaining, group_size * 2)
+    lines.extend(['[include.base]', 'files = ["defconfig.base"]', ''])
+    for i in range(groups):
+        subsystem = SUBSYSTEMS[i % len(SUBSYSTEMS)]
+        name = '{}{}'.format(subsystem, i)
+        write_fragment('fragments/defconfig.{}'.format(name), by_subsystem[subsystem], group_size)
+        lines.extend(['[include.{}]'.format(name), 'files = ["defconfig.{}"]'.format(name), ''])
+        group_names.append(name)
+
+    # Profiles are organised in families sharing their first include groups,
+    # as is usual for real-world repositories (board families, product lines).
+    families = [rng.sample(group_names, 3) for _ in range(max(1, profiles // 20))]
+    names = []
+    for i in range(profiles):
+        name = 'profile{}'.format(i)
+        write_fragment('fragments/defconfig.{}'.format(name), remaining, group_size // 3)
+        family = families[i % len(families)]
+        others = [group for group in group_names if group not in family]
+        include = ['base'] + family + rng.sample(others, rng.randrange(1, 5))
+        lines.extend([
+            '[profile.{}]'.format(name),
+            'arch = "{}"'.format(ARCHES[i % len(ARCHES)]),
+            'include = [{}]'.format(', '.join('"{}"'.format(group) for group in include)),
+            'extras = ["defconfig.{}"]'.format(name),
+            '',
+        ])
+        names.append(name)
+    (dest / 'profiles.toml').write_text('\n'.join(lines), encoding='utf-8')
+
+    categories = ['lib/', 'arch/'] + [
+        '{}/'.format(directory)
+        for directory in sorted({symbol.directory for symbol in visible})
+        if directory.count('/') < 2
+    ]
+    (dest / 'categories').write_text('\n'.join(categories) + '\n', encoding='utf-8')
+    return names
+
+
+def generate(
+        dest: pathlib.Path,
+        symbols: int = 15000,
+        profiles: int = 300,
+        depth: int = 5,
+        seed: int = 0,
+) -> SyntheticTree:
+    kernel_sources = dest / 'linux'
+    root = dest / 'profiles'
+    generated = generate_kernel(kernel_sources, symbols=symbols, depth=depth, seed=seed)
+    names = generate_profiles(root, generated, profiles=profiles, seed=seed)
+    return SyntheticTree(
+        kernel_sources=kernel_sources,
+        root=root,
+        categories=root / 'categories',
+        symbols=generated,
+        profiles=names,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('dest', type=pathlib.Path)
+    parser.add_argument('--symbols', type=int, default=15000)
+    parser.add_argument('--profiles', type=int, default=300)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.dest.exists() and os.listdir(str(args.dest)):
+        sys.exit("{} is not empty".format(args.dest))
+    tree = generate(args.dest, symbols=args.symbols, profiles=args.profiles, depth=args.depth, seed=args.seed)
+    sys.stdout.write("Generated {s} symbols in {k}, {p} profiles in {r}.\n".format(
+        s=len(tree.symbols), k=tree.kernel_sources, p=len(tree.profiles), r=tree.root,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,113 @@ import typing as T
 
 SymbolValue = T.Union[int, T.Text]
 
+VERSION: T.Tuple[int, int, int]
+
+os: T.Any
+
+UNKNOWN: int
+BOOL: int
+TRISTATE: int
+STRING: int
+INT: int
+HEX: int
+
+TYPE_TO_STR: T.Dict[int, T.Text]
+TRI_TO_STR: T.Dict[int, T.Text]
+STR_TO_TRI: T.Dict[T.Text, int]
+
+
+def escape(s: T.Text) -> T.Text: ...
+
+
+def unescape(s: T.Text) -> T.Text: ...
+
 
 class MenuNode:
     filename: T.Text
+    linenr: int
 
 
 class Symbol:
+    name: T.Text
+    name_and_loc: T.Text
+    orig_type: int
+    type: int
     user_value: T.Optional[SymbolValue]
+    str_value: T.Text
+    tri_value: int
+    choice: T.Optional['Choice']
 
     config_string: T.Text
 
     nodes: T.Sequence[MenuNode]
 
+    def set_value(self, value: SymbolValue) -> bool: ...
+
+    def unset_value(self) -> None: ...
+
+    _was_set: bool
+
+
+class Choice:
+    user_value: T.Optional[int]
+    user_selection: T.Optional[Symbol]
+
+    def set_value(self, value: SymbolValue) -> bool: ...
+
+    def unset_value(self) -> None: ...
+
+    _was_set: bool
+
 
 class Kconfig:
-    def load_config(self, filename: str = None, replace: bool = True, verbose=None) -> str: ...
+    def __init__(
+        self,
+        filename: str = ...,
+        warn: bool = ...,
+        warn_to_stderr: bool = ...,
+        encoding: str = ...,
+        suppress_traceback: bool = ...,
+    ) -> None: ...
+
+    def load_config(self, filename: T.Optional[str] = None, replace: bool = True, verbose=None) -> str: ...
 
     def write_min_config(self, filename: str, header: str = ...) -> str: ...
 
+    def unset_values(self) -> None: ...
+
+    srctree: T.Text
+    config_prefix: T.Text
+    kconfig_filenames: T.List[T.Text]
+    env_vars: T.Set[T.Text]
+    warnings: T.List[T.Text]
+    warn: bool
+    warn_to_stderr: bool
+    syms: T.Dict[T.Text, Symbol]
     missing_syms: T.List[T.Tuple[T.Text, T.Text]]
     unique_defined_syms: T.List[Symbol]
+    unique_choices: T.List[Choice]
+
+    def _warn(self, msg: T.Text, filename: T.Optional[T.Text] = None, linenr: T.Optional[int] = None) -> None: ...
+
+    def _undef_assign(self, name: T.Text, val: T.Text, filename: T.Text, linenr: int) -> None: ...
+
+    def _assigned_twice(self, sym: Symbol, new_val: SymbolValue, filename: T.Text, linenr: int) -> None: ...
+
+    def _min_config_contents(self, header: T.Optional[T.Text]) -> T.Text: ...
+
+    def _config_contents(self, header: T.Optional[T.Text]) -> T.Text: ...
+
+    def _autoconf_contents(self, header: T.Optional[T.Text]) -> T.Text: ...
+
+    def _invalidate_all(self) -> None: ...
+
+    _warn_assign_no_prompt: bool
+    _encoding: T.Text
+    filename: T.Text
+    linenr: int
+    _readline: T.Any
+
+
+class KconfigError(Exception):
+    pass
@@ -39,7 +39,9 @@ setup(
     license='MIT',
     python_requires=">=3.5",
     install_requires=[
-        'kconfiglib',
+        # kconfgen relies on kconfiglib internals (_load_config() logic,
+        # _min_config_contents(), ...): only allow the tested releases.
+        'kconfiglib>=14.1,<15',
         'toml',
     ],
     setup_requires=[
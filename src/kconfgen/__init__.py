@@ -1,14 +1,93 @@
+import importlib
+import sys
+import typing as T
+
 __version__ = '1.2.3.dev0'
 
 
-from .core import (  # noqa: F401
-    load_kconf,
-    load_configuration,
-    Configuration,
-    CfgProfile,
-    CfgInclude,
-    PROFILES_FILENAME,
-    defconfig_for_target,
-    defconfig_merge,
-    defconfig_split,
-)
+# Public names, by defining module; loading kconfgen.core imports kconfiglib,
+# which is deferred until one of them is used (on Python >= 3.7).
+_EXPORTS = {
+    'core': (
+        'load_kconf',
+        'kconf_environ',
+        'reset_kconf',
+        'snapshot_kconf',
+        'restore_kconf',
+        'parse_config',
+        'apply_config',
+        'min_config',
+        'full_config',
+        'autoconf_header',
+        'symbols_json',
+        'KconfPool',
+        'FragmentCache',
+        'load_configuration',
+        'load_profiles',
+        'Configuration',
+        'CfgProfile',
+        'CfgInclude',
+        'PROFILES_FILENAME',
+        'defconfig_for_target',
+        'defconfig_merge',
+        'defconfig_merge_many',
+        'defconfig_split',
+        'CategoryIndex',
+        'assemble_profiles',
+        'ProfileResult',
+    ),
+    'timings': (
+        'Timings',
+    ),
+}
+
+
+# Static imports for type checkers; keep in sync with _EXPORTS (checked by the tests).
+if T.TYPE_CHECKING:
+    from .core import (  # noqa: F401
+        load_kconf,
+        kconf_environ,
+        reset_kconf,
+        snapshot_kconf,
+        restore_kconf,
+        parse_config,
+        apply_config,
+        min_config,
+        full_config,
+        autoconf_header,
+        symbols_json,
+        KconfPool,
+        FragmentCache,
+        load_configuration,
+        load_profiles,
+        Configuration,
+        CfgProfile,
+        CfgInclude,
+        PROFILES_FILENAME,
+        defconfig_for_target,
+        defconfig_merge,
+        defconfig_merge_many,
+        defconfig_split,
+        CategoryIndex,
+        assemble_profiles,
+        ProfileResult,
+    )
+    from .timings import Timings  # noqa: F401
+
+elif sys.version_info < (3, 7):
+    # No module __getattr__ (PEP 562): import everything upfront.
+    for _module, _names in _EXPORTS.items():
+        _loaded = importlib.import_module('.' + _module, __name__)
+        globals().update((_name, getattr(_loaded, _name)) for _name in _names)
+
+else:
+    def __getattr__(name: T.Text) -> T.Any:
+        for module, names in _EXPORTS.items():
+            if name in names:
+                value = getattr(importlib.import_module('.' + module, __name__), name)
+                globals()[name] = value
+                return value
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    def __dir__() -> T.List[T.Text]:
+        return sorted(set(globals()) | {name for names in _EXPORTS.values() for name in names})
@@ -0,0 +1,465 @@
+import abc
+import contextlib
+import gc
+import hashlib
+import http.client
+import json
+import os
+import pathlib
+import pickle
+import re
+import sys
+import tempfile
+import threading
+import typing as T
+import urllib.request
+
+import kconfiglib
+
+
+# Bump whenever the layout of cached entries changes.
+CACHE_FORMAT = 1
+
+# kconfiglib objects are deeply linked (menu nodes, expressions, symbols);
+# pickling them requires much more than the default recursion limit and stack.
+PICKLE_RECURSION_LIMIT = 200000
+PICKLE_STACK_SIZE = 512 * 1024 * 1024
+
+
+# {{{1 Helpers
+# ===========
+
+
+def file_digest(path: T.Union[T.Text, pathlib.Path]) -> T.Text:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_digest(*parts: T.Text) -> T.Text:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+
+
+@contextlib.contextmanager
+def gc_paused() -> T.Iterator[None]:
+    """Disable the cyclic GC while building large object graphs.
+
+    Parsing or unpickling a Kconfig tree allocates hundreds of thousands of
+    objects, none of them garbage; collections during that phase are pure overhead.
+    Pauses may overlap across threads: the GC is enabled again after the last one.
+    """
+    global _gc_pauses
+    with _gc_lock:
+        # If disabled by someone else, leave it alone.
+        managed = bool(_gc_pauses) or gc.isenabled()
+        if managed:
+            _gc_pauses += 1
+            gc.disable()
+    try:
+        yield
+    finally:
+        if managed:
+            with _gc_lock:
+                _gc_pauses -= 1
+                if not _gc_pauses:
+                    gc.enable()
+
+
+def atomic_write(path: pathlib.Path, contents: T.Union[bytes, T.Text]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.{}.'.format(path.name))
+    try:
+        if isinstance(contents, bytes):
+            with os.fdopen(fd, 'wb') as f:
+                f.write(contents)
+        else:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(contents)
+        os.replace(tmp, str(path))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def write_if_changed(path: pathlib.Path, contents: T.Text) -> bool:
+    """Atomically replace path with contents, unless it already holds them.
+
+    Returns whether the file was written; its mtime is kept otherwise.
+    """
+    try:
+        with path.open('r', encoding='utf-8') as f:
+            if f.read() == contents:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    atomic_write(path, contents)
+    return True
+
+
+_pickle_lock = threading.Lock()
+
+
+def _deep_pickle(obj: T.Any) -> bytes:
+    # Run pickle.dumps() in a thread with a large stack, as the default stack
+    # is too small for the recursion depth of a full kernel tree.
+    # The recursion limit is process-wide: serialize those.
+    with _pickle_lock:
+        return _deep_pickle_locked(obj)
+
+
+def _deep_pickle_locked(obj: T.Any) -> bytes:
+    result: T.Dict[T.Text, T.Any] = {}
+
+    def run() -> None:
+        try:
+            result['data'] = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException as e:
+            result['error'] = e
+
+    old_limit = sys.getrecursionlimit()
+    old_stack = threading.stack_size()
+    sys.setrecursionlimit(max(old_limit, PICKLE_RECURSION_LIMIT))
+    try:
+        threading.stack_size(PICKLE_STACK_SIZE)
+        try:
+            thread = threading.Thread(target=run)
+        finally:
+            threading.stack_size(old_stack)
+        thread.start()
+        thread.join()
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+    if 'error' in result:
+        raise result['error']
+    return result['data']
+
+
+class PickleStore:
+    """A directory of pickled objects, keyed by (content) digest."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+
+    def _entry(self, key: T.Text) -> pathlib.Path:
+        return self.path / key[:2] / '{}.pickle'.format(key)
+
+    def get(self, key: T.Text) -> T.Any:
+        try:
+            with self._entry(key).open('rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def put(self, key: T.Text, value: T.Any) -> None:
+        try:
+            atomic_write(self._entry(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            # A read-only or full cache must not break the run.
+            pass
+
+
+# {{{1 Kconfig trees
+# =================
+
+
+class KconfCache:
+    """On-disk cache of parsed Kconfig trees.
+
+    Entries are keyed by kernel source path and arch, and validated against
+    the content of every Kconfig file read during the parse, and the
+    environment variables the Kconfig files referenced.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+
+    def _entry(self, kernel_sources: pathlib.Path, arch: T.Text) -> pathlib.Path:
+        key = text_digest(
+            str(CACHE_FORMAT),
+            '.'.join(str(part) for part in kconfiglib.VERSION),
+            '{}.{}'.format(*sys.version_info[:2]),
+            os.path.realpath(str(kernel_sources)),
+            arch,
+        )
+        return self.path / 'kconf' / key
+
+    def fingerprint(
+            self,
+            kernel_sources: pathlib.Path,
+            arch: T.Text,
+            environ: T.Mapping[T.Text, T.Text],
+    ) -> T.Optional[T.Text]:
+        """Fingerprint of a cached tree, if the cached entry is still valid."""
+        index_path = self._entry(kernel_sources, arch).with_suffix('.json')
+        try:
+            with index_path.open('r', encoding='utf-8') as f:
+                index = json.load(f)
+            for name, value in index['env'].items():
+                if environ.get(name) != value:
+                    return None
+            for name, digest in index['files'].items():
+                if file_digest(os.path.join(str(kernel_sources), name)) != digest:
+                    return None
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None
+        return T.cast(T.Text, index['fingerprint'])
+
+    def load(
+            self,
+            kernel_sources: pathlib.Path,
+            arch: T.Text,
+            environ: T.Mapping[T.Text, T.Text],
+    ) -> T.Optional[kconfiglib.Kconfig]:
+        if self.fingerprint(kernel_sources, arch, environ) is None:
+            return None
+        entry = self._entry(kernel_sources, arch)
+        try:
+            with entry.with_suffix('.pickle').open('rb') as f, gc_paused():
+                kconf = pickle.load(f)
+        except Exception:
+            # Any corruption means a cache miss.
+            return None
+        if not isinstance(kconf, kconfiglib.Kconfig):
+            return None
+        return kconf
+
+    def store(
+            self,
+            kernel_sources: pathlib.Path,
+            arch: T.Text,
+            environ: T.Mapping[T.Text, T.Text],
+            kconf: kconfiglib.Kconfig,
+    ) -> None:
+        files = {
+            name: file_digest(os.path.join(str(kernel_sources), name))
+            for name in kconf.kconfig_filenames
+        }
+        env = {name: environ[name] for name in sorted(kconf.env_vars) if name in environ}
+        index = {
+            'files': files,
+            'env': env,
+            'fingerprint': kconf_fingerprint(files, env),
+        }
+
+        # The file-reading callback of the last parsed file can't be pickled,
+        # and is useless once parsing is complete.
+        readline, kconf._readline = kconf._readline, None
+        try:
+            data = _deep_pickle(kconf)
+        finally:
+            kconf._readline = readline
+
+        entry = self._entry(kernel_sources, arch)
+        # The index marks the entry as valid: write it last.
+        atomic_write(entry.with_suffix('.pickle'), data)
+        atomic_write(entry.with_suffix('.json'), json.dumps(index, indent=2, sort_keys=True))
+
+
+def kconf_fingerprint(files: T.Mapping[T.Text, T.Text], env: T.Mapping[T.Text, T.Text]) -> T.Text:
+    return text_digest(
+        *('{}={}'.format(name, digest) for name, digest in sorted(files.items())),
+        *('${}={}'.format(name, value) for name, value in sorted(env.items())),
+    )
+
+
+# {{{1 Results
+# ===========
+
+
+# Bump whenever the contents of cached results change.
+RESULT_FORMAT = 3
+
+# $(NAME), $NAME and ${NAME} in Kconfig files; NAME may come from the environment.
+_VARIABLE_REFERENCE = re.compile(rb'\$[({]?([A-Za-z_]\w*)')
+
+# Set from the kernel tree and arch when parsing, rather than from the environment.
+_TREE_VARIABLES = {'srctree', 'SRCARCH'}
+
+
+class TreeFingerprint(T.NamedTuple):
+    digest: T.Text
+    # Variables referenced by the Kconfig files
+    variables: T.FrozenSet[T.Text]
+
+
+def tree_fingerprint(kernel_sources: pathlib.Path) -> TreeFingerprint:
+    """Fingerprint of the files of a kernel tree Kconfig depends on, without parsing it.
+
+    Unlike the KconfCache fingerprint, this doesn't require a parsed tree:
+    it covers all files named Kconfig*, whichever arch they belong to, and
+    the scripts/ directory, whose tools $(shell,...) may run.
+    """
+    root = str(kernel_sources)
+    scripts = os.path.join(root, 'scripts')
+    parts = []
+    variables: T.Set[T.Text] = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        in_scripts = dirpath == scripts or dirpath.startswith(scripts + os.sep)
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if name.startswith('Kconfig'):
+                with open(path, 'rb') as f:
+                    contents = f.read()
+                variables.update(match.decode('ascii') for match in _VARIABLE_REFERENCE.findall(contents))
+                digest = hashlib.sha256(contents).hexdigest()
+            elif in_scripts and os.path.isfile(path):
+                digest = file_digest(path)
+            else:
+                continue
+            parts.append('{}={}'.format(os.path.relpath(path, root), digest))
+    return TreeFingerprint(digest=text_digest(*parts), variables=frozenset(variables - _TREE_VARIABLES))
+
+
+class ResultStore(abc.ABC):
+    """Backend of a result cache: opaque values, addressed by key."""
+
+    @abc.abstractmethod
+    def get(self, key: T.Text) -> T.Optional[bytes]:
+        """The value stored for key; None if missing, or on any backend error."""
+
+    @abc.abstractmethod
+    def put(self, key: T.Text, value: bytes) -> None:
+        """Store a value for key; backend errors are ignored."""
+
+
+class DirectoryStore(ResultStore):
+    """Results stored as files in a local (or network-mounted) directory."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+
+    def _entry(self, key: T.Text) -> pathlib.Path:
+        return self.path / key[:2] / key
+
+    def get(self, key: T.Text) -> T.Optional[bytes]:
+        try:
+            return self._entry(key).read_bytes()
+        except OSError:
+            return None
+
+    def put(self, key: T.Text, value: bytes) -> None:
+        try:
+            atomic_write(self._entry(key), value)
+        except OSError:
+            pass
+
+
+class HTTPStore(ResultStore):
+    """Results stored on an HTTP server, with GET and PUT on BASE_URL/KEY.
+
+    Any WebDAV-enabled server, or a cache proxy speaking this protocol, will do.
+    Network errors are treated as cache misses.
+    """
+
+    def __init__(self, url: T.Text, timeout: float = 10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key: T.Text) -> T.Optional[bytes]:
+        try:
+            with urllib.request.urlopen('{}/{}'.format(self.url, key), timeout=self.timeout) as response:
+                return T.cast(bytes, response.read())
+        except (OSError, ValueError, http.client.HTTPException):
+            # URLError and HTTPError are OSErrors; truncated or garbled
+            # responses raise HTTPExceptions (IncompleteRead, BadStatusLine).
+            return None
+
+    def put(self, key: T.Text, value: bytes) -> None:
+        request = urllib.request.Request(
+            '{}/{}'.format(self.url, key),
+            data=value,
+            method='PUT',
+            headers={'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+
+
+def open_result_store(location: T.Text) -> ResultStore:
+    """A result store for an http(s):// URL, or a local directory."""
+    if location.startswith(('http://', 'https://')):
+        return HTTPStore(location)
+    return DirectoryStore(pathlib.Path(location))
+
+
+class ResultCache:
+    """Content-addressed cache of generated defconfigs.
+
+    Results are keyed by the Kconfig files and scripts of the kernel tree,
+    the environment variables they may read (CC, ...), the arch, the options,
+    and the contents of the ordered fragments: a hit doesn't require parsing
+    the Kconfig tree at all.
+    """
+
+    def __init__(self, store: ResultStore):
+        self.store = store
+        self._trees: T.Dict[T.Text, TreeFingerprint] = {}
+        self._fragments: T.Dict[T.Text, T.Tuple[T.Tuple[int, int], T.Text]] = {}
+
+    def _tree(self, kernel_sources: pathlib.Path) -> TreeFingerprint:
+        key = os.path.realpath(str(kernel_sources))
+        if key not in self._trees:
+            self._trees[key] = tree_fingerprint(kernel_sources)
+        return self._trees[key]
+
+    def _fragment(self, path: pathlib.Path) -> T.Text:
+        stat = os.stat(str(path))
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self._fragments.get(str(path))
+        if cached is None or cached[0] != stamp:
+            cached = self._fragments[str(path)] = (stamp, file_digest(path))
+        return cached[1]
+
+    def key(
+            self,
+            kernel_sources: pathlib.Path,
+            arch: T.Text,
+            sources: T.List[pathlib.Path],
+            fail_on_unknown: bool,
+            artifacts: T.Sequence[T.Text] = ('defconfig',),
+            environ: T.Optional[T.Mapping[T.Text, T.Text]] = None,
+    ) -> T.Text:
+        """Key of a result; environ is the environment the tree is parsed with (default: os.environ)."""
+        environ = os.environ if environ is None else environ
+        tree = self._tree(kernel_sources)
+        return text_digest(
+            str(RESULT_FORMAT),
+            '.'.join(str(part) for part in kconfiglib.VERSION),
+            tree.digest,
+            *('${}={}'.format(name, environ[name]) for name in sorted(tree.variables) if name in environ),
+            arch,
+            str(fail_on_unknown),
+            ','.join(sorted(artifacts)),
+            *(self._fragment(path) for path in sources),
+        )
+
+    def get(self, key: T.Text) -> T.Optional[T.Dict[T.Text, T.Any]]:
+        data = self.store.get(key)
+        if data is None:
+            return None
+        try:
+            value = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(value, dict) or value.get('format') != RESULT_FORMAT:
+            return None
+        return value
+
+    def put(self, key: T.Text, value: T.Mapping[T.Text, T.Any]) -> None:
+        self.store.put(key, json.dumps(dict(value, format=RESULT_FORMAT), sort_keys=True).encode('utf-8'))
@@ -0,0 +1,233 @@
+"""Verify a profiles repository: fragments are minimal, profiles assemble cleanly.
+
+Each profile is merged on a warm tree (see core.defconfig_merge_many()); every
+assignment of its fragments is then classified:
+
+- unknown: the symbol doesn't exist in the kernel tree (for that arch);
+- useful: it is the last assignment to its symbol, and the minimal
+  configuration of the profile holds that exact value;
+- redundant: the symbol already has that value without the assignment;
+- ineffective: the symbol ends up with another value (unmet dependencies,
+  select, another assignment later in the profile).
+
+An assignment is reported if it is unknown in any profile including it, or
+if it isn't useful in any of them.
+"""
+
+import io
+import os
+import pathlib
+import typing as T
+
+import kconfiglib
+
+from . import core
+from .timings import NO_TIMINGS, Timings
+
+
+UNKNOWN = 'unknown'
+REDUNDANT = 'redundant'
+INEFFECTIVE = 'ineffective'
+OVERRIDDEN = 'overridden'
+OUTDATED = 'outdated'
+ERROR = 'error'
+
+
+class CheckIssue(T.NamedTuple):
+    kind: T.Text
+    path: T.Text
+    linenr: T.Optional[int]
+    symbol: T.Optional[T.Text]
+    message: T.Text
+    profiles: T.List[T.Text]
+
+    def as_dict(self) -> T.Dict[T.Text, T.Any]:
+        return self._asdict()
+
+    def __str__(self) -> str:
+        location = self.path if self.linenr is None else '{}:{}'.format(self.path, self.linenr)
+        return '{}: {}: {} [{}]'.format(location, self.kind, self.message, ', '.join(self.profiles))
+
+
+# (path, linenr) of an assignment
+Line = T.Tuple[T.Text, int]
+
+
+class ProfileCheck(T.NamedTuple):
+    target: T.Text
+    # Classification of each assignment, with the symbol name and a message
+    lines: T.Dict[Line, T.Tuple[T.Text, T.Text, T.Text]]
+    # Issues not tied to a single assignment (errors, outdated outputs)
+    issues: T.List[CheckIssue]
+
+
+def _normalize(sym: kconfiglib.Symbol, value: T.Optional[T.Text]) -> T.Optional[T.Text]:
+    if sym.orig_type in (kconfiglib.BOOL, kconfiglib.TRISTATE):
+        return (value or 'n')[:1]
+    return value
+
+
+def _current_value(kconf: kconfiglib.Kconfig, sym: kconfiglib.Symbol) -> T.Optional[T.Text]:
+    if sym.orig_type in (kconfiglib.BOOL, kconfiglib.TRISTATE):
+        return sym.str_value
+    assignments = core.parse_config([sym.config_string], prefix=kconf.config_prefix).assignments
+    if not assignments:
+        return None
+    return _normalize(sym, assignments[0][1])
+
+
+def _classify(
+        kconf: kconfiglib.Kconfig,
+        target: T.Text,
+        profile: core.Profile,
+        fragments: core.FragmentCache,
+        output: T.Text,
+        outputs: T.Mapping[T.Text, pathlib.Path],
+) -> ProfileCheck:
+    minimal = {
+        name: value
+        for name, value, _linenr in core.parse_config(io.StringIO(output), prefix=kconf.config_prefix).assignments
+    }
+    last: T.Dict[T.Text, Line] = {}
+    assignments = []
+    for path in profile.files:
+        for name, value, linenr in fragments.get(path, prefix=kconf.config_prefix).assignments:
+            line = (str(path), linenr)
+            assignments.append((line, name, value))
+            last[name] = line
+
+    lines = {}
+    for line, name, value in assignments:
+        sym = kconf.syms.get(name)
+        if sym is None or not sym.nodes:
+            lines[line] = (UNKNOWN, name, "unknown symbol {}".format(name))
+        elif last[name] != line:
+            lines[line] = (OVERRIDDEN, name, "{} is assigned again at {}:{}".format(name, *last[name]))
+        elif name in minimal and _normalize(sym, minimal[name]) == _normalize(sym, value):
+            lines[line] = ('', name, '')
+        elif _current_value(kconf, sym) == _normalize(sym, value):
+            lines[line] = (REDUNDANT, name, "{} already defaults to {}".format(name, value or 'n'))
+        else:
+            lines[line] = (INEFFECTIVE, name, "{} is {}, not {}".format(
+                name, sym.str_value or '""', value or 'n',
+            ))
+
+    issues = []
+    if target in outputs:
+        committed = outputs[target]
+        try:
+            with committed.open('r', encoding='utf-8') as f:
+                current = f.read() == output
+        except OSError:
+            current = False
+        if not current:
+            issues.append(CheckIssue(
+                kind=OUTDATED, path=str(committed), linenr=None, symbol=None,
+                message="doesn't match the assembled profile", profiles=[target],
+            ))
+    return ProfileCheck(target=target, lines=lines, issues=issues)
+
+
+def _check_group(
+        pool: core.KconfPool,
+        group: core.TreeGroup,
+        outputs: T.Mapping[T.Text, pathlib.Path],
+        timings: Timings = NO_TIMINGS,
+) -> T.List[ProfileCheck]:
+    profiles = group.items
+    by_target = dict(profiles)
+    try:
+        kconf = pool.get(group.kernel_sources, group.arch, timings=timings)
+        # Unknown symbols and ineffective assignments are reported below.
+        warn, kconf.warn = kconf.warn, False
+        try:
+            results = []
+            for target, result in core.defconfig_merge_many(
+                    kconf=kconf,
+                    sources={target: profile.files for target, profile in profiles},
+                    fail_on_unknown=False,
+                    fragments=pool.fragments,
+            ):
+                # The tree still holds the state of that profile.
+                results.append(_classify(kconf, target, by_target[target], pool.fragments, result.output, outputs))
+        finally:
+            kconf.warn = warn
+        return results
+    except (OSError, kconfiglib.KconfigError) as e:
+        # Most likely a missing fragment: find out which profiles are affected.
+        if len(profiles) > 1:
+            return [
+                check
+                for item in profiles
+                for check in _check_group(pool, group._replace(items=[item]), outputs, timings)
+            ]
+        target = profiles[0][0]
+        return [ProfileCheck(target=target, lines={}, issues=[CheckIssue(
+            kind=ERROR, path=getattr(e, 'filename', None) or target, linenr=None, symbol=None,
+            message=getattr(e, 'strerror', None) or str(e), profiles=[target],
+        )])]
+
+
+def _summarize(checks: T.Iterable[ProfileCheck]) -> T.List[CheckIssue]:
+    issues = []
+    classified: T.Dict[Line, T.Dict[T.Text, T.List[T.Tuple[T.Text, T.Text, T.Text]]]] = {}
+    for check in checks:
+        issues.extend(check.issues)
+        for line, (kind, symbol, message) in check.lines.items():
+            classified.setdefault(line, {}).setdefault(kind, []).append((check.target, symbol, message))
+
+    for (path, linenr), kinds in sorted(classified.items()):
+        if UNKNOWN in kinds:
+            kind = UNKNOWN
+        elif '' in kinds:
+            # Useful for some profile
+            continue
+        else:
+            kind = max(kinds, key=lambda kind: len(kinds[kind]))
+        profiles = sorted(target for entries in kinds.values() for target, _symbol, _message in entries)
+        _target, symbol, message = kinds[kind][0]
+        issues.append(CheckIssue(
+            kind=kind, path=path, linenr=linenr, symbol=symbol, message=message, profiles=profiles,
+        ))
+    return sorted(issues, key=lambda issue: (issue.path, issue.linenr or 0, issue.profiles))
+
+
+def check_profiles(
+        config: core.Configuration,
+        targets: T.List[T.Text],
+        root: pathlib.Path,
+        kernel_sources: pathlib.Path,
+        pool: T.Optional[core.KconfPool] = None,
+        jobs: int = 1,
+        outputs: T.Optional[T.Mapping[T.Text, pathlib.Path]] = None,
+) -> T.List[CheckIssue]:
+    """Check that profiles assemble cleanly, from minimal fragments.
+
+    With outputs (profile name => path), also check that committed defconfig
+    files match the assembled profiles.
+    """
+    outputs = outputs or {}
+
+    profiles = [
+        (target, core.defconfig_for_target(config=config, target=target, root=root, extra_include=[]))
+        for target in targets
+    ]
+    checks = core.map_groups(
+        _check_group,
+        core.group_profiles(profiles, kernel_sources),
+        args=(outputs,),
+        pool=pool,
+        jobs=jobs,
+    )
+    return _summarize(checks)
+
+
+def relative_issue(issue: CheckIssue, base: pathlib.Path) -> CheckIssue:
+    """Issue with its path relative to base, when below it."""
+    try:
+        path = os.path.relpath(issue.path, str(base))
+    except ValueError:
+        return issue
+    if path.startswith(os.pardir):
+        return issue
+    return issue._replace(path=path)
@@ -1,29 +1,259 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
 import enum
+import json
+import os
 import pathlib
 import sys
+import time
+import typing as T
 
-import toml
+from . import __version__
+from .timings import NO_TIMINGS, Timings, max_rss
 
-from . import (
-    PROFILES_FILENAME,
-    __version__,
-    defconfig_for_target,
-    defconfig_merge,
-    defconfig_split,
-    load_configuration,
-    load_kconf,
-)
+# kconfiglib (through .core) and toml take most of the startup time: modules
+# using them are only imported by the commands needing them, not for
+# 'kconfgen help' or 'kconfgen version'.
+if T.TYPE_CHECKING:
+    from .cache import ResultCache
+    from .core import Configuration, GenerationResult, ProfileResult
+
+
+DEFAULT_OUTPUT_TEMPLATE = '{profile}_defconfig'
+
+# Files which may be generated along with the defconfig: option => artifact (see core.ARTIFACTS)
+EXTRA_ARTIFACTS = [
+    ('full_config', 'config'),
+    ('autoconf', 'autoconf'),
+    ('symbols_json', 'json'),
+]
 
 
 class Mode(enum.Enum):
     ASSEMBLE = 'assemble'
+    CHECK = 'check'
     HELP = 'help'
+    MATRIX = 'matrix'
     MERGE = 'merge'
+    QUERY = 'query'
+    SERVE = 'serve'
     SPLIT = 'split'
+    VALIDATE = 'validate'
     VERSION = 'version'
+    WATCH = 'watch'
+
+
+def _write_timings(timings: Timings, destination: T.Text) -> None:
+    contents = json.dumps(timings.as_dict(), indent=2, sort_keys=True) + '\n'
+    if destination == '-':
+        sys.stderr.write(contents)
+    else:
+        with open(destination, 'w', encoding='utf-8') as f:
+            f.write(contents)
+
+
+def _result_cache(args: argparse.Namespace) -> T.Optional['ResultCache']:
+    from .cache import ResultCache, open_result_store
+
+    if args.result_cache is None:
+        return None
+    return ResultCache(open_result_store(args.result_cache))
+
+
+def _artifacts(args: argparse.Namespace) -> T.List[T.Text]:
+    """Names of the artifacts requested on the command line."""
+    names = [] if args.no_defconfig else ['defconfig']
+    return names + [name for option, name in EXTRA_ARTIFACTS if getattr(args, option) is not None]
+
+
+def _artifact_paths(args: argparse.Namespace, defconfig: T.Text, **fields: T.Text) -> T.Dict[T.Text, T.Text]:
+    """Paths of the requested artifacts, by name.
+
+    Paths of extra artifacts are formatted with `fields`, and relative to
+    --output-dir if set.
+    """
+    paths = {} if args.no_defconfig else {'defconfig': defconfig}
+    for option, name in EXTRA_ARTIFACTS:
+        template = getattr(args, option)
+        if template is None:
+            continue
+        path = template.format(**fields) if fields else template
+        if getattr(args, 'output_dir', None) is not None:
+            path = str(args.output_dir / path)
+        paths[name] = path
+    return paths
+
+
+def _write_artifacts(
+        paths: T.Mapping[T.Text, T.Text],
+        result: 'GenerationResult',
+        if_changed: bool = False,
+) -> None:
+    from .cache import write_if_changed
+
+    for name, path in paths.items():
+        contents = result.output if name == 'defconfig' else result.artifacts[name]
+        if path == '-':
+            sys.stdout.write(contents)
+        elif if_changed:
+            write_if_changed(pathlib.Path(path), contents)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(contents)
+
+
+def _call_server(socket_path: pathlib.Path, command: T.Text, **arguments: T.Any) -> T.Dict[T.Text, T.Any]:
+    from . import server
+
+    try:
+        return server.call(socket_path, command, **arguments)
+    except (OSError, server.ServerError) as e:
+        sys.exit("Error from server {}: {}".format(socket_path, e))
+
+
+def _assemble_remote(args: argparse.Namespace, targets: T.Iterable[T.Text]) -> T.Iterator['ProfileResult']:
+    from .core import GenerationResult, Profile, ProfileResult, Stats
+
+    for target in targets:
+        start = time.monotonic()
+        response = _call_server(
+            args.server, 'assemble',
+            root=str(args.root.absolute()),
+            profile=target,
+            include=args.include,
+            kernel_source=os.path.abspath(args.kernel_source),
+            fail_on_unknown=args.fail_on_unknown,
+            artifacts=_artifacts(args),
+        )
+        yield ProfileResult(
+            target=target,
+            profile=Profile(arch=response['arch'], files=[]),
+            result=GenerationResult(
+                stats=Stats(nb_symbols=response['nb_symbols'], files=[]),
+                output=response['output'],
+                artifacts=response['artifacts'],
+            ),
+            worker=os.getpid(),
+            duration=time.monotonic() - start,
+            kconfig_files=response['kconfig_files'],
+        )
+
+
+def _resolve_kernel_sources(args: argparse.Namespace, timings: Timings) -> T.Dict[T.Text, T.Text]:
+    """Replace archive and git specs in args.kernel_source by extracted trees; returns the original specs."""
+    import tarfile
+
+    from . import sources
+    from .git import GitError
+
+    specs = args.kernel_source if isinstance(args.kernel_source, list) else [args.kernel_source]
+    labels = {}
+    resolved = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            resolved.append(pathlib.Path(spec))
+            continue
+        try:
+            with timings.phase('kernel_source'):
+                path = sources.resolve_kernel_source(spec, cache_dir=getattr(args, 'cache_dir', None))
+        except (OSError, ValueError, tarfile.TarError, GitError) as e:
+            sys.exit("Error: unable to read kernel sources from {}: {}".format(spec, e))
+        labels[str(path)] = str(spec)
+        resolved.append(path)
+    if isinstance(args.kernel_source, list):
+        args.kernel_source = resolved
+    else:
+        args.kernel_source = str(resolved[0])
+    return labels
+
+
+def _assemble_revisions(args: argparse.Namespace, timings: Timings) -> None:
+    """Assemble profiles at git revisions of the profiles repository, on shared Kconfig trees."""
+    from . import revision
+    from .core import PROFILES_FILENAME, KconfPool, assemble_profiles
+    from .git import GitError, GitRepository
+
+    pool = KconfPool(cache_dir=args.cache_dir)
+    repository = GitRepository(args.root)
+    try:
+        for rev in args.revision:
+            with timings.phase('load_configuration'):
+                try:
+                    config, fragments = revision.load_revision(
+                        args.root, rev, repository=repository, cache_dir=args.cache_dir,
+                    )
+                except (OSError, GitError) as e:
+                    sys.exit("Error: unable to read {} at {}: {}".format(PROFILES_FILENAME, rev, e))
+            targets = sorted(config.profiles) if args.all else args.profile
+            if args.shard is not None:
+                targets = _shard_targets(args, config, targets)
+
+            results = assemble_profiles(
+                config=config,
+                targets=targets,
+                root=args.root,
+                kernel_sources=pathlib.Path(args.kernel_source),
+                fail_on_unknown=args.fail_on_unknown,
+                extra_include=args.include,
+                pool=pool,
+                jobs=args.jobs or os.cpu_count() or 1,
+                timings=timings,
+                fragments=fragments,
+                artifacts=_artifacts(args),
+            )
+            for item in results:
+                fields = dict(profile=item.target, arch=item.profile.arch, revision=rev)
+                if args.output_dir is None:
+                    output = args.output
+                else:
+                    output = str(args.output_dir / args.output_template.format(**fields))
+                with timings.phase('write_output'):
+                    _write_artifacts(_artifact_paths(args, output, **fields), item.result)
+                sys.stderr.write(">>> Written {ns} symbols for {t} at {r}.\n".format(
+                    ns=item.result.stats.nb_symbols,
+                    t=item.target,
+                    r=rev,
+                ))
+    finally:
+        repository.close()
+
+
+def _load_profiles(
+        args: argparse.Namespace,
+        targets: T.Optional[T.List[T.Text]] = None,
+) -> 'Configuration':
+    """Load profiles (only targets and the groups they reach, with profiles.d), exiting on errors."""
+    from .core import InvalidConfiguration, load_profiles
+
+    try:
+        return load_profiles(
+            args.root,
+            cache_dir=args.cache_dir,
+            targets=targets,
+            extra_include=getattr(args, 'include', None),
+        )
+    except InvalidConfiguration as e:
+        sys.exit("Error: invalid profiles configuration:\n{}".format(
+            '\n'.join('  - {}'.format(error) for error in e.args[0]),
+        ))
+
+
+def _shard_targets(args: argparse.Namespace, config: 'Configuration', targets: T.List[T.Text]) -> T.List[T.Text]:
+    from . import shard
+
+    selected = shard.shard_targets(
+        config=config,
+        targets=targets,
+        root=args.root,
+        extra_include=getattr(args, 'include', []),
+        shard=args.shard,
+        costs=shard.load_costs(args.shard_timings),
+    )
+    sys.stderr.write(">>> Shard {s}: {n} of {t} profiles.\n".format(s=args.shard, n=len(selected), t=len(targets)))
+    return selected
 
 
 def main() -> None:
@@ -65,7 +295,37 @@ def main() -> None:
         default=[], help="Extra sections to include",
     )
     assemble_parser.add_argument(
-        'profile', help="Assemble a defconfig file for PROFILE",
+        '--all', '-a', action='store_true', default=False,
+        help="Assemble all profiles",
+    )
+    assemble_parser.add_argument(
+        '--output-dir', type=pathlib.Path, default=None,
+        help="Directory where generated defconfig files should be written, when assembling several profiles",
+    )
+    assemble_parser.add_argument(
+        '--output-template', type=str, default=DEFAULT_OUTPUT_TEMPLATE,
+        help="Name of generated files within --output-dir; may use {profile} and {arch}",
+    )
+    assemble_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="Number of profiles to assemble in parallel; 0 for one per CPU",
+    )
+    assemble_parser.add_argument(
+        '--depfile', type=pathlib.Path, default=None,
+        help="Write a Makefile-style list of the files the generated defconfigs depend on",
+    )
+    assemble_parser.add_argument(
+        '--if-changed', action='store_true', default=False,
+        help="Only regenerate outputs whose inputs changed since --depfile was written; "
+        "leave outputs untouched when their content is unchanged",
+    )
+    assemble_parser.add_argument(
+        '--revision', type=str, action='append', default=[], metavar='REV',
+        help="Read profiles and fragments from the git revision REV of the repository; may be repeated, "
+        "--output-template should then use {revision}",
+    )
+    assemble_parser.add_argument(
+        'profile', nargs='*', help="Assemble a defconfig file for PROFILE",
     )
 
     merge_parser = subparsers.add_parser('merge', help="Merge deconfig files")
@@ -90,10 +350,10 @@ def main() -> None:
     split_parser.set_defaults(mode=Mode.SPLIT)
     split_parser.add_argument(
         '--categories', '-c', type=argparse.FileType('r', encoding='utf-8'), required=True,
-        help="File containing categories, one per line.",
+        help="File containing categories, one per line: path prefixes, globs, or symbol:GLOB; optionally NAME=RULE",
     )
     split_parser.add_argument(
-        '--destdir', '-d', type=str, required=True,
+        '--destdir', '-d', type=str, default=None,
         help="Directory where generated files should be written",
     )
     split_parser.add_argument(
@@ -101,66 +361,475 @@ def main() -> None:
         help="Prefix for generated files",
     )
     split_parser.add_argument(
-        'source', type=argparse.FileType('r', encoding='utf-8'),
+        'source', type=argparse.FileType('r', encoding='utf-8'), nargs='?', default=None,
         help="Source file to read",
     )
     split_parser.add_argument(
-        '--arch', type=str, required=True,
+        '--arch', type=str, default=None,
         help="Target architecture",
     )
+    split_parser.add_argument(
+        '--batch', type=argparse.FileType('r', encoding='utf-8'), default=None, metavar='FILE',
+        help="Split many sources: one 'SOURCE ARCH DESTDIR [PREFIX]' per line of FILE, "
+        "instead of SOURCE, --arch and --destdir",
+    )
+    split_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="With --batch, number of sources to split in parallel; 0 for one per CPU",
+    )
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help="Serve assemble/merge/split requests, keeping Kconfig trees in memory",
+    )
+    serve_parser.set_defaults(mode=Mode.SERVE)
+    serve_parser.add_argument(
+        '--socket', '-s', type=pathlib.Path, required=True,
+        help="Path of the Unix socket to listen on",
+    )
+    serve_parser.add_argument(
+        '--max-trees', type=int, default=None,
+        help="Maximum number of Kconfig trees kept in memory",
+    )
+    serve_parser.add_argument(
+        '--max-memory', type=int, default=None,
+        help="Drop Kconfig trees while the resident memory of the server exceeds this, in MiB",
+    )
+
+    check_parser = subparsers.add_parser(
+        'check',
+        help="Check that fragments are minimal, and that all profiles assemble cleanly",
+    )
+    check_parser.set_defaults(mode=Mode.CHECK)
+    check_parser.add_argument(
+        '--root', '-r', type=pathlib.Path,
+        default='.', help="Profiles repository root",
+    )
+    check_parser.add_argument(
+        '--kernel-source', '-k', type=str, required=True,
+        help="Kernel source tree: a directory, a .tar.* archive, or REV:PATH for a git revision",
+    )
+    check_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="Number of profiles to check in parallel; 0 for one per CPU",
+    )
+    check_parser.add_argument(
+        '--format', choices=['text', 'json'], default='text',
+        help="Format of the list of issues",
+    )
+    check_parser.add_argument(
+        '--output-dir', type=pathlib.Path, default=None,
+        help="Also check that the defconfig files committed in this directory are up to date",
+    )
+    check_parser.add_argument(
+        '--output-template', type=str, default=DEFAULT_OUTPUT_TEMPLATE,
+        help="Name of committed files within --output-dir; may use {profile} and {arch}",
+    )
+    check_parser.add_argument(
+        'profile', nargs='*', help="Check only these profiles (default: all)",
+    )
+
+    matrix_parser = subparsers.add_parser(
+        'matrix',
+        help="Assemble profiles against several kernel trees, and report symbol differences",
+    )
+    matrix_parser.set_defaults(mode=Mode.MATRIX)
+    matrix_parser.add_argument(
+        '--root', '-r', type=pathlib.Path,
+        default='.', help="Profiles repository root",
+    )
+    matrix_parser.add_argument(
+        '--kernel-source', '-k', type=str, action='append', required=True,
+        help="Kernel source tree (directory, .tar.* archive or REV:PATH); "
+        "repeat for each tree, the first one is the reference",
+    )
+    matrix_parser.add_argument(
+        '--fail-on-unknown', action='store_true', default=False,
+        help="Don't allow symbols unknown from the target kernels.",
+    )
+    matrix_parser.add_argument(
+        '--include', '-i', type=str, nargs='*',
+        default=[], help="Extra sections to include",
+    )
+    matrix_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="Number of worker processes; 0 for one per CPU",
+    )
+    matrix_parser.add_argument(
+        '--format', choices=['text', 'json'], default='text',
+        help="Format of the report",
+    )
+    matrix_parser.add_argument(
+        'profile', nargs='*', help="Compare only these profiles (default: all)",
+    )
+
+    query_parser = subparsers.add_parser(
+        'query',
+        help="Print the value of some symbols in each profile",
+    )
+    query_parser.set_defaults(mode=Mode.QUERY)
+    query_parser.add_argument(
+        '--root', '-r', type=pathlib.Path,
+        default='.', help="Profiles repository root",
+    )
+    query_parser.add_argument(
+        '--kernel-source', '-k', type=str, required=True,
+        help="Kernel source tree: a directory, a .tar.* archive, or REV:PATH for a git revision",
+    )
+    query_parser.add_argument(
+        '--fail-on-unknown', action='store_true', default=False,
+        help="Don't allow symbols unknown from the target kernel.",
+    )
+    query_parser.add_argument(
+        '--include', '-i', type=str, nargs='*',
+        default=[], help="Extra sections to include",
+    )
+    query_parser.add_argument(
+        '--profile', '-p', type=str, action='append', default=[], metavar='GLOB',
+        help="Only query profiles whose name matches GLOB; may be repeated (default: all profiles)",
+    )
+    query_parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help="Number of worker processes; 0 for one per CPU",
+    )
+    query_parser.add_argument(
+        '--format', choices=['text', 'json'], default='text',
+        help="Format of the profile × symbol matrix",
+    )
+    query_parser.add_argument(
+        'symbol', nargs='+', help="Symbols to print, with or without the CONFIG_ prefix",
+    )
+
+    validate_parser = subparsers.add_parser(
+        'validate',
+        help="Load and validate all profiles and include groups, without a kernel tree",
+    )
+    validate_parser.set_defaults(mode=Mode.VALIDATE)
+    validate_parser.add_argument(
+        '--root', '-r', type=pathlib.Path,
+        default='.', help="Profiles repository root",
+    )
+
+    watch_parser = subparsers.add_parser(
+        'watch',
+        help="Regenerate defconfig files whenever their fragments change",
+    )
+    watch_parser.set_defaults(mode=Mode.WATCH)
+    watch_parser.add_argument(
+        '--root', '-r', type=pathlib.Path,
+        default='.', help="Profiles repository root",
+    )
+    watch_parser.add_argument(
+        '--kernel-source', '-k', type=str, required=True,
+        help="Kernel source tree: a directory, a .tar.* archive, or REV:PATH for a git revision",
+    )
+    watch_parser.add_argument(
+        '--fail-on-unknown', action='store_true', default=False,
+        help="Don't allow symbols unknown from the target kernel.",
+    )
+    watch_parser.add_argument(
+        '--include', '-i', type=str, nargs='*',
+        default=[], help="Extra sections to include",
+    )
+    watch_parser.add_argument(
+        '--output-dir', type=pathlib.Path, required=True,
+        help="Directory where generated defconfig files should be written",
+    )
+    watch_parser.add_argument(
+        '--output-template', type=str, default=DEFAULT_OUTPUT_TEMPLATE,
+        help="Name of generated files within --output-dir; may use {profile} and {arch}",
+    )
+    watch_parser.add_argument(
+        '--poll', type=float, default=None, metavar='SECONDS',
+        help="Check files for changes every SECONDS, instead of using inotify",
+    )
+    watch_parser.add_argument(
+        'profile', nargs='*', help="Watch only these profiles (default: all)",
+    )
 
     # Common options
     for subparser in [assemble_parser, merge_parser, split_parser]:
         subparser.add_argument(
             '--kernel-source', '-k', type=str, required=True,
-            help="Path to the kernel source tree",
+            help="Kernel source tree: a directory, a .tar.* archive, or REV:PATH for a git revision",
         )
         subparser.add_argument(
             '--fail-on-unknown', action='store_true', default=False,
             help="Don't allow symbols unknown from the target kernel.",
         )
+        subparser.add_argument(
+            '--server', type=pathlib.Path, default=None,
+            help="Send the request to the 'kconfgen serve' instance listening on this socket",
+        )
+        subparser.add_argument(
+            '--timings', type=str, nargs='?', const='-', default=None, metavar='FILE',
+            help="Write the time and peak memory used by each phase of the run, as JSON, to FILE (default: stderr)",
+        )
+        subparser.add_argument(
+            '--profile-out', type=pathlib.Path, default=None, metavar='FILE',
+            help="Profile the run with cProfile, and write pstats data to FILE",
+        )
+
+    for subparser in [assemble_parser, check_parser]:
+        subparser.add_argument(
+            '--shard', type=str, default=None, metavar='I/N',
+            help="Only handle the I-th of N deterministic parts of the profiles (1 <= I <= N)",
+        )
+        subparser.add_argument(
+            '--shard-timings', type=pathlib.Path, action='append', default=[], metavar='FILE',
+            help="Balance shards by the profile durations recorded by --timings in FILE; may be repeated",
+        )
+
+    for subparser in [assemble_parser, merge_parser]:
+        subparser.add_argument(
+            '--full-config', type=str, default=None, metavar='PATH',
+            help="Also write the full .config to PATH",
+        )
+        subparser.add_argument(
+            '--autoconf', type=str, default=None, metavar='PATH',
+            help="Also write the C header (include/generated/autoconf.h) to PATH",
+        )
+        subparser.add_argument(
+            '--symbols-json', type=str, default=None, metavar='PATH',
+            help="Also write the values of all symbols set in the full .config, as JSON, to PATH",
+        )
+        subparser.add_argument(
+            '--no-defconfig', action='store_true', default=False,
+            help="Don't compute the minimal defconfig; only write --full-config, --autoconf or --symbols-json",
+        )
+        subparser.add_argument(
+            '--result-cache', type=str, default=None, metavar='DIR_OR_URL',
+            help="Cache generated defconfigs by content, in a directory or on an HTTP server (GET/PUT)",
+        )
+
+    for subparser in [
+            assemble_parser, merge_parser, split_parser, serve_parser, check_parser, matrix_parser, query_parser,
+            validate_parser, watch_parser,
+    ]:
+        subparser.add_argument(
+            '--cache-dir', type=pathlib.Path, default=None,
+            help="Directory where parsed Kconfig trees are cached across runs",
+        )
 
     # }}}
 
     args = parser.parse_args()
 
+    if args.mode == Mode.VERSION:
+        sys.stdout.write("kconfgen v{}".format(__version__))
+        return
+
+    elif args.mode == Mode.HELP:
+        parser.print_help()
+        for subparser in [
+                assemble_parser, merge_parser, split_parser, check_parser, matrix_parser, query_parser,
+                validate_parser, watch_parser, serve_parser,
+        ]:
+            sys.stdout.write('\n\n')
+            sys.stdout.write('{}\n'.format(subparser.prog))
+            sys.stdout.write('{}\n'.format('-' * len(subparser.prog)))
+            subparser.print_help()
+        return
+
+    elif args.mode is None:
+        parser.print_help()
+        return
+
+    from . import check, depfile, matrix, query, server, shard, watch
+    from .cache import text_digest
+    from .core import (
+        CategoryIndex,
+        GenerationResult,
+        KconfPool,
+        ProfileResult,
+        Stats,
+        assemble_profiles,
+        defconfig_for_target,
+        defconfig_merge,
+        defconfig_split,
+        defconfig_split_many,
+        load_kconf,
+        parse_split_jobs,
+        profile_sources,
+        profiles_index,
+    )
+
+    if args.mode in (Mode.ASSEMBLE, Mode.MERGE):
+        if args.no_defconfig and _artifacts(args) == []:
+            parser.error("--no-defconfig requires --full-config, --autoconf or --symbols-json")
+
+    if args.mode == Mode.ASSEMBLE:
+        extra_templates = [getattr(args, option) for option, _name in EXTRA_ARTIFACTS if getattr(args, option)]
+        if args.all and args.profile:
+            parser.error("Can't use --all with explicit profiles")
+        elif not args.all and not args.profile:
+            parser.error("Missing profile name")
+        elif (args.all or len(args.profile) > 1 or len(args.revision) > 1) and args.output_dir is None:
+            parser.error("--output-dir is required when assembling several profiles")
+        elif (args.all or len(args.profile) > 1) and any('{profile}' not in path for path in extra_templates):
+            parser.error("--full-config, --autoconf and --symbols-json must use {profile} with several profiles")
+        elif len(args.revision) > 1 and '{revision}' not in args.output_template:
+            parser.error("--output-template must use {revision} when assembling several revisions")
+        elif len(args.revision) > 1 and any('{revision}' not in path for path in extra_templates):
+            parser.error("--full-config, --autoconf and --symbols-json must use {revision} with several revisions")
+        elif args.revision and (args.depfile or args.result_cache or args.server):
+            parser.error("--revision can't be used with --depfile, --result-cache or --server")
+        elif args.depfile is not None and args.output_dir is None and '-' in [args.output] + extra_templates:
+            parser.error("--depfile requires writing to a file")
+        elif args.if_changed and args.depfile is None:
+            parser.error("--if-changed requires --depfile")
+
+    if args.mode == Mode.SPLIT:
+        if args.batch is not None:
+            if args.source is not None or args.arch is not None or args.destdir is not None:
+                parser.error("Can't use --batch with SOURCE, --arch or --destdir")
+            elif args.server is not None:
+                parser.error("Can't use --batch with --server")
+        elif args.source is None or args.arch is None or args.destdir is None:
+            parser.error("SOURCE, --arch and --destdir are required without --batch")
+
+    if args.mode in (Mode.ASSEMBLE, Mode.CHECK) and args.shard is not None:
+        try:
+            args.shard = shard.parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
     # {{{ Launchers
 
+    timings = Timings() if getattr(args, 'timings', None) is not None else NO_TIMINGS
+    profiler = None
+    if getattr(args, 'profile_out', None) is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    start_time_ns = int(time.time() * 1e9)
+
+    kernel_labels: T.Dict[T.Text, T.Text] = {}
+    if getattr(args, 'kernel_source', None) is not None:
+        kernel_labels = _resolve_kernel_sources(args, timings)
+
     if args.mode == Mode.MERGE:
-        kconf = load_kconf(
-            kernel_sources=pathlib.Path(args.kernel_source),
-            arch=args.arch,
-        )
-        result = defconfig_merge(
-            kconf=kconf,
-            fail_on_unknown=args.fail_on_unknown,
-            sources=args.sources,
-        )
-        if args.output == '-':
-            sys.stdout.write(result.output)
+        if args.server is not None:
+            response = _call_server(
+                args.server, 'merge',
+                kernel_source=os.path.abspath(args.kernel_source),
+                arch=args.arch,
+                sources=[str(path.absolute()) for path in args.sources],
+                fail_on_unknown=args.fail_on_unknown,
+                artifacts=_artifacts(args),
+            )
+            result = GenerationResult(
+                stats=Stats(nb_symbols=response['nb_symbols'], files=[]),
+                output=response['output'],
+                artifacts=response['artifacts'],
+            )
         else:
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write(result.output)
+            result_cache = _result_cache(args)
+            cached = None
+            if result_cache is not None:
+                with timings.phase('result_cache'):
+                    key = result_cache.key(
+                        pathlib.Path(args.kernel_source), args.arch, args.sources, args.fail_on_unknown,
+                        _artifacts(args),
+                    )
+                    cached = result_cache.get(key)
+
+            if cached is not None:
+                result = GenerationResult(
+                    stats=Stats(nb_symbols=cached['nb_symbols'], files=args.sources),
+                    output=cached['output'],
+                    artifacts=cached['artifacts'],
+                )
+            else:
+                kconf = load_kconf(
+                    kernel_sources=pathlib.Path(args.kernel_source),
+                    arch=args.arch,
+                    cache_dir=args.cache_dir,
+                    timings=timings,
+                )
+                result = defconfig_merge(
+                    kconf=kconf,
+                    fail_on_unknown=args.fail_on_unknown,
+                    sources=args.sources,
+                    timings=timings,
+                    artifacts=_artifacts(args),
+                )
+                if result_cache is not None:
+                    result_cache.put(key, {
+                        'output': result.output,
+                        'artifacts': result.artifacts,
+                        'nb_symbols': result.stats.nb_symbols,
+                        'kconfig_filenames': kconf.kconfig_filenames,
+                    })
+        with timings.phase('write_output'):
+            _write_artifacts(_artifact_paths(args, args.output), result)
         sys.stderr.write(">>> Written {ns} symbols.\n".format(
             ns=result.stats.nb_symbols,
         ))
 
-    elif args.mode == Mode.SPLIT:
-        kconf = load_kconf(
-            kernel_sources=pathlib.Path(args.kernel_source),
-            arch=args.arch,
-        )
+    elif args.mode == Mode.SPLIT and args.batch is not None:
         try:
-            categories = [line.strip() for line in args.categories]
-
-            stats = defconfig_split(
-                kconf=kconf,
+            try:
+                split_jobs = parse_split_jobs(args.batch, prefix=args.prefix)
+            except ValueError as e:
+                sys.exit("Error: invalid --batch file {}: {}".format(args.batch.name, e))
+            splits = defconfig_split_many(
+                sources=split_jobs,
+                kernel_sources=pathlib.Path(args.kernel_source),
+                categories=list(args.categories),
                 fail_on_unknown=args.fail_on_unknown,
-                categories=categories,
-                destdir=pathlib.Path(args.destdir),
-                source=args.source,
-                prefix=args.prefix,
+                pool=KconfPool(cache_dir=args.cache_dir),
+                jobs=args.jobs or os.cpu_count() or 1,
+                timings=timings,
             )
+            for job, stats in splits:
+                sys.stderr.write(">>> Written {ns} symbols from {s} to {n} files in {d} ({u} unchanged).\n".format(
+                    ns=stats.nb_symbols,
+                    s=job.source,
+                    n=len(stats.files),
+                    d=job.destdir,
+                    u=len(stats.unchanged),
+                ))
+        finally:
+            args.categories.close()
+            args.batch.close()
+
+    elif args.mode == Mode.SPLIT:
+        try:
+            if args.server is not None:
+                response = _call_server(
+                    args.server, 'split',
+                    kernel_source=os.path.abspath(args.kernel_source),
+                    arch=args.arch,
+                    categories=list(args.categories),
+                    destdir=os.path.abspath(args.destdir),
+                    source=args.source.read(),
+                    prefix=args.prefix,
+                    fail_on_unknown=args.fail_on_unknown,
+                )
+                stats = Stats(
+                    nb_symbols=response['nb_symbols'],
+                    files=[pathlib.Path(path) for path in response['files']],
+                )
+            else:
+                kconf = load_kconf(
+                    kernel_sources=pathlib.Path(args.kernel_source),
+                    arch=args.arch,
+                    cache_dir=args.cache_dir,
+                    timings=timings,
+                )
+                categories = CategoryIndex(args.categories)
+
+                stats = defconfig_split(
+                    kconf=kconf,
+                    fail_on_unknown=args.fail_on_unknown,
+                    categories=categories,
+                    destdir=pathlib.Path(args.destdir),
+                    source=args.source,
+                    prefix=args.prefix,
+                    timings=timings,
+                )
             sys.stderr.write(">>> Written {ns} symbols to files {files}.\n".format(
                 ns=stats.nb_symbols,
                 files=', '.join(str(path) for path in stats.files),
@@ -169,48 +838,273 @@ def main() -> None:
             args.categories.close()
             args.source.close()
 
+    elif args.mode == Mode.ASSEMBLE and args.revision:
+        _assemble_revisions(args, timings)
+
     elif args.mode == Mode.ASSEMBLE:
-        profiles = toml.load(args.root / PROFILES_FILENAME)
-        config = load_configuration(profiles)
-        profile = defconfig_for_target(
+        with timings.phase('load_configuration'):
+            config = _load_profiles(args, targets=None if args.all else args.profile)
+        targets = sorted(config.profiles) if args.all else args.profile
+        if args.shard is not None:
+            targets = _shard_targets(args, config, targets)
+
+        # Paths of the generated files of each profile, by artifact
+        outputs: T.Dict[T.Text, T.Dict[T.Text, T.Text]] = {}
+        for target in targets:
+            fields = dict(profile=target, arch=config.profiles[target].arch)
+            if args.output_dir is None:
+                output = args.output
+            else:
+                output = str(args.output_dir / args.output_template.format(**fields))
+            outputs[target] = _artifact_paths(args, output, **fields)
+
+        depfile_key = text_digest(
+            __version__,
+            os.path.abspath(args.kernel_source),
+            str(args.fail_on_unknown),
+            *args.include,
+        )
+        skipped: T.List[T.Text] = []
+        previous: T.Optional[depfile.DepFile] = None
+        if args.if_changed:
+            checker = depfile.Checker(args.depfile, key=depfile_key)
+            previous = checker.depfile
+            skipped = [
+                target for target in targets
+                if all(checker.up_to_date(path) for path in outputs[target].values())
+            ]
+            targets = [target for target in targets if target not in skipped]
+            if skipped:
+                sys.stderr.write(">>> {n} profiles up to date: {t}.\n".format(
+                    n=len(skipped),
+                    t=', '.join(skipped),
+                ))
+
+        index = profiles_index(args.root)
+        results: T.Iterable[ProfileResult]
+        if not targets:
+            results = []
+        elif args.server is not None:
+            results = _assemble_remote(args, targets)
+        else:
+            results = assemble_profiles(
+                config=config,
+                targets=targets,
+                root=args.root,
+                kernel_sources=pathlib.Path(args.kernel_source),
+                fail_on_unknown=args.fail_on_unknown,
+                extra_include=args.include,
+                pool=KconfPool(cache_dir=args.cache_dir),
+                jobs=args.jobs or os.cpu_count() or 1,
+                timings=timings,
+                result_cache=_result_cache(args),
+                artifacts=_artifacts(args),
+            )
+        workers: T.Dict[int, T.List[float]] = collections.defaultdict(list)
+        kconfig_files: T.Dict[T.Text, T.List[T.Text]] = {}
+        rules: T.List[depfile.Rule] = []
+        for item in results:
+            result = item.result
+            workers[item.worker].append(item.duration)
+            with timings.phase('write_output'):
+                _write_artifacts(outputs[item.target], result, if_changed=args.if_changed)
+            sys.stderr.write(">>> Written {ns} symbols for {t}.\n".format(
+                ns=result.stats.nb_symbols,
+                t=item.target,
+            ))
+            kconfig_files.setdefault(item.profile.arch, item.kconfig_files)
+            rules.append((
+                list(outputs[item.target].values()),
+                [str(path) for path in profile_sources(args.root, config, item.target, args.include, index)] + [
+                    str(path)
+                    for path in defconfig_for_target(config, item.target, args.root, args.include).files
+                ],
+            ))
+
+        if len(workers) > 1:
+            for pid, durations in sorted(workers.items()):
+                sys.stderr.write(">>> Worker {pid}: {n} profiles in {s:.2f}s.\n".format(
+                    pid=pid,
+                    n=len(durations),
+                    s=sum(durations),
+                ))
+
+        if args.depfile is not None and targets:
+            # Kconfig files are shared by all profiles of an arch: list them once.
+            for arch, files in sorted(kconfig_files.items()):
+                rules.append((
+                    [
+                        path
+                        for target in targets if config.profiles[target].arch == arch
+                        for path in outputs[target].values()
+                    ],
+                    files,
+                ))
+            if previous is not None:
+                rules.extend(previous.only({path for target in skipped for path in outputs[target].values()}))
+            depfile.write_depfile(args.depfile, depfile.DepFile(key=depfile_key, rules=rules))
+            # Inputs modified while running must trigger a new run.
+            os.utime(str(args.depfile), ns=(start_time_ns, start_time_ns))
+
+    elif args.mode == Mode.CHECK:
+        config = _load_profiles(args)
+        targets = args.profile or sorted(config.profiles)
+        unknown = [target for target in targets if target not in config.profiles]
+        if unknown:
+            sys.exit("Unknown profiles: {}".format(', '.join(unknown)))
+        if args.shard is not None:
+            targets = _shard_targets(args, config, targets)
+
+        committed = {}
+        if args.output_dir is not None:
+            for target in targets:
+                committed[target] = args.output_dir / args.output_template.format(
+                    profile=target,
+                    arch=config.profiles[target].arch,
+                )
+
+        issues = check.check_profiles(
             config=config,
-            target=args.profile,
+            targets=targets,
             root=args.root,
-            extra_include=args.include,
-        )
-        kconf = load_kconf(
             kernel_sources=pathlib.Path(args.kernel_source),
-            arch=profile.arch,
+            pool=KconfPool(cache_dir=args.cache_dir),
+            jobs=args.jobs or os.cpu_count() or 1,
+            outputs=committed,
         )
-        result = defconfig_merge(
-            kconf=kconf,
+        issues = [check.relative_issue(issue, pathlib.Path.cwd()) for issue in issues]
+        if args.format == 'json':
+            json.dump([issue.as_dict() for issue in issues], sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            for issue in issues:
+                sys.stdout.write('{}\n'.format(issue))
+        sys.stderr.write(">>> Checked {n} profiles: {i} issues.\n".format(n=len(targets), i=len(issues)))
+        if issues:
+            sys.exit(1)
+
+    elif args.mode == Mode.MATRIX:
+        if len(args.kernel_source) < 2:
+            parser.error("At least two --kernel-source trees are needed")
+        config = _load_profiles(args)
+        targets = args.profile or sorted(config.profiles)
+
+        try:
+            symbols = matrix.assemble_matrix(
+                config=config,
+                targets=targets,
+                root=args.root,
+                kernel_sources=args.kernel_source,
+                fail_on_unknown=args.fail_on_unknown,
+                extra_include=args.include,
+                pool=KconfPool(cache_dir=args.cache_dir),
+                jobs=args.jobs or os.cpu_count() or 1,
+            )
+        except ValueError as e:
+            sys.exit("Error: {}".format(e))
+        changes = [
+            change._replace(kernel=kernel_labels.get(change.kernel, change.kernel))
+            for change in matrix.compare_matrix(symbols, targets, args.kernel_source)
+        ]
+        if args.format == 'json':
+            json.dump([change.as_dict() for change in changes], sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            for change in changes:
+                sys.stdout.write('{}\n'.format(change))
+        sys.stderr.write(">>> Compared {n} profiles on {k} kernels: {c} changes.\n".format(
+            n=len(targets),
+            k=len(args.kernel_source),
+            c=len(changes),
+        ))
+
+    elif args.mode == Mode.QUERY:
+        config = _load_profiles(args)
+        try:
+            targets = query.select_profiles(config, args.profile)
+        except ValueError as e:
+            sys.exit("Error: {}".format(e))
+
+        values = query.query_profiles(
+            config=config,
+            targets=targets,
+            symbols=args.symbol,
+            root=args.root,
+            kernel_sources=pathlib.Path(args.kernel_source),
             fail_on_unknown=args.fail_on_unknown,
-            sources=profile.files,
+            extra_include=args.include,
+            pool=KconfPool(cache_dir=args.cache_dir),
+            jobs=args.jobs or os.cpu_count() or 1,
         )
-        if args.output == '-':
-            sys.stdout.write(result.output)
+        if args.format == 'json':
+            json.dump({item.target: item.values for item in values}, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
         else:
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write(result.output)
-        sys.stderr.write(">>> Written {ns} symbols for {t}.\n".format(
-            ns=result.stats.nb_symbols,
-            t=args.profile,
+            sys.stdout.write(query.format_table(values, args.symbol))
+
+    elif args.mode == Mode.VALIDATE:
+        # Without targets, every profile and include group is loaded and validated.
+        config = _load_profiles(args)
+        errors = [
+            "Missing fragment {f} for profile {p}".format(f=path, p=target)
+            for target in sorted(config.profiles)
+            for path in defconfig_for_target(config, target, args.root, extra_include=[]).files
+            if not path.exists()
+        ]
+        for error in errors:
+            sys.stdout.write('{}\n'.format(error))
+        sys.stderr.write(">>> Validated {p} profiles and {g} include groups: {e} errors.\n".format(
+            p=len(config.profiles),
+            g=len(config.includes),
+            e=len(errors),
         ))
+        if errors:
+            sys.exit(1)
 
-    elif args.mode == Mode.VERSION:
-        sys.stdout.write("kconfgen v{}".format(__version__))
+    elif args.mode == Mode.WATCH:
+        session = watch.Session(
+            root=args.root,
+            kernel_sources=pathlib.Path(args.kernel_source),
+            output=lambda profile, arch: args.output_dir / args.output_template.format(profile=profile, arch=arch),
+            profiles=args.profile or None,
+            fail_on_unknown=args.fail_on_unknown,
+            extra_include=args.include,
+            pool=KconfPool(cache_dir=args.cache_dir),
+        )
+        watcher = watch.make_watcher(polling=args.poll is not None, interval=args.poll or 0.5)
+        sys.stderr.write(">>> Watching {} ({}).\n".format(args.root, type(watcher).__name__))
+        try:
+            session.run(watcher)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
-    elif args.mode == Mode.HELP:
-        parser.print_help()
-        for subparser in [assemble_parser, merge_parser, split_parser]:
-            sys.stdout.write('\n\n')
-            sys.stdout.write('{}\n'.format(subparser.prog))
-            sys.stdout.write('{}\n'.format('-' * len(subparser.prog)))
-            subparser.print_help()
+    elif args.mode == Mode.SERVE:
+        pool = KconfPool(
+            cache_dir=args.cache_dir,
+            max_trees=args.max_trees,
+            max_memory=args.max_memory * 1024 * 1024 if args.max_memory is not None else None,
+        )
+        sys.stderr.write(">>> Listening on {}.\n".format(args.socket))
+        try:
+            server.serve(args.socket, pool)
+        except server.ServerError as e:
+            sys.exit("Error: {}".format(e))
 
-    else:
-        assert args.mode is None
-        parser.print_help()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(str(args.profile_out))
+
+    if timings.enabled:
+        timings.add_max_rss(max_rss())
+        timings.add_phase(
+            'total',
+            wall=time.perf_counter() - start_wall,
+            cpu=time.process_time() - start_cpu,
+            peak_rss=timings.max_rss,
+        )
+        _write_timings(timings, args.timings)
 
     # }}}
 
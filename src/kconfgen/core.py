@@ -1,12 +1,30 @@
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import gc
+import hashlib
+import io
+import json
 import os
 import pathlib
-import tempfile
+import re
+import shlex
+import threading
+import time
+import types
 import typing as T
+import warnings
 
 import kconfiglib
 
+from .cache import CACHE_FORMAT, KconfCache, PickleStore, ResultCache, gc_paused, text_digest, write_if_changed
+from .timings import NO_TIMINGS, Timings
+
 
 PROFILES_FILENAME = 'profiles.toml'
+# Split layout: one file per profile (profile/NAME.toml) or group (include/NAME.toml)
+PROFILES_DIRNAME = 'profiles.d'
 
 
 class InvalidConfiguration(Exception):
@@ -30,12 +48,57 @@ class CfgProfile(T.NamedTuple):
 
 class CfgInclude(T.NamedTuple):
     files: T.List[T.Text] = []
+    # Nested groups, whose files come before this group's files
+    include: T.List[T.Text] = []
 
 
 class Configuration(T.NamedTuple):
     profiles: T.Dict[T.Text, CfgProfile]
     includes: T.Dict[T.Text, CfgInclude]
     fragments_dir: T.Text = ''
+    # Files of each include group, with nested groups resolved (see resolve_includes())
+    groups: T.Dict[T.Text, T.List[T.Text]] = {}
+
+
+def _unique(lists: T.Iterable[T.List[T.Text]]) -> T.List[T.Text]:
+    """Concatenate lists, keeping only the first occurrence of each item."""
+    seen: T.Set[T.Text] = set()
+    result = []
+    for items in lists:
+        for item in items:
+            if item not in seen:
+                seen.add(item)
+                result.append(item)
+    return result
+
+
+def resolve_includes(includes: T.Mapping[T.Text, CfgInclude]) -> T.Dict[T.Text, T.List[T.Text]]:
+    """Files of each include group, after the files of its nested groups.
+
+    Each group is resolved once, and its list is reused by all groups
+    including it; a file appearing several times is only kept at its first
+    occurrence.
+    """
+    resolved: T.Dict[T.Text, T.List[T.Text]] = {}
+    # Groups being resolved, from the outermost one
+    active: T.List[T.Text] = []
+
+    def resolve(name: T.Text) -> T.List[T.Text]:
+        if name in resolved:
+            return resolved[name]
+        if name in active:
+            cycle = active[active.index(name):] + [name]
+            raise InvalidConfiguration(["Include cycle: {}".format(' -> '.join(cycle))])
+        group = includes[name]
+        active.append(name)
+        files = _unique([resolve(include) for include in group.include] + [group.files])
+        active.pop()
+        resolved[name] = files
+        return files
+
+    for name in sorted(includes):
+        resolve(name)
+    return resolved
 
 
 def load_configuration(config: T.Mapping[T.Text, T.Any]) -> Configuration:
@@ -48,13 +111,16 @@ def load_configuration(config: T.Mapping[T.Text, T.Any]) -> Configuration:
             errors.append("Missing arch for profile {}".format(name))
         if not profile.get('include') and not profile.get('extras'):
             errors.append("Missing 'include' or 'extras' for profile {}".format(name))
-        for include in profile.get('include'):
+        for include in profile.get('include', []):
             if include not in includes:
                 errors.append("Reference to missing group {s} in profile {p}".format(s=include, p=name))
 
     for name, section in sorted(includes.items()):
-        if 'files' not in section:
-            errors.append("Missing 'files' for include group {}".format(name))
+        if 'files' not in section and 'include' not in section:
+            errors.append("Missing 'files' or 'include' for include group {}".format(name))
+        for include in section.get('include', []):
+            if include not in includes:
+                errors.append("Reference to missing group {s} in include group {g}".format(s=include, g=name))
 
     try:
         fragments_dir = config['core']['fragments_dir']
@@ -64,6 +130,14 @@ def load_configuration(config: T.Mapping[T.Text, T.Any]) -> Configuration:
     if errors:
         raise InvalidConfiguration(errors)
 
+    groups = {
+        name: CfgInclude(
+            files=section.get('files') or [],
+            include=section.get('include', []),
+        )
+        for name, section in includes.items()
+    }
+
     return Configuration(
         profiles={
             name: CfgProfile(
@@ -73,25 +147,786 @@ def load_configuration(config: T.Mapping[T.Text, T.Any]) -> Configuration:
             )
             for name, profile in profiles.items()
         },
-        includes={
-            name: CfgInclude(
-                files=section['files'] or [],
-            )
-            for name, section in includes.items()
-        },
+        includes=groups,
         fragments_dir=fragments_dir,
+        groups=resolve_includes(groups),
+    )
+
+
+class ProfilesIndex:
+    """The files of a profiles.d directory, by profile and include group name.
+
+    profiles.d/core.toml holds the [core] section; profile/NAME.toml and
+    include/NAME.toml hold the contents of the [profile.NAME] and
+    [include.NAME] sections. Only the files needed are parsed.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.core = self.path / 'core.toml'
+        self.profiles = self._scan('profile')
+        self.includes = self._scan('include')
+
+    def _scan(self, kind: T.Text) -> T.Dict[T.Text, pathlib.Path]:
+        directory = self.path / kind
+        if not directory.is_dir():
+            return {}
+        return {path.stem: path for path in sorted(directory.glob('*.toml'))}
+
+    @staticmethod
+    def _parse(path: pathlib.Path, errors: T.List[T.Text]) -> T.Dict[T.Text, T.Any]:
+        # Deferred, as in load_profiles().
+        import toml
+        try:
+            return toml.load(str(path))
+        except (OSError, toml.TomlDecodeError) as e:
+            errors.append("{}: {}".format(path, e))
+            return {}
+
+    def sources(self, config: Configuration, target: T.Text, extra_include: T.List[T.Text]) -> T.List[pathlib.Path]:
+        """Files defining a profile: core.toml, the profile, and the include groups it reaches."""
+        groups: T.List[T.Text] = []
+        pending = list(reversed(config.profiles[target].include + extra_include))
+        while pending:
+            name = pending.pop()
+            if name in groups or name not in self.includes:
+                continue
+            groups.append(name)
+            pending.extend(reversed(config.includes[name].include if name in config.includes else []))
+        files = [self.core] if self.core.exists() else []
+        return files + [self.profiles[target]] + [self.includes[name] for name in groups]
+
+    def load(
+            self,
+            targets: T.Optional[T.Iterable[T.Text]] = None,
+            extra_include: T.Optional[T.List[T.Text]] = None,
+    ) -> Configuration:
+        """Load and validate some profiles (all if targets is None), and the include groups they reach.
+
+        Without targets, every file is loaded, including unused groups.
+        """
+        errors: T.List[T.Text] = []
+        raw: T.Dict[T.Text, T.Any] = {'profile': {}, 'include': {}}
+        if self.core.exists():
+            raw.update({'core': self._parse(self.core, errors).get('core', {})})
+
+        if targets is None:
+            pending = list(self.includes)
+            targets = list(self.profiles)
+        else:
+            pending = list(extra_include or [])
+        for target in targets:
+            if target not in self.profiles:
+                errors.append("Missing profile {} in {}".format(target, self.path))
+                continue
+            raw['profile'][target] = self._parse(self.profiles[target], errors)
+            pending.extend(raw['profile'][target].get('include', []))
+
+        while pending:
+            name = pending.pop()
+            # Missing groups are reported by load_configuration().
+            if name in raw['include'] or name not in self.includes:
+                continue
+            raw['include'][name] = self._parse(self.includes[name], errors)
+            pending.extend(raw['include'][name].get('include', []))
+
+        if errors:
+            raise InvalidConfiguration(errors)
+        return load_configuration(raw)
+
+
+def profiles_index(root: pathlib.Path) -> T.Optional[ProfilesIndex]:
+    """The index of the profiles.d directory of a repository, if it uses that layout."""
+    directory = pathlib.Path(root) / PROFILES_DIRNAME
+    return ProfilesIndex(directory) if directory.is_dir() else None
+
+
+def profile_sources(
+        root: pathlib.Path,
+        config: Configuration,
+        target: T.Text,
+        extra_include: T.List[T.Text],
+        index: T.Optional[ProfilesIndex] = None,
+) -> T.List[pathlib.Path]:
+    """Configuration files defining a profile."""
+    index = index or profiles_index(root)
+    if index is None:
+        return [pathlib.Path(root) / PROFILES_FILENAME]
+    return index.sources(config, target, extra_include)
+
+
+def load_profiles(
+        root: pathlib.Path,
+        cache_dir: T.Optional[pathlib.Path] = None,
+        targets: T.Optional[T.Iterable[T.Text]] = None,
+        extra_include: T.Optional[T.List[T.Text]] = None,
+) -> Configuration:
+    """Load and validate the profiles of a repository, from profiles.toml or profiles.d.
+
+    With a profiles.d directory and explicit targets, only those profiles and
+    the include groups they reach are loaded (see ProfilesIndex).
+
+    With a cache_dir, the validated contents of profiles.toml are cached,
+    keyed by the file's mtime and content hash: later runs skip parsing it.
+    """
+    path = pathlib.Path(root) / PROFILES_FILENAME
+    index = profiles_index(root)
+    if index is not None:
+        if path.exists():
+            raise InvalidConfiguration(["Both {} and {} found in {}".format(
+                PROFILES_FILENAME, PROFILES_DIRNAME, root,
+            )])
+        return index.load(targets, extra_include)
+
+    store = PickleStore(pathlib.Path(cache_dir) / 'profiles') if cache_dir is not None else None
+    with path.open('rb') as f:
+        data = f.read()
+    key = text_digest(
+        str(CACHE_FORMAT),
+        # Entries written by another layout of the configuration are ignored.
+        ' '.join(Configuration._fields + CfgProfile._fields + CfgInclude._fields),
+        str(os.stat(str(path)).st_mtime_ns),
+        hashlib.sha256(data).hexdigest(),
     )
+    if store is not None:
+        cached = store.get(key)
+        if isinstance(cached, Configuration):
+            return cached
+
+    # Deferred: toml is only needed on a cache miss.
+    import toml
+    config = load_configuration(toml.loads(data.decode('utf-8')))
+    if store is not None:
+        store.put(key, config)
+    return config
 
 
 # {{{1 Kconfig
 # ===========
 
 
-def load_kconf(kernel_sources: pathlib.Path, arch: T.Text):
-    os.environ['srctree'] = str(kernel_sources)
-    os.environ['SRCARCH'] = arch
+# kconfiglib reads its settings ($srctree, $(SRCARCH), ...) from os.environ.
+# Instead of mutating the process environment, each thread parsing a tree
+# sets up its own environment, which kconfiglib sees through _KconfiglibOs,
+# _expandvars() (old-style `source "arch/$SRCARCH/Kconfig"`) and _shell_fn()
+# (`$(shell,...)`), installed into kconfiglib while any tree is being parsed.
+_thread_environ = threading.local()
+
+
+class _ThreadEnviron(T.Mapping[T.Text, T.Text]):
+    """os.environ, as seen by the current thread."""
+
+    def _current(self) -> T.Mapping[T.Text, T.Text]:
+        environ = getattr(_thread_environ, 'environ', None)
+        return os.environ if environ is None else environ
+
+    def __getitem__(self, key: T.Text) -> T.Text:
+        return self._current()[key]
+
+    def __iter__(self) -> T.Iterator[T.Text]:
+        return iter(self._current())
+
+    def __len__(self) -> int:
+        return len(self._current())
+
+
+class _KconfiglibOs(types.ModuleType):
+    """Stand-in for the os module within kconfiglib, with a per-thread environment."""
+
+    def __init__(self) -> None:
+        super().__init__(os.__name__)
+        self.__dict__.update(os.__dict__)
+        self.environ = _ThreadEnviron()  # type: ignore
+        # Don't shadow our getenv() with os.getenv()
+        del self.__dict__['getenv']
+
+    def getenv(self, key: T.Text, default: T.Optional[T.Text] = None) -> T.Optional[T.Text]:
+        return self.environ.get(key, default)
+
+
+_ENV_REFERENCE = re.compile(r'\$(\w+|\{[^}]*\})', re.ASCII)
+
+
+def _expandvars(path: T.Text) -> T.Text:
+    """os.path.expandvars(), with the environment of the current thread."""
+    environ = _ThreadEnviron()
+
+    def expand(match: T.Match[T.Text]) -> T.Text:
+        name = match.group(1)
+        if name.startswith('{'):
+            name = name[1:-1]
+        return environ.get(name, match.group(0))
+
+    return _ENV_REFERENCE.sub(expand, path)
+
+
+def _shell_fn(kconf: kconfiglib.Kconfig, _name: T.Text, command: T.Text) -> T.Text:
+    """kconfiglib's $(shell,...), run with the environment of the current thread."""
+    import subprocess
+
+    process = subprocess.run(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=dict(_ThreadEnviron()),
+    )
+    stdout = process.stdout.decode(kconf._encoding)
+    stderr = process.stderr.decode(kconf._encoding)
+    if stderr:
+        kconf._warn(
+            "'{}' wrote to stderr: {}".format(command, "\n".join(stderr.splitlines())),
+            kconf.filename,
+            kconf.linenr,
+        )
+    return "\n".join(stdout.splitlines()).rstrip("\n").replace("\n", " ")
+
+
+# Replacements of kconfiglib globals, and the number of threads using them
+_KCONFIGLIB_PATCHES: T.Dict[T.Text, T.Any] = {
+    'os': _KconfiglibOs(),
+    'expandvars': _expandvars,
+    '_shell_fn': _shell_fn,
+}
+_patch_lock = threading.Lock()
+_patch_users = 0
+_patched_originals: T.Dict[T.Text, T.Any] = {}
+
+
+def kconf_environ(
+        kernel_sources: pathlib.Path,
+        arch: T.Text,
+        base: T.Optional[T.Mapping[T.Text, T.Text]] = None,
+) -> T.Dict[T.Text, T.Text]:
+    """The environment a Kconfig tree is parsed with."""
+    environ = dict(os.environ if base is None else base)
+    environ['srctree'] = str(kernel_sources)
+    environ['SRCARCH'] = arch
+    return environ
+
+
+@contextlib.contextmanager
+def _kconfiglib_environ(environ: T.Mapping[T.Text, T.Text]) -> T.Iterator[None]:
+    """Make kconfiglib see `environ` in the current thread.
+
+    kconfiglib globals are patched while at least one thread is within this
+    context, and restored afterwards; threads outside it see os.environ.
+    """
+    global _patch_users
+    with _patch_lock:
+        if not _patch_users:
+            for name, value in _KCONFIGLIB_PATCHES.items():
+                _patched_originals[name] = getattr(kconfiglib, name)
+                setattr(kconfiglib, name, value)
+        _patch_users += 1
+
+    previous = getattr(_thread_environ, 'environ', None)
+    _thread_environ.environ = environ
+    try:
+        yield
+    finally:
+        _thread_environ.environ = previous
+        with _patch_lock:
+            _patch_users -= 1
+            if not _patch_users:
+                for name, value in _patched_originals.items():
+                    setattr(kconfiglib, name, value)
+                _patched_originals.clear()
+
+
+def load_kconf(
+        kernel_sources: pathlib.Path,
+        arch: T.Text,
+        cache_dir: T.Optional[pathlib.Path] = None,
+        timings: T.Optional[Timings] = None,
+        environ: T.Optional[T.Mapping[T.Text, T.Text]] = None,
+) -> kconfiglib.Kconfig:
+    """Parse the Kconfig tree of kernel_sources for arch.
+
+    The process environment is neither used (unless environ is None, where
+    it provides the base environment) nor modified: trees may be loaded
+    concurrently from several threads.
+    """
+    timings = timings or NO_TIMINGS
+    env = kconf_environ(kernel_sources, arch, base=environ)
+
+    cache = KconfCache(cache_dir) if cache_dir is not None else None
+    if cache is not None:
+        with timings.phase('kconf_cache_load'):
+            kconf = cache.load(kernel_sources, arch, env)
+        if kconf is not None:
+            return kconf
+
+    with timings.phase('parse_kconfig'), gc_paused(), _kconfiglib_environ(env):
+        kconf = kconfiglib.Kconfig()
+
+    if cache is not None:
+        try:
+            with timings.phase('kconf_cache_store'):
+                cache.store(kernel_sources, arch, env, kconf)
+        except (OSError, RecursionError) as e:
+            warnings.warn("Unable to cache the Kconfig tree in {}: {}".format(cache_dir, e))
+
+    return kconf
+
+
+def kconfig_files(kconf: kconfiglib.Kconfig) -> T.List[T.Text]:
+    """Paths of all Kconfig files read while parsing the tree."""
+    return [os.path.join(kconf.srctree, filename) for filename in kconf.kconfig_filenames]
+
+
+def reset_kconf(kconf: kconfiglib.Kconfig) -> None:
+    """Drop all user values from a tree, making it as good as freshly parsed."""
+    kconf.unset_values()
+    kconf.missing_syms = []
+    kconf.warnings = []
+    # Only used to warn about symbols set twice within a single load_config().
+    for sym in kconf.unique_defined_syms:
+        sym._was_set = False
+    for choice in kconf.unique_choices:
+        choice._was_set = False
+
+
+class KconfSnapshot(T.NamedTuple):
+    # (item, user_value, _was_set) for symbols and choices with a user value
+    symbols: T.List[T.Tuple[kconfiglib.Symbol, T.Any, bool]]
+    # (choice, user_value, user_selection, _was_set)
+    choices: T.List[T.Tuple[kconfiglib.Choice, T.Any, T.Any, bool]]
+    missing_syms: T.List[T.Tuple[T.Text, T.Text]]
+
+
+def snapshot_kconf(kconf: kconfiglib.Kconfig) -> KconfSnapshot:
+    """Record the user values of a tree, to be restored later with restore_kconf()."""
+    return KconfSnapshot(
+        symbols=[
+            (sym, sym.user_value, sym._was_set)
+            for sym in kconf.unique_defined_syms
+            if sym.user_value is not None or sym._was_set
+        ],
+        choices=[
+            # Choice._was_set is only initialized by the first assignment
+            (choice, choice.user_value, choice.user_selection, getattr(choice, '_was_set', False))
+            for choice in kconf.unique_choices
+            if choice.user_value is not None or choice.user_selection is not None
+            or getattr(choice, '_was_set', False)
+        ],
+        missing_syms=list(kconf.missing_syms),
+    )
+
+
+def restore_kconf(kconf: kconfiglib.Kconfig, snapshot: KconfSnapshot) -> None:
+    # Computed values only depend on user values: set those directly, then
+    # drop all cached values at once.
+    for sym in kconf.unique_defined_syms:
+        sym.user_value = None
+        sym._was_set = False
+    for choice in kconf.unique_choices:
+        choice.user_value = choice.user_selection = None
+        choice._was_set = False
+
+    for sym, user_value, was_set in snapshot.symbols:
+        sym.user_value = user_value
+        sym._was_set = was_set
+    for choice, user_value, user_selection, was_set in snapshot.choices:
+        choice.user_value = user_value
+        choice.user_selection = user_selection
+        choice._was_set = was_set
+    kconf.missing_syms = list(snapshot.missing_syms)
+
+    kconf._invalidate_all()
+
+
+def _current_rss() -> T.Optional[int]:
+    # Resident memory of the current process, in bytes; Linux only.
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class KconfPool:
+    """Parsed Kconfig trees, loaded once per (kernel sources, arch), and parsed fragments.
+
+    With max_trees or max_memory (in bytes), the least recently used trees are
+    dropped once the limit is exceeded; max_memory applies to the resident
+    memory of the whole process (Linux only).
+
+    The pool may be shared between threads; trees are loaded concurrently, but
+    callers must not use the same tree from several threads at once.
+    """
+
+    def __init__(
+            self,
+            cache_dir: T.Optional[pathlib.Path] = None,
+            max_trees: T.Optional[int] = None,
+            max_memory: T.Optional[int] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.max_trees = max_trees
+        self.max_memory = max_memory
+        self.trees: 'collections.OrderedDict[T.Tuple[T.Text, T.Text], kconfiglib.Kconfig]' = collections.OrderedDict()
+        self.fragments = FragmentCache(cache_dir=cache_dir)
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            kernel_sources: pathlib.Path,
+            arch: T.Text,
+            timings: T.Optional[Timings] = None,
+    ) -> kconfiglib.Kconfig:
+        """Return a tree for the kernel and arch, with all user values cleared."""
+        key = (str(kernel_sources), arch)
+        with self._lock:
+            kconf = self.trees.get(key)
+            if kconf is not None:
+                self.trees.move_to_end(key)
+        if kconf is not None:
+            reset_kconf(kconf)
+            return kconf
+
+        kconf = load_kconf(
+            kernel_sources=kernel_sources,
+            arch=arch,
+            cache_dir=self.cache_dir,
+            timings=timings,
+        )
+        with self._lock:
+            self.trees[key] = kconf
+            self._evict()
+        return kconf
+
+    def _over_memory(self) -> bool:
+        if self.max_memory is None:
+            return False
+        rss = _current_rss()
+        return rss is not None and rss > self.max_memory
+
+    def _evict(self) -> None:
+        # Never evict the most recent tree, which is about to be used.
+        while self.max_trees is not None and len(self.trees) > max(1, self.max_trees):
+            self.trees.popitem(last=False)
+        # Memory of dropped trees is reused by the next ones rather than given
+        # back to the system, so it can't be accounted per tree: measure the
+        # whole process after each drop instead.
+        while len(self.trees) > 1 and self._over_memory():
+            self.trees.popitem(last=False)
+            # Trees hold reference cycles: free them right away.
+            gc.collect()
+
+
+# {{{1 Config files
+# ================
+
+
+# (name, value, linenr); value is the raw text right of the '=', or None for
+# '# CONFIG_FOO is not set'.
+Assignment = T.Tuple[T.Text, T.Optional[T.Text], int]
+
+
+class ConfigFile(T.NamedTuple):
+    assignments: T.List[Assignment]
+    # (linenr, line) for lines which are neither assignments nor comments
+    malformed: T.List[T.Tuple[int, T.Text]]
+
+
+_STRING_MATCH = re.compile(r'"((?:[^\\"]|\\.)*)"').match
+
+# Accepted first character of values for bool/tristate symbols
+_TRISTATE_PREFIXES = {
+    kconfiglib.BOOL: ('y', 'n'),
+    kconfiglib.TRISTATE: ('y', 'm', 'n'),
+}
+
+
+def parse_config(lines: T.Iterable[T.Text], prefix: T.Text = 'CONFIG_') -> ConfigFile:
+    """Parse the lines of a .config / defconfig file, as kconfiglib would."""
+    set_match = re.compile(re.escape(prefix) + r'([^=]+)=(.*)').match
+    unset_match = re.compile(r'# {}([^ ]+) is not set'.format(re.escape(prefix))).match
+
+    result = ConfigFile(assignments=[], malformed=[])
+    add = result.assignments.append
+    for linenr, line in enumerate(lines, 1):
+        # The C tools ignore trailing whitespace
+        line = line.rstrip()
+        match = set_match(line)
+        if match:
+            name, value = match.groups()
+            add((name, value, linenr))
+            continue
+        match = unset_match(line)
+        if match:
+            add((match.group(1), None, linenr))
+        elif line and not line.lstrip().startswith('#'):
+            result.malformed.append((linenr, line))
+    return result
+
+
+def apply_config(
+        kconf: kconfiglib.Kconfig,
+        config: ConfigFile,
+        filename: T.Text,
+        replace: bool,
+) -> None:
+    """Set symbol values from a parsed config; same semantics as Kconfig.load_config()."""
+    if replace:
+        kconf.missing_syms = []
+        for symbol in kconf.unique_defined_syms:
+            symbol._was_set = False
+        for choice in kconf.unique_choices:
+            choice._was_set = False
+
+    for linenr, line in config.malformed:
+        kconf._warn("ignoring malformed line '{}'".format(line), filename, linenr)
+
+    get_sym = kconf.syms.get
+    tristate_prefixes = _TRISTATE_PREFIXES
+
+    # Assigning to symbols without prompts is expected within a .config file.
+    kconf._warn_assign_no_prompt = False
+    try:
+        for name, value, linenr in config.assignments:
+            sym = get_sym(name)
+            if not sym or not sym.nodes:
+                kconf._undef_assign(name, 'n' if value is None else value, filename, linenr)
+                continue
+
+            if value is None:
+                if sym.orig_type not in tristate_prefixes:
+                    continue
+                value = 'n'
+
+            elif sym.orig_type in tristate_prefixes:
+                # The C implementation only checks the first character
+                if not value.startswith(tristate_prefixes[sym.orig_type]):
+                    kconf._warn(
+                        "'{}' is not a valid value for the {} symbol {}. Assignment ignored.".format(
+                            value, kconfiglib.TYPE_TO_STR[sym.orig_type], sym.name_and_loc,
+                        ),
+                        filename, linenr,
+                    )
+                    continue
+                value = value[0]
+
+                if sym.choice and value != 'n':
+                    # The mode of the choice is inferred from its symbols' values
+                    prev_mode = sym.choice.user_value
+                    if prev_mode is not None and kconfiglib.TRI_TO_STR[prev_mode] != value:
+                        kconf._warn("both m and y assigned to symbols within the same choice", filename, linenr)
+                    sym.choice.set_value(value)
+
+            elif sym.orig_type is kconfiglib.STRING:
+                match = _STRING_MATCH(value)
+                if not match:
+                    kconf._warn(
+                        "malformed string literal in assignment to {}. Assignment ignored.".format(
+                            sym.name_and_loc,
+                        ),
+                        filename, linenr,
+                    )
+                    continue
+                value = kconfiglib.unescape(match.group(1))
+
+            if sym._was_set:
+                kconf._assigned_twice(sym, value, filename, linenr)
+            sym.set_value(value)
+    finally:
+        kconf._warn_assign_no_prompt = True
+
+    if replace:
+        for symbol in kconf.unique_defined_syms:
+            if not symbol._was_set:
+                symbol.unset_value()
+        for choice in kconf.unique_choices:
+            if not choice._was_set:
+                choice.unset_value()
+
+
+def load_config_file(path: pathlib.Path, prefix: T.Text = 'CONFIG_') -> ConfigFile:
+    with path.open('r', encoding='utf-8') as f:
+        return parse_config(f, prefix=prefix)
+
+
+class FragmentCache:
+    """Parsed fragments, shared by all profiles including them.
+
+    Fragments are parsed once per process (and again if they change on disk);
+    with a cache_dir, parsed fragments are also stored by content hash.
+    """
+
+    def __init__(self, cache_dir: T.Optional[pathlib.Path] = None):
+        self.store = PickleStore(pathlib.Path(cache_dir) / 'fragments') if cache_dir is not None else None
+        self._parsed: T.Dict[T.Tuple[T.Text, T.Text], T.Tuple[T.Tuple[int, int], ConfigFile]] = {}
+
+    def get(self, path: pathlib.Path, prefix: T.Text = 'CONFIG_') -> ConfigFile:
+        key = (str(path), prefix)
+        stat = os.stat(str(path))
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if key in self._parsed and self._parsed[key][0] == stamp:
+            return self._parsed[key][1]
+
+        with open(str(path), 'rb') as f:
+            config = self.parse(f.read(), prefix)
+
+        self._parsed[key] = (stamp, config)
+        return config
+
+    def parse(self, data: bytes, prefix: T.Text) -> ConfigFile:
+        config = None
+        if self.store is not None:
+            digest = hashlib.sha256(prefix.encode('utf-8') + b'\0' + data).hexdigest()
+            config = self.store.get(digest)
+        if not isinstance(config, ConfigFile):
+            # Universal newlines, as when reading the file in text mode
+            config = parse_config(io.StringIO(data.decode('utf-8'), newline=None), prefix=prefix)
+            if self.store is not None:
+                self.store.put(digest, config)
+        return config
+
 
-    return kconfiglib.Kconfig()
+def min_config(kconf: kconfiglib.Kconfig) -> T.Text:
+    """Contents of the minimal config (as Kconfig.write_min_config()), without a file round-trip."""
+    return T.cast(T.Text, kconf._min_config_contents(header=''))
+
+
+def full_config(kconf: kconfiglib.Kconfig) -> T.Text:
+    """Contents of the full .config (as Kconfig.write_config()), without a file round-trip."""
+    return T.cast(T.Text, kconf._config_contents(header=''))
+
+
+def autoconf_header(kconf: kconfiglib.Kconfig) -> T.Text:
+    """Contents of include/generated/autoconf.h (as Kconfig.write_autoconf())."""
+    return T.cast(T.Text, kconf._autoconf_contents(header=''))
+
+
+def symbols_json(kconf: kconfiglib.Kconfig) -> T.Text:
+    """Values of the symbols written to the full .config, as a JSON object in .config order."""
+    values = {
+        kconf.config_prefix + sym.name: sym.str_value
+        for sym in kconf.unique_defined_syms
+        if sym.config_string
+    }
+    return json.dumps(values, indent=2) + '\n'
+
+
+# Files which can be generated from a configured tree: name => (timing phase, generator)
+ARTIFACTS: T.Dict[T.Text, T.Tuple[T.Text, T.Callable[[kconfiglib.Kconfig], T.Text]]] = {
+    'defconfig': ('min_config', min_config),
+    'config': ('full_config', full_config),
+    'autoconf': ('autoconf', autoconf_header),
+    'json': ('symbols_json', symbols_json),
+}
+DEFCONFIG = 'defconfig'
+DEFAULT_ARTIFACTS = (DEFCONFIG,)
+
+
+# {{{1 Categories
+# ==============
+
+
+class CategoryRule(T.NamedTuple):
+    name: T.Text
+    kind: T.Text
+    pattern: T.Text
+
+
+CATEGORY_PREFIX = 'prefix'
+CATEGORY_GLOB = 'glob'
+CATEGORY_SYMBOL = 'symbol'
+
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+def parse_category(line: T.Text) -> CategoryRule:
+    """Parse a category definition.
+
+    Accepted forms, with an optional ``NAME =`` prefix:
+    - ``drivers/net``: Kconfig files whose path starts with ``drivers/net``;
+    - ``drivers/*/wireless/*``: Kconfig files whose path matches the glob;
+    - ``symbol:CRYPTO_*``: symbols whose name matches the glob.
+    """
+    name, sep, rule = line.partition('=')
+    if sep:
+        name, rule = name.strip(), rule.strip()
+    else:
+        name = rule = line.strip()
+
+    if rule.startswith('symbol:'):
+        return CategoryRule(name=name, kind=CATEGORY_SYMBOL, pattern=rule[len('symbol:'):])
+    elif _GLOB_CHARS.search(rule):
+        return CategoryRule(name=name, kind=CATEGORY_GLOB, pattern=rule)
+    else:
+        return CategoryRule(name=name, kind=CATEGORY_PREFIX, pattern=rule)
+
+
+def _compile_globs(rules: T.List[CategoryRule]) -> T.Optional[T.Callable[[T.Text], T.Optional[T.Match[T.Text]]]]:
+    if not rules:
+        return None
+    # Alternatives are tried in order: the first matching rule wins.
+    return re.compile('|'.join(
+        '(?P<r{}>{})'.format(i, fnmatch.translate(rule.pattern))
+        for i, rule in enumerate(rules)
+    )).match
+
+
+class CategoryIndex:
+    """Compiled category rules, mapping a symbol to the name of its category.
+
+    Symbol name rules win over filename globs, which win over path prefixes;
+    among prefixes, the longest match wins. Symbols matching no rule fall in
+    the default, unnamed, category.
+    """
+
+    def __init__(self, categories: T.Iterable[T.Text]):
+        self.rules = [
+            parse_category(line) for line in categories
+            if line.strip() and not line.lstrip().startswith('#')
+        ]
+        self.names = sorted({''} | {rule.name for rule in self.rules})
+
+        # Character-level trie of prefixes; the None key holds the category name.
+        self._prefixes: T.Dict[T.Any, T.Any] = {None: ''}
+        for rule in self.rules:
+            if rule.kind == CATEGORY_PREFIX:
+                node = self._prefixes
+                for char in rule.pattern:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, rule.name)
+
+        self._globs = [rule for rule in self.rules if rule.kind == CATEGORY_GLOB]
+        self._match_glob = _compile_globs(self._globs)
+        self._symbols = [rule for rule in self.rules if rule.kind == CATEGORY_SYMBOL]
+        self._match_symbol = _compile_globs(self._symbols)
+
+        self._by_filename: T.Dict[T.Text, T.Text] = {}
+
+    def for_filename(self, filename: T.Text) -> T.Text:
+        try:
+            return self._by_filename[filename]
+        except KeyError:
+            pass
+
+        match = self._match_glob(filename) if self._match_glob else None
+        if match:
+            category = self._globs[int(T.cast(T.Text, match.lastgroup)[1:])].name
+        else:
+            node = self._prefixes
+            category = node[None]
+            for char in filename:
+                if char not in node:
+                    break
+                node = node[char]
+                category = node.get(None, category)
+
+        self._by_filename[filename] = category
+        return category
+
+    def for_symbol(self, symbol: kconfiglib.Symbol) -> T.Text:
+        if self._match_symbol:
+            match = self._match_symbol(symbol.name)
+            if match:
+                return self._symbols[int(T.cast(T.Text, match.lastgroup)[1:])].name
+        return self.for_filename(symbol.nodes[0].filename)
 
 
 # {{{1 Features
@@ -101,11 +936,18 @@ def load_kconf(kernel_sources: pathlib.Path, arch: T.Text):
 class Stats(T.NamedTuple):
     nb_symbols: int
     files: T.List[pathlib.Path]
+    # Per-phase timings of the run, if requested
+    timings: T.Optional[Timings] = None
+    # Files which already held the generated contents, and were left untouched
+    unchanged: T.List[pathlib.Path] = []
 
 
 class GenerationResult(T.NamedTuple):
     stats: Stats
+    # The minimal defconfig; empty if it wasn't requested
     output: T.Text
+    # Other generated artifacts, by name (see ARTIFACTS)
+    artifacts: T.Dict[T.Text, T.Text] = {}
 
 
 def defconfig_for_target(
@@ -116,15 +958,9 @@ def defconfig_for_target(
 ) -> Profile:
 
     profile = config.profiles[target]
-    includes = profile.include + extra_include
-    files: T.List[T.Text] = sum(
-        (
-            config.includes[include].files
-            for include in includes
-        ),
-        [],
-    )
-    files.extend(profile.extras)
+    # Configurations not built by load_configuration() are resolved on each call.
+    groups = config.groups or resolve_includes(config.includes)
+    files = _unique([groups[include] for include in profile.include + extra_include] + [profile.extras])
 
     return Profile(
         arch=profile.arch,
@@ -132,77 +968,543 @@ def defconfig_for_target(
     )
 
 
-def defconfig_merge(
+def _merge_file(
         kconf: kconfiglib.Kconfig,
-        sources: T.List[pathlib.Path],
+        path: pathlib.Path,
         fail_on_unknown: bool,
-) -> GenerationResult:
+        fragments: T.Optional[FragmentCache],
+        timings: Timings = NO_TIMINGS,
+) -> None:
+    start = time.perf_counter()
+    with timings.phase('load_fragment'):
+        if fragments is not None:
+            config = fragments.get(path, prefix=kconf.config_prefix)
+        else:
+            config = load_config_file(path, prefix=kconf.config_prefix)
+    with timings.phase('apply_fragment'):
+        apply_config(kconf, config, filename=str(path), replace=False)
+    timings.add_fragment(str(path), time.perf_counter() - start)
+    if kconf.missing_syms and fail_on_unknown:
+        raise ValueError("Unknown symbols: {}".format(kconf.missing_syms))
 
-    for path in sources:
-        kconf.load_config(str(path.absolute()), replace=False)
-        if kconf.missing_syms and fail_on_unknown:
-            raise ValueError("Unknown symbols: {}".format(kconf.missing_syms))
 
+def check_artifacts(artifacts: T.Iterable[T.Text]) -> None:
+    unknown = sorted(set(artifacts) - set(ARTIFACTS))
+    if unknown:
+        raise ValueError("Unknown artifacts: {}".format(', '.join(unknown)))
+
+
+def _merge_result(
+        kconf: kconfiglib.Kconfig,
+        sources: T.List[pathlib.Path],
+        timings: Timings = NO_TIMINGS,
+        artifacts: T.Sequence[T.Text] = DEFAULT_ARTIFACTS,
+) -> GenerationResult:
     stats = Stats(
         nb_symbols=len([
             symbol for symbol in kconf.unique_defined_syms if symbol.user_value
         ]),
         files=sources,
+        timings=timings if timings.enabled else None,
     )
 
-    with tempfile.NamedTemporaryFile(mode='r') as f:
-        kconf.write_min_config(f.name, header='')
-        lines = f.read()
+    # All artifacts are read from the same evaluated tree.
+    contents = {}
+    for name in artifacts:
+        phase, generate = ARTIFACTS[name]
+        with timings.phase(phase):
+            contents[name] = generate(kconf)
 
     return GenerationResult(
         stats=stats,
-        output=lines,
+        output=contents.pop(DEFCONFIG, ''),
+        artifacts=contents,
+    )
+
+
+def defconfig_merge(
+        kconf: kconfiglib.Kconfig,
+        sources: T.List[pathlib.Path],
+        fail_on_unknown: bool,
+        fragments: T.Optional[FragmentCache] = None,
+        timings: T.Optional[Timings] = None,
+        artifacts: T.Sequence[T.Text] = DEFAULT_ARTIFACTS,
+) -> GenerationResult:
+    """Merge sources into a tree, and generate the requested artifacts (see ARTIFACTS) from it."""
+    timings = timings or NO_TIMINGS
+    check_artifacts(artifacts)
+
+    for path in sources:
+        _merge_file(kconf, path, fail_on_unknown, fragments, timings)
+
+    return _merge_result(kconf, sources, timings, artifacts)
+
+
+def common_prefix(a: T.Sequence[T.Any], b: T.Sequence[T.Any]) -> int:
+    """Length of the common leading part of two sequences."""
+    length = 0
+    for left, right in zip(a, b):
+        if left != right:
+            break
+        length += 1
+    return length
+
+
+def merge_many(
+        kconf: kconfiglib.Kconfig,
+        sources: T.Mapping[T.Text, T.List[pathlib.Path]],
+        fail_on_unknown: bool,
+        fragments: T.Optional[FragmentCache] = None,
+        timings: T.Optional[Timings] = None,
+) -> T.Iterator[T.Text]:
+    """Merge several lists of sources on a single tree, yielding each name once its files are applied.
+
+    The tree holds the state of a list until the next item is requested.
+
+    Lists are processed in sorted order; the state reached after a prefix of
+    files shared with later lists is snapshotted, and restored for those lists
+    instead of merging the same files again.
+    """
+    timings = timings or NO_TIMINGS
+    ordered = sorted(sources, key=lambda name: [str(path) for path in sources[name]])
+    # Length of the prefix shared by each list and the next one
+    shared = [
+        common_prefix(sources[name], sources[next_name])
+        for name, next_name in zip(ordered, ordered[1:])
+    ]
+
+    # Snapshots of the state after applying the first `depth` files of `applied`
+    stack: T.List[T.Tuple[int, KconfSnapshot]] = []
+    applied: T.List[pathlib.Path] = []
+    for i, name in enumerate(ordered):
+        files = sources[name]
+        # In sorted order, the prefix shared with a later list is the minimum
+        # of the consecutive shared prefixes up to it.
+        branches = set()
+        reach = len(files)
+        for length in shared[i:]:
+            reach = min(reach, length)
+            if not reach:
+                break
+            branches.add(reach)
+
+        common = common_prefix(applied, files)
+        while stack and stack[-1][0] > common:
+            stack.pop()
+        with timings.phase('restore'):
+            if stack:
+                depth = stack[-1][0]
+                restore_kconf(kconf, stack[-1][1])
+            else:
+                depth = 0
+                reset_kconf(kconf)
+
+        applied = files
+        for position in range(depth, len(files) + 1):
+            if position in branches and position > depth:
+                with timings.phase('snapshot'):
+                    stack.append((position, snapshot_kconf(kconf)))
+            if position < len(files):
+                _merge_file(kconf, files[position], fail_on_unknown, fragments, timings)
+
+        yield name
+
+
+def defconfig_merge_many(
+        kconf: kconfiglib.Kconfig,
+        sources: T.Mapping[T.Text, T.List[pathlib.Path]],
+        fail_on_unknown: bool,
+        fragments: T.Optional[FragmentCache] = None,
+        timings: T.Optional[Timings] = None,
+        artifacts: T.Sequence[T.Text] = DEFAULT_ARTIFACTS,
+) -> T.Iterator[T.Tuple[T.Text, GenerationResult]]:
+    """Merge several lists of sources on a single tree, yielding results by name (see merge_many())."""
+    timings = timings or NO_TIMINGS
+    check_artifacts(artifacts)
+    for name in merge_many(kconf, sources, fail_on_unknown, fragments, timings):
+        yield name, _merge_result(kconf, sources[name], timings, artifacts)
+
+
+class ProfileResult(T.NamedTuple):
+    target: T.Text
+    profile: Profile
+    result: GenerationResult
+    # PID of the process which assembled the profile, and time spent on it.
+    worker: int
+    duration: float
+    # Kconfig files read from the kernel tree
+    kconfig_files: T.List[T.Text] = []
+
+
+def _assemble_group(
+        pool: KconfPool,
+        group: 'TreeGroup',
+        fail_on_unknown: bool,
+        fragments: T.Optional[FragmentCache] = None,
+        artifacts: T.Sequence[T.Text] = DEFAULT_ARTIFACTS,
+        timings: Timings = NO_TIMINGS,
+) -> T.Iterator[ProfileResult]:
+    by_target = dict(group.items)
+    kconf = pool.get(group.kernel_sources, group.arch, timings=timings)
+    kconf_files = kconfig_files(kconf)
+    start = time.perf_counter()
+    results = defconfig_merge_many(
+        kconf=kconf,
+        sources={target: profile.files for target, profile in group.items},
+        fail_on_unknown=fail_on_unknown,
+        fragments=fragments or pool.fragments,
+        timings=timings,
+        artifacts=artifacts,
     )
+    for target, result in results:
+        end = time.perf_counter()
+        timings.add_profile(target, end - start)
+        yield ProfileResult(
+            target=target,
+            profile=by_target[target],
+            result=result,
+            worker=os.getpid(),
+            duration=end - start,
+            kconfig_files=kconf_files,
+        )
+        start = time.perf_counter()
+
+
+class TreeGroup(T.NamedTuple):
+    """Items (profiles, split jobs, ...) handled on the same Kconfig tree."""
+    kernel_sources: pathlib.Path
+    arch: T.Text
+    items: T.List[T.Any]
+
+
+def group_profiles(
+        profiles: T.Iterable[T.Tuple[T.Text, Profile]],
+        kernel_sources: pathlib.Path,
+) -> T.List[TreeGroup]:
+    """Group (name, profile) pairs by arch, sorted by arch.
+
+    Within a group, profiles are sorted by fragments: contiguous chunks keep
+    most shared prefixes together (see merge_many()).
+    """
+    by_arch: T.Dict[T.Text, T.List[T.Tuple[T.Text, Profile]]] = {}
+    for target, profile in profiles:
+        by_arch.setdefault(profile.arch, []).append((target, profile))
+    return [
+        TreeGroup(
+            kernel_sources=kernel_sources,
+            arch=arch,
+            items=sorted(items, key=lambda item: [str(path) for path in item[1].files]),
+        )
+        for arch, items in sorted(by_arch.items())
+    ]
+
+
+# Warm Kconfig trees of a worker process
+_worker_pool: T.Optional[KconfPool] = None
+
+
+def _init_worker(cache_dir: T.Optional[pathlib.Path]) -> None:
+    global _worker_pool
+    _worker_pool = KconfPool(cache_dir=cache_dir)
+
+
+def _split_chunks(items: T.List[T.Any], count: int) -> T.List[T.List[T.Any]]:
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _map_group_in_worker(
+        fn: T.Callable[..., T.Iterable[T.Any]],
+        group: TreeGroup,
+        args: T.Sequence[T.Any],
+        timed: bool,
+) -> T.Tuple[T.List[T.Any], T.Optional[Timings]]:
+    assert _worker_pool is not None
+    timings = Timings() if timed else None
+    results = list(fn(_worker_pool, group, *args, timings=timings or NO_TIMINGS))
+    return results, timings
+
+
+def map_groups(
+        fn: T.Callable[..., T.Iterable[T.Any]],
+        groups: T.Iterable[TreeGroup],
+        args: T.Sequence[T.Any] = (),
+        pool: T.Optional[KconfPool] = None,
+        jobs: int = 1,
+        timings: T.Optional[Timings] = None,
+) -> T.Iterator[T.Any]:
+    """Run fn(pool, group, *args, timings=timings) on each group, yielding its results.
+
+    With jobs > 1, each group is split into up to `jobs` contiguous chunks,
+    run by a pool of worker processes, each keeping its own warm trees (and
+    sharing the on-disk cache of `pool`); fn and args must then be
+    picklable. Results are yielded as soon as a chunk completes, and the
+    timings of workers are merged into `timings`.
+    """
+    timings = timings or NO_TIMINGS
+    if pool is None:
+        pool = KconfPool()
+    groups = [group for group in groups if group.items]
+
+    if jobs <= 1:
+        for group in groups:
+            yield from fn(pool, group, *args, timings=timings)
+        return
+
+    chunks = [group._replace(items=items) for group in groups for items in _split_chunks(group.items, jobs)]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(pool.cache_dir,),
+    ) as executor:
+        futures = [executor.submit(_map_group_in_worker, fn, chunk, args, timings.enabled) for chunk in chunks]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                results, worker_timings = future.result()
+                if worker_timings is not None:
+                    timings.merge(worker_timings)
+                yield from results
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def assemble_profiles(
+        config: Configuration,
+        targets: T.List[T.Text],
+        root: pathlib.Path,
+        kernel_sources: pathlib.Path,
+        fail_on_unknown: bool,
+        extra_include: T.List[T.Text],
+        pool: T.Optional[KconfPool] = None,
+        jobs: int = 1,
+        timings: T.Optional[Timings] = None,
+        result_cache: T.Optional[ResultCache] = None,
+        fragments: T.Optional[FragmentCache] = None,
+        artifacts: T.Sequence[T.Text] = DEFAULT_ARTIFACTS,
+) -> T.Iterator[ProfileResult]:
+    """Assemble several profiles, parsing the Kconfig tree once per arch.
+
+    Profiles sharing an arch are merged on the same tree, reusing the state
+    reached after their common leading fragments (see defconfig_merge_many()).
+
+    With jobs > 1, profiles are spread over a pool of worker processes, each
+    keeping its own trees; results are yielded as soon as they are ready.
+    Their timings are merged into `timings` as each chunk completes.
+
+    With a result_cache, cached profiles are yielded first, without parsing
+    any Kconfig tree; other results are added to the cache.
+
+    Fragments are read through `fragments` if set (e.g. from a git revision),
+    through the pool's cache otherwise.
+
+    Each result holds the requested artifacts (see ARTIFACTS), all generated
+    from the same configured tree.
+    """
+    timings = timings or NO_TIMINGS
+    check_artifacts(artifacts)
+
+    if pool is None:
+        pool = KconfPool()
+
+    profiles: T.List[T.Tuple[T.Text, Profile]] = []
+    keys: T.Dict[T.Text, T.Text] = {}
+    for target in targets:
+        profile = defconfig_for_target(
+            config=config,
+            target=target,
+            root=root,
+            extra_include=extra_include,
+        )
+        if result_cache is not None:
+            with timings.phase('result_cache'):
+                key = result_cache.key(kernel_sources, profile.arch, profile.files, fail_on_unknown, artifacts)
+                cached = result_cache.get(key)
+            if cached is not None:
+                yield _cached_result(target, profile, kernel_sources, cached)
+                continue
+            keys[target] = key
+        profiles.append((target, profile))
+
+    results = map_groups(
+        _assemble_group,
+        group_profiles(profiles, kernel_sources),
+        args=(fail_on_unknown, fragments, artifacts),
+        pool=pool,
+        jobs=jobs,
+        timings=timings,
+    )
+    for item in results:
+        if result_cache is not None:
+            with timings.phase('result_cache'):
+                _cache_result(result_cache, keys[item.target], kernel_sources, item)
+        yield item
+
+
+def _cached_result(
+        target: T.Text,
+        profile: Profile,
+        kernel_sources: pathlib.Path,
+        cached: T.Mapping[T.Text, T.Any],
+) -> ProfileResult:
+    return ProfileResult(
+        target=target,
+        profile=profile,
+        result=GenerationResult(
+            stats=Stats(nb_symbols=cached['nb_symbols'], files=profile.files),
+            output=cached['output'],
+            artifacts=cached['artifacts'],
+        ),
+        worker=os.getpid(),
+        duration=0.0,
+        kconfig_files=[os.path.join(str(kernel_sources), filename) for filename in cached['kconfig_filenames']],
+    )
+
+
+def _cache_result(
+        result_cache: ResultCache,
+        key: T.Text,
+        kernel_sources: pathlib.Path,
+        item: ProfileResult,
+) -> None:
+    result_cache.put(key, {
+        'output': item.result.output,
+        'artifacts': item.result.artifacts,
+        'nb_symbols': item.result.stats.nb_symbols,
+        'kconfig_filenames': [os.path.relpath(path, str(kernel_sources)) for path in item.kconfig_files],
+    })
 
 
 def defconfig_split(
         kconf: kconfiglib.Kconfig,
         fail_on_unknown: bool,
-        categories: T.List[T.Text],
+        categories: T.Union[T.List[T.Text], CategoryIndex],
         destdir: pathlib.Path,
         source: T.TextIO,
         prefix: T.Text,
+        timings: T.Optional[Timings] = None,
 ) -> Stats:
+    timings = timings or NO_TIMINGS
 
-    with tempfile.TemporaryDirectory() as d:
-        config_path = os.path.join(d, '.config')
-        defconfig_path = os.path.join(d, 'defconfig')
-        with open(config_path, 'w', encoding='utf-8') as f:
-            for line in source:
-                f.write(line)
-        kconf.load_config(config_path)
+    index = categories if isinstance(categories, CategoryIndex) else CategoryIndex(categories)
 
-        if fail_on_unknown and kconf.missing_syms:
-            raise ValueError("Unknown symbols: {}".format(kconf.missing_syms))
+    filename = getattr(source, 'name', '<source>')
+    with timings.phase('load_source'):
+        apply_config(kconf, parse_config(source, prefix=kconf.config_prefix), filename=filename, replace=True)
 
-        kconf.write_min_config(defconfig_path)
-        kconf.load_config(defconfig_path)
+    if fail_on_unknown and kconf.missing_syms:
+        raise ValueError("Unknown symbols: {}".format(kconf.missing_syms))
 
-    symbols_by_category: T.Dict[T.Text, T.List[kconfiglib.Symbol]] = {cat: [] for cat in categories}
-    symbols_by_category[''] = []
-    for symbol in kconf.unique_defined_syms:
-        if symbol.user_value is not None:
-            category = max(cat for cat in symbols_by_category if symbol.nodes[0].filename.startswith(cat))
-            symbols_by_category[category].append(symbol)
+    # Keep only the values which are required to reach that configuration
+    with timings.phase('min_config'):
+        minimal = min_config(kconf).splitlines()
+        apply_config(kconf, parse_config(minimal, prefix=kconf.config_prefix), filename='<minimal>', replace=True)
+
+    with timings.phase('categorize'):
+        symbols_by_category: T.Dict[T.Text, T.List[kconfiglib.Symbol]] = {name: [] for name in index.names}
+        for symbol in kconf.unique_defined_syms:
+            if symbol.user_value is not None:
+                symbols_by_category[index.for_symbol(symbol)].append(symbol)
 
     stats = Stats(
         nb_symbols=sum(len(symbols) for symbols in symbols_by_category.values()),
         files=[],
+        timings=timings if timings.enabled else None,
+        unchanged=[],
     )
 
-    for category, symbols in sorted(symbols_by_category.items()):
-        if category:
-            path = destdir / '{}.{}'.format(prefix, category.replace('/', '_'))
-        else:
-            path = destdir / prefix
-        stats.files.append(path)
-        with path.open('w', encoding='utf-8') as output:
-            for symbol in symbols:
-                output.write(symbol.config_string)
+    with timings.phase('write_output'):
+        for category, symbols in sorted(symbols_by_category.items()):
+            if category:
+                path = destdir / '{}.{}'.format(prefix, category.replace('/', '_'))
+            else:
+                path = destdir / prefix
+            stats.files.append(path)
+            # Keep the mtime of unchanged files, to avoid triggering rebuilds.
+            if not write_if_changed(path, ''.join(symbol.config_string for symbol in symbols)):
+                stats.unchanged.append(path)
 
     return stats
+
+
+class SplitJob(T.NamedTuple):
+    source: pathlib.Path
+    arch: T.Text
+    destdir: pathlib.Path
+    prefix: T.Text = 'defconfig'
+
+
+def parse_split_jobs(lines: T.Iterable[T.Text], prefix: T.Text = 'defconfig') -> T.List[SplitJob]:
+    """Parse a list of sources to split: one 'SOURCE ARCH DESTDIR [PREFIX]' per line, shell-quoted."""
+    jobs = []
+    for linenr, line in enumerate(lines, start=1):
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        if len(fields) not in (3, 4):
+            raise ValueError("Line {}: expected SOURCE ARCH DESTDIR [PREFIX], got {!r}".format(linenr, line.strip()))
+        jobs.append(SplitJob(
+            source=pathlib.Path(fields[0]),
+            arch=fields[1],
+            destdir=pathlib.Path(fields[2]),
+            prefix=fields[3] if len(fields) == 4 else prefix,
+        ))
+    return jobs
+
+
+def _split_group(
+        pool: KconfPool,
+        group: TreeGroup,
+        categories: T.List[T.Text],
+        fail_on_unknown: bool,
+        timings: Timings = NO_TIMINGS,
+) -> T.Iterator[T.Tuple[SplitJob, Stats]]:
+    kconf = pool.get(group.kernel_sources, group.arch, timings=timings)
+    index = CategoryIndex(categories)
+    for job in group.items:
+        with job.source.open('r', encoding='utf-8') as source:
+            stats = defconfig_split(
+                kconf=kconf,
+                fail_on_unknown=fail_on_unknown,
+                categories=index,
+                destdir=job.destdir,
+                source=source,
+                prefix=job.prefix,
+                timings=timings,
+            )
+        yield job, stats
+
+
+def defconfig_split_many(
+        sources: T.List[SplitJob],
+        kernel_sources: pathlib.Path,
+        categories: T.List[T.Text],
+        fail_on_unknown: bool,
+        pool: T.Optional[KconfPool] = None,
+        jobs: int = 1,
+        timings: T.Optional[Timings] = None,
+) -> T.Iterator[T.Tuple[SplitJob, Stats]]:
+    """Split several sources, each into its own destdir and prefix, parsing the Kconfig tree once per arch.
+
+    With jobs > 1, sources are spread over a pool of worker processes;
+    results are yielded as soon as they are ready.
+    """
+    by_arch: T.Dict[T.Text, T.List[SplitJob]] = {}
+    for job in sources:
+        by_arch.setdefault(job.arch, []).append(job)
+
+    return map_groups(
+        _split_group,
+        [TreeGroup(kernel_sources=kernel_sources, arch=arch, items=group) for arch, group in sorted(by_arch.items())],
+        args=(categories, fail_on_unknown),
+        pool=pool,
+        jobs=jobs,
+        timings=timings,
+    )
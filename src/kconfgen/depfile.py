@@ -0,0 +1,132 @@
+"""Make-style dependency files.
+
+A depfile is a list of rules, ``target [target...]: dependency [dependency...]``,
+as understood by make's ``include`` or ninja's ``depfile``; a target's
+dependencies are the union of all rules listing it.
+
+kconfgen adds a ``# kconfgen: KEY`` comment, where KEY summarizes the options
+used to generate the targets: a depfile written with other options is ignored.
+"""
+
+import os
+import pathlib
+import re
+import typing as T
+
+from .cache import atomic_write
+
+
+KEY_PREFIX = '# kconfgen: '
+
+Rule = T.Tuple[T.List[T.Text], T.List[T.Text]]
+
+_SPLIT = re.compile(r'(?:\\.|[^\s\\])+')
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+def escape(path: T.Text) -> T.Text:
+    return path.replace('\\', '\\\\').replace(' ', '\\ ').replace('#', '\\#').replace('$', '$$')
+
+
+def unescape(word: T.Text) -> T.Text:
+    return _UNESCAPE.sub(r'\1', word).replace('$$', '$')
+
+
+class DepFile(T.NamedTuple):
+    key: T.Optional[T.Text]
+    rules: T.List[Rule]
+
+    def dependencies(self, target: T.Text) -> T.List[T.Text]:
+        seen: T.Dict[T.Text, None] = {}
+        for targets, dependencies in self.rules:
+            if target in targets:
+                seen.update((dependency, None) for dependency in dependencies)
+        return list(seen)
+
+    def targets(self) -> T.Set[T.Text]:
+        return {target for targets, _ in self.rules for target in targets}
+
+    def only(self, targets: T.Collection[T.Text]) -> T.List[Rule]:
+        """Rules restricted to some targets."""
+        rules = []
+        for rule_targets, dependencies in self.rules:
+            kept = [target for target in rule_targets if target in targets]
+            if kept:
+                rules.append((kept, dependencies))
+        return rules
+
+
+def read_depfile(path: pathlib.Path) -> T.Optional[DepFile]:
+    try:
+        with path.open('r', encoding='utf-8') as f:
+            contents = f.read()
+    except OSError:
+        return None
+
+    key = None
+    rules = []
+    for line in contents.replace('\\\n', ' ').splitlines():
+        if line.startswith(KEY_PREFIX):
+            key = line[len(KEY_PREFIX):].strip()
+            continue
+        words = [unescape(word) for word in _SPLIT.findall(line)]
+        if not words or words[0].startswith('#'):
+            continue
+        targets: T.List[T.Text] = []
+        while words and not words[0].endswith(':'):
+            targets.append(words.pop(0))
+        if not words:
+            # Not a rule
+            continue
+        targets.append(words.pop(0)[:-1])
+        rules.append(([target for target in targets if target], words))
+    return DepFile(key=key, rules=rules)
+
+
+def write_depfile(path: pathlib.Path, depfile: DepFile) -> None:
+    lines = []
+    if depfile.key is not None:
+        lines.append('{}{}\n'.format(KEY_PREFIX, depfile.key))
+    for targets, dependencies in depfile.rules:
+        lines.append(' \\\n  '.join(
+            ['{}:'.format(' '.join(escape(target) for target in targets))]
+            + [escape(dependency) for dependency in dependencies]
+        ) + '\n')
+    atomic_write(path, ''.join(lines))
+
+
+class Checker:
+    """Decide whether targets are up to date, according to a previous depfile.
+
+    A target is up to date if it exists, and none of its dependencies is
+    missing, or was modified after the depfile was written.
+    """
+
+    def __init__(self, path: pathlib.Path, key: T.Text):
+        self.depfile = read_depfile(path)
+        if self.depfile is not None and self.depfile.key != key:
+            self.depfile = None
+        try:
+            self.reference = path.stat().st_mtime_ns
+        except OSError:
+            self.depfile = None
+        self._mtimes: T.Dict[T.Text, T.Optional[int]] = {}
+
+    def _mtime(self, path: T.Text) -> T.Optional[int]:
+        if path not in self._mtimes:
+            try:
+                self._mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                self._mtimes[path] = None
+        return self._mtimes[path]
+
+    def up_to_date(self, target: T.Text) -> bool:
+        if self.depfile is None or target not in self.depfile.targets():
+            return False
+        if self._mtime(target) is None:
+            return False
+        for dependency in self.depfile.dependencies(target):
+            mtime = self._mtime(dependency)
+            if mtime is None or mtime > self.reference:
+                return False
+        return True
@@ -0,0 +1,123 @@
+"""Read objects from a git repository, without a checkout.
+
+Objects are read through a single long-running ``git cat-file --batch``
+process per repository, which avoids paying for a git process per file.
+"""
+
+import os
+import pathlib
+import subprocess
+import threading
+import typing as T
+
+
+class GitError(Exception):
+    pass
+
+
+class TreeEntry(T.NamedTuple):
+    mode: T.Text
+    type: T.Text
+    oid: T.Text
+    # Relative to the listed tree, with '/' separators
+    path: T.Text
+
+
+class GitRepository:
+    def __init__(self, path: T.Union[T.Text, pathlib.Path]):
+        self.path = str(path)
+        self._batch: T.Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> T.Dict[T.Text, T.Any]:
+        # Worker processes start their own git process.
+        return {'path': self.path}
+
+    def __setstate__(self, state: T.Dict[T.Text, T.Any]) -> None:
+        self.path = state['path']
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'GitRepository':
+        return self
+
+    def __exit__(self, *exc_info: T.Any) -> None:
+        self.close()
+
+    def git(self, *args: T.Text) -> bytes:
+        """Run a git command in the repository, returning its output."""
+        try:
+            process = subprocess.run(
+                ['git', '-C', self.path] + list(args),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            raise GitError("Unable to run git: {}".format(e))
+        if process.returncode:
+            raise GitError("git {} failed: {}".format(
+                ' '.join(args),
+                process.stderr.decode('utf-8', 'replace').strip(),
+            ))
+        return process.stdout
+
+    def rev_parse(self, rev: T.Text) -> T.Text:
+        return self.git('rev-parse', '--verify', rev).decode('ascii').strip()
+
+    def toplevel(self) -> T.Text:
+        """Absolute path of the top of the work tree."""
+        return os.fsdecode(self.git('rev-parse', '--show-toplevel').rstrip(b'\n'))
+
+    def prefix(self) -> T.Text:
+        """Path of the repository's directory relative to the top of the work tree, with a trailing '/'."""
+        return self.git('rev-parse', '--show-prefix').decode('utf-8').strip()
+
+    def ls_tree(self, treeish: T.Text) -> T.Iterator[TreeEntry]:
+        """All blobs (and submodules) below a tree, recursively."""
+        output = self.git('ls-tree', '-r', '-z', '--full-tree', treeish)
+        for record in output.split(b'\0'):
+            if not record:
+                continue
+            info, _, path = record.partition(b'\t')
+            mode, kind, oid = info.decode('ascii').split()
+            yield TreeEntry(mode=mode, type=kind, oid=oid, path=os.fsdecode(path))
+
+    def _batch_process(self) -> subprocess.Popen:
+        if self._batch is None or self._batch.poll() is not None:
+            try:
+                self._batch = subprocess.Popen(
+                    ['git', '-C', self.path, 'cat-file', '--batch'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+            except OSError as e:
+                raise GitError("Unable to run git: {}".format(e))
+        return self._batch
+
+    def read(self, name: T.Text) -> T.Optional[bytes]:
+        """Contents of an object (OID, or REV:PATH), None if missing."""
+        if '\n' in name:
+            raise ValueError("Invalid object name {!r}".format(name))
+        with self._lock:
+            process = self._batch_process()
+            assert process.stdin is not None and process.stdout is not None
+            process.stdin.write(name.encode('utf-8') + b'\n')
+            process.stdin.flush()
+            header = process.stdout.readline()
+            if not header:
+                raise GitError("git cat-file exited unexpectedly")
+            fields = header.split()
+            if len(fields) != 3:
+                # '<name> missing', or '<name> ambiguous'
+                return None
+            size = int(fields[2])
+            data = process.stdout.read(size + 1)
+            return data[:size]
+
+    def close(self) -> None:
+        if self._batch is not None:
+            assert self._batch.stdin is not None and self._batch.stdout is not None
+            self._batch.stdin.close()
+            self._batch.wait()
+            self._batch.stdout.close()
+            self._batch = None
@@ -0,0 +1,169 @@
+"""Assemble profiles against several kernel trees, and report the differences.
+
+The first kernel tree is the reference; for each other tree, and each
+profile, symbols of the resulting configuration are compared:
+
+- unknown: assigned by a fragment, known from the reference tree, but not
+  from this one;
+- vanished: set in the reference configuration, absent from this one
+  (removed, or no longer visible);
+- changed: present in both configurations, with different values.
+"""
+
+import pathlib
+import typing as T
+
+import kconfiglib
+
+from . import core
+from .timings import NO_TIMINGS, Timings
+
+
+UNKNOWN = 'unknown'
+VANISHED = 'vanished'
+CHANGED = 'changed'
+
+
+class ProfileSymbols(T.NamedTuple):
+    kernel: T.Text
+    target: T.Text
+    # Minimal defconfig
+    output: T.Text
+    # Value of each symbol written to the full .config ('n' for unset bool/tristate)
+    values: T.Dict[T.Text, T.Text]
+    # Assigned symbols unknown from the tree
+    unknown: T.List[T.Text]
+
+
+class SymbolChange(T.NamedTuple):
+    kind: T.Text
+    target: T.Text
+    symbol: T.Text
+    kernel: T.Text
+    before: T.Optional[T.Text]
+    after: T.Optional[T.Text]
+
+    def as_dict(self) -> T.Dict[T.Text, T.Any]:
+        return self._asdict()
+
+    def __str__(self) -> str:
+        return '{t}: {k}: {s}: {b} -> {a} ({kernel})'.format(
+            t=self.target,
+            k=self.kind,
+            s=self.symbol,
+            b=self.before if self.before is not None else '-',
+            a=self.after if self.after is not None else '-',
+            kernel=self.kernel,
+        )
+
+
+def config_values(kconf: kconfiglib.Kconfig) -> T.Dict[T.Text, T.Text]:
+    """Symbols of the full configuration (as Kconfig.write_config()), by name."""
+    config = core.parse_config(
+        (sym.config_string for sym in kconf.unique_defined_syms),
+        prefix=kconf.config_prefix,
+    )
+    return {name: 'n' if value is None else value for name, value, _linenr in config.assignments}
+
+
+def _assemble_group(
+        pool: core.KconfPool,
+        group: core.TreeGroup,
+        fail_on_unknown: bool,
+        timings: Timings = NO_TIMINGS,
+) -> T.List[ProfileSymbols]:
+    profiles = group.items
+    kconf = pool.get(group.kernel_sources, group.arch, timings=timings)
+    by_target = dict(profiles)
+    results = []
+    for target, result in core.defconfig_merge_many(
+            kconf=kconf,
+            sources={target: profile.files for target, profile in profiles},
+            fail_on_unknown=fail_on_unknown,
+            fragments=pool.fragments,
+    ):
+        unknown = {
+            name
+            for path in by_target[target].files
+            for name, _value, _linenr in pool.fragments.get(path, prefix=kconf.config_prefix).assignments
+            if name not in kconf.syms or not kconf.syms[name].nodes
+        }
+        results.append(ProfileSymbols(
+            kernel=str(group.kernel_sources),
+            target=target,
+            output=result.output,
+            values=config_values(kconf),
+            unknown=sorted(unknown),
+        ))
+    return results
+
+
+def assemble_matrix(
+        config: core.Configuration,
+        targets: T.List[T.Text],
+        root: pathlib.Path,
+        kernel_sources: T.List[pathlib.Path],
+        fail_on_unknown: bool,
+        extra_include: T.List[T.Text],
+        pool: T.Optional[core.KconfPool] = None,
+        jobs: int = 1,
+) -> T.Dict[T.Tuple[T.Text, T.Text], ProfileSymbols]:
+    """Assemble each profile against each kernel tree; results are keyed by (kernel, profile).
+
+    Profiles are grouped by (kernel, arch), so that each tree is parsed once;
+    with jobs > 1, groups are split over worker processes.
+    """
+    profiles = [
+        (target, core.defconfig_for_target(config=config, target=target, root=root, extra_include=extra_include))
+        for target in targets
+    ]
+    results = core.map_groups(
+        _assemble_group,
+        [group for kernel in kernel_sources for group in core.group_profiles(profiles, kernel)],
+        args=(fail_on_unknown,),
+        pool=pool,
+        jobs=jobs,
+    )
+
+    return {(item.kernel, item.target): item for item in results}
+
+
+def compare_profile(reference: ProfileSymbols, other: ProfileSymbols) -> T.List[SymbolChange]:
+    """Differences of a profile between the reference tree and another one."""
+    changes = []
+    unknown = set(other.unknown) - set(reference.unknown)
+    for name in sorted(unknown):
+        changes.append(SymbolChange(
+            kind=UNKNOWN, target=other.target, symbol=name, kernel=other.kernel,
+            before=reference.values.get(name), after=None,
+        ))
+
+    for name, before in sorted(reference.values.items()):
+        after = other.values.get(name)
+        if after is None:
+            # Symbols which were disabled anyway don't matter.
+            if before != 'n' and name not in unknown:
+                changes.append(SymbolChange(
+                    kind=VANISHED, target=other.target, symbol=name, kernel=other.kernel,
+                    before=before, after=None,
+                ))
+        elif after != before:
+            changes.append(SymbolChange(
+                kind=CHANGED, target=other.target, symbol=name, kernel=other.kernel,
+                before=before, after=after,
+            ))
+    return changes
+
+
+def compare_matrix(
+        matrix: T.Mapping[T.Tuple[T.Text, T.Text], ProfileSymbols],
+        targets: T.List[T.Text],
+        kernel_sources: T.List[pathlib.Path],
+) -> T.List[SymbolChange]:
+    """Compare each profile, on each kernel tree, to its result on the first tree."""
+    reference = str(kernel_sources[0])
+    changes = []
+    for target in targets:
+        for kernel in kernel_sources[1:]:
+            changes.extend(compare_profile(matrix[reference, target], matrix[str(kernel), target]))
+    return changes
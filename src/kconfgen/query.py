@@ -0,0 +1,127 @@
+"""Evaluate a few symbols across profiles.
+
+Profiles are merged on warm trees, sharing the state reached after common
+leading fragments (see core.merge_many()), and read from the fragment cache;
+unlike assemble, no minimal configuration is computed.
+
+The value of a symbol is the one written to the full .config: 'y', 'm' or
+'n' for bool and tristate symbols, the raw value for other types, None if
+the symbol is unknown or not written (e.g. unmet dependencies).
+"""
+
+import fnmatch
+import pathlib
+import typing as T
+
+import kconfiglib
+
+from . import core
+from .timings import NO_TIMINGS, Timings
+
+
+class ProfileValues(T.NamedTuple):
+    target: T.Text
+    arch: T.Text
+    values: T.Dict[T.Text, T.Optional[T.Text]]
+
+
+def select_profiles(config: core.Configuration, patterns: T.List[T.Text]) -> T.List[T.Text]:
+    """Profiles whose names match any of the glob patterns (all profiles if none)."""
+    if not patterns:
+        return sorted(config.profiles)
+    selected = set()
+    for pattern in patterns:
+        matches = fnmatch.filter(config.profiles, pattern)
+        if not matches:
+            raise ValueError("No profile matching {}".format(pattern))
+        selected.update(matches)
+    return sorted(selected)
+
+
+def symbol_name(kconf: kconfiglib.Kconfig, name: T.Text) -> T.Text:
+    """A symbol name, without the config prefix (CONFIG_)."""
+    if name.startswith(kconf.config_prefix):
+        return name[len(kconf.config_prefix):]
+    return name
+
+
+def symbol_value(kconf: kconfiglib.Kconfig, name: T.Text) -> T.Optional[T.Text]:
+    """Value of a symbol in the current configuration, as written to the full .config."""
+    sym = kconf.syms.get(symbol_name(kconf, name))
+    if sym is None or not sym.nodes:
+        return None
+    if sym.orig_type in (kconfiglib.BOOL, kconfiglib.TRISTATE):
+        return sym.str_value
+    if not sym.config_string:
+        return None
+    return sym.str_value
+
+
+def _query_group(
+        pool: core.KconfPool,
+        group: core.TreeGroup,
+        symbols: T.List[T.Text],
+        fail_on_unknown: bool,
+        timings: Timings = NO_TIMINGS,
+) -> T.List[ProfileValues]:
+    profiles = group.items
+    kconf = pool.get(group.kernel_sources, group.arch, timings=timings)
+    by_target = dict(profiles)
+    results = []
+    for target in core.merge_many(
+            kconf=kconf,
+            sources={target: profile.files for target, profile in profiles},
+            fail_on_unknown=fail_on_unknown,
+            fragments=pool.fragments,
+    ):
+        results.append(ProfileValues(
+            target=target,
+            arch=by_target[target].arch,
+            values={name: symbol_value(kconf, name) for name in symbols},
+        ))
+    return results
+
+
+def query_profiles(
+        config: core.Configuration,
+        targets: T.List[T.Text],
+        symbols: T.List[T.Text],
+        root: pathlib.Path,
+        kernel_sources: pathlib.Path,
+        fail_on_unknown: bool,
+        extra_include: T.List[T.Text],
+        pool: T.Optional[core.KconfPool] = None,
+        jobs: int = 1,
+) -> T.List[ProfileValues]:
+    """Values of symbols for each profile, sorted by profile name.
+
+    Profiles are grouped by arch, so that each tree is parsed once; with
+    jobs > 1, groups are split over worker processes.
+    """
+    profiles = [
+        (target, core.defconfig_for_target(config=config, target=target, root=root, extra_include=extra_include))
+        for target in targets
+    ]
+    results = core.map_groups(
+        _query_group,
+        core.group_profiles(profiles, kernel_sources),
+        args=(symbols, fail_on_unknown),
+        pool=pool,
+        jobs=jobs,
+    )
+    return sorted(results, key=lambda item: item.target)
+
+
+def format_table(results: T.List[ProfileValues], symbols: T.List[T.Text]) -> T.Text:
+    """A profile × symbol table, with aligned columns; '-' stands for unknown or unset symbols."""
+    rows = [['PROFILE'] + symbols]
+    for item in results:
+        rows.append([item.target] + [
+            '-' if item.values[name] is None else T.cast(T.Text, item.values[name])
+            for name in symbols
+        ])
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return ''.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + '\n'
+        for row in rows
+    )
@@ -0,0 +1,66 @@
+"""Profiles and fragments as of a git revision, read without a checkout.
+
+All files are read through the repository's ``git cat-file --batch``
+process (see git.GitRepository); fragments of several revisions may be
+assembled on the same warm Kconfig trees.
+"""
+
+import errno
+import os
+import pathlib
+import typing as T
+
+import toml
+
+from . import core
+from .git import GitRepository
+
+
+class GitFragmentCache(core.FragmentCache):
+    """Parsed fragments, read from a git revision instead of the work tree."""
+
+    def __init__(
+            self,
+            repository: GitRepository,
+            commit: T.Text,
+            cache_dir: T.Optional[pathlib.Path] = None,
+    ):
+        super().__init__(cache_dir=cache_dir)
+        self.repository = repository
+        self.commit = commit
+        self.toplevel = os.path.realpath(repository.toplevel())
+        self._revision_parsed: T.Dict[T.Tuple[T.Text, T.Text], core.ConfigFile] = {}
+
+    def read(self, path: T.Union[T.Text, pathlib.Path]) -> bytes:
+        """Contents of a file (path in the work tree) at the revision."""
+        # The file itself may not exist in the work tree.
+        directory, name = os.path.split(os.path.abspath(str(path)))
+        relative = os.path.relpath(os.path.join(os.path.realpath(directory), name), self.toplevel)
+        if relative.startswith(os.pardir):
+            raise ValueError("{} is outside of the git repository {}".format(path, self.toplevel))
+        name = '{}:{}'.format(self.commit, relative.replace(os.sep, '/'))
+        data = self.repository.read(name)
+        if data is None:
+            raise FileNotFoundError(errno.ENOENT, "No such file at revision {}".format(self.commit), str(path))
+        return data
+
+    def get(self, path: pathlib.Path, prefix: T.Text = 'CONFIG_') -> core.ConfigFile:
+        key = (str(path), prefix)
+        if key not in self._revision_parsed:
+            self._revision_parsed[key] = self.parse(self.read(path), prefix)
+        return self._revision_parsed[key]
+
+
+def load_revision(
+        root: pathlib.Path,
+        revision: T.Text,
+        repository: T.Optional[GitRepository] = None,
+        cache_dir: T.Optional[pathlib.Path] = None,
+) -> T.Tuple[core.Configuration, GitFragmentCache]:
+    """The configuration of a profiles repository at a revision, and a reader for its fragments."""
+    if repository is None:
+        repository = GitRepository(root)
+    commit = repository.rev_parse('{}^{{commit}}'.format(revision))
+    fragments = GitFragmentCache(repository, commit, cache_dir=cache_dir)
+    profiles = toml.loads(fragments.read(root / core.PROFILES_FILENAME).decode('utf-8'))
+    return core.load_configuration(profiles), fragments
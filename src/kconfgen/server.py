@@ -0,0 +1,170 @@
+"""A long-lived kconfgen process, keeping Kconfig trees warm between requests.
+
+The protocol is one JSON object per line over a Unix socket: each request
+holds a 'command' (assemble, merge, split) and its arguments; each response
+holds 'ok', and either the command's results or an 'error' message.
+"""
+
+import contextlib
+import io
+import json
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import threading
+import typing as T
+
+from . import core
+
+
+class ServerError(Exception):
+    pass
+
+
+# {{{1 Server
+# ==========
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: pathlib.Path, pool: core.KconfPool):
+        self.socket_path = socket_path
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._tree_locks: T.Dict[T.Tuple[T.Text, T.Text], threading.Lock] = {}
+        super().__init__(str(socket_path), _RequestHandler)
+
+    @contextlib.contextmanager
+    def kconf(self, kernel_sources: pathlib.Path, arch: T.Text) -> T.Iterator[core.kconfiglib.Kconfig]:
+        """Reserve the tree for (kernel_sources, arch) for the current request."""
+        key = (str(kernel_sources), arch)
+        with self._lock:
+            tree_lock = self._tree_locks.setdefault(key, threading.Lock())
+        with tree_lock:
+            yield self.pool.get(kernel_sources, arch)
+
+    def assemble(self, request: T.Mapping[T.Text, T.Any]) -> T.Dict[T.Text, T.Any]:
+        root = pathlib.Path(request['root'])
+        config = core.load_profiles(root, targets=[request['profile']], extra_include=request.get('include', []))
+        profile = core.defconfig_for_target(
+            config=config,
+            target=request['profile'],
+            root=root,
+            extra_include=request.get('include', []),
+        )
+        with self.kconf(pathlib.Path(request['kernel_source']), profile.arch) as kconf:
+            result = core.defconfig_merge(
+                kconf=kconf,
+                sources=profile.files,
+                fail_on_unknown=request.get('fail_on_unknown', False),
+                fragments=self.pool.fragments,
+                artifacts=request.get('artifacts', core.DEFAULT_ARTIFACTS),
+            )
+            files = core.kconfig_files(kconf)
+        return {
+            'arch': profile.arch,
+            'output': result.output,
+            'artifacts': result.artifacts,
+            'nb_symbols': result.stats.nb_symbols,
+            'kconfig_files': [os.path.abspath(path) for path in files],
+        }
+
+    def merge(self, request: T.Mapping[T.Text, T.Any]) -> T.Dict[T.Text, T.Any]:
+        with self.kconf(pathlib.Path(request['kernel_source']), request['arch']) as kconf:
+            result = core.defconfig_merge(
+                kconf=kconf,
+                sources=[pathlib.Path(source) for source in request['sources']],
+                fail_on_unknown=request.get('fail_on_unknown', False),
+                fragments=self.pool.fragments,
+                artifacts=request.get('artifacts', core.DEFAULT_ARTIFACTS),
+            )
+        return {
+            'output': result.output,
+            'artifacts': result.artifacts,
+            'nb_symbols': result.stats.nb_symbols,
+        }
+
+    def split(self, request: T.Mapping[T.Text, T.Any]) -> T.Dict[T.Text, T.Any]:
+        with self.kconf(pathlib.Path(request['kernel_source']), request['arch']) as kconf:
+            stats = core.defconfig_split(
+                kconf=kconf,
+                fail_on_unknown=request.get('fail_on_unknown', False),
+                categories=core.CategoryIndex(request['categories']),
+                destdir=pathlib.Path(request['destdir']),
+                source=io.StringIO(request['source']),
+                prefix=request['prefix'],
+            )
+        return {
+            'nb_symbols': stats.nb_symbols,
+            'files': [str(path) for path in stats.files],
+        }
+
+    def handle_request_data(self, request: T.Mapping[T.Text, T.Any]) -> T.Dict[T.Text, T.Any]:
+        command = request.get('command')
+        if command not in COMMANDS:
+            raise ServerError("Unknown command {!r}".format(command))
+        return T.cast(T.Dict[T.Text, T.Any], getattr(self, command)(request))
+
+
+COMMANDS = ('assemble', 'merge', 'split')
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: Server
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = dict(self.server.handle_request_data(json.loads(line.decode('utf-8'))), ok=True)
+            except Exception as e:
+                response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def serve(socket_path: pathlib.Path, pool: core.KconfPool) -> None:
+    """Serve requests on socket_path until interrupted (SIGINT / SIGTERM)."""
+    if socket_path.is_socket():
+        # Only replace the socket of a dead server.
+        with contextlib.suppress(OSError), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.connect(str(socket_path))
+            raise ServerError("A server is already listening on {}".format(socket_path))
+        socket_path.unlink()
+
+    server = Server(socket_path, pool)
+
+    def shutdown(signum: int, frame: T.Any) -> None:
+        # shutdown() blocks until serve_forever() returns: call it from another thread.
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.unlink(str(socket_path))
+
+
+# {{{1 Client
+# ==========
+
+
+def call(socket_path: pathlib.Path, command: T.Text, **arguments: T.Any) -> T.Dict[T.Text, T.Any]:
+    request = dict(arguments, command=command)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ServerError("No response from {}".format(socket_path))
+    response = T.cast(T.Dict[T.Text, T.Any], json.loads(line.decode('utf-8')))
+    if not response.pop('ok', False):
+        raise ServerError(response.get('error', "Unknown error"))
+    return response
@@ -0,0 +1,122 @@
+"""Deterministic partitioning of profiles across CI nodes.
+
+Profiles are sorted as for assembly (by arch, then fragments), and cut into
+contiguous shards: profiles sharing an arch and leading include groups stay
+on the same shard as far as the balance allows, so that Kconfig trees and
+shared fragment states are reused.
+
+Costs come from the 'profiles' durations of earlier --timings files; each
+profile counts as one unit of time otherwise.
+"""
+
+import json
+import pathlib
+import statistics
+import typing as T
+
+from . import core
+
+
+class Shard(T.NamedTuple):
+    # 1-based
+    number: int
+    total: int
+
+    def __str__(self) -> str:
+        return '{}/{}'.format(self.number, self.total)
+
+
+def parse_shard(text: T.Text) -> Shard:
+    """Parse a 'I/N' shard specification, 1 <= I <= N."""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError("Invalid shard {!r}, expected INDEX/COUNT".format(text))
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard {!r}, expected 1 <= INDEX <= COUNT".format(text))
+    return Shard(number=index, total=count)
+
+
+def load_costs(paths: T.Iterable[pathlib.Path]) -> T.Dict[T.Text, float]:
+    """Duration of each profile, from --timings files of earlier runs."""
+    costs: T.Dict[T.Text, float] = {}
+    for path in paths:
+        with path.open('r', encoding='utf-8') as f:
+            data = json.load(f)
+        costs.update(data.get('profiles', {}))
+    return costs
+
+
+# Shards may cost this much more, or less, than an even share, to cut at a better place.
+TOLERANCE = 0.1
+
+
+def _affinity(left: core.Profile, right: core.Profile) -> T.Tuple[bool, int]:
+    """How much is lost by separating two consecutive profiles."""
+    return (left.arch == right.arch, core.common_prefix(left.files, right.files))
+
+
+def assign_shards(
+        profiles: T.Mapping[T.Text, core.Profile],
+        count: int,
+        costs: T.Optional[T.Mapping[T.Text, float]] = None,
+) -> T.List[T.List[T.Text]]:
+    """Partition profiles into count shards; the result only depends on the arguments.
+
+    Profiles are sorted by arch and fragments, as for assembly, and the list
+    is cut into contiguous shards of similar cost; within TOLERANCE of an
+    even share, cuts are placed between the least related profiles.
+    """
+    known = [costs[target] for target in profiles if costs and target in costs]
+    default = statistics.median(known) if known else 1.0
+    ordered = sorted(
+        profiles,
+        key=lambda target: (profiles[target].arch, [str(path) for path in profiles[target].files], target),
+    )
+    full_costs = [(costs or {}).get(target, default) for target in ordered]
+    # cumulated[i]: cost of the first i profiles
+    cumulated = [0.0]
+    for cost in full_costs:
+        cumulated.append(cumulated[-1] + cost)
+    total = cumulated[-1]
+
+    cuts = [0]
+    for k in range(1, count):
+        ideal = total * k / count
+        window = TOLERANCE * total / count
+        candidates = [
+            i for i in range(cuts[-1], len(ordered) + 1)
+            if abs(cumulated[i] - ideal) <= window
+        ]
+        if not candidates:
+            # Profiles are too expensive to stay within the tolerance.
+            candidates = [min(
+                range(cuts[-1], len(ordered) + 1),
+                key=lambda i: abs(cumulated[i] - ideal),
+            )]
+        cuts.append(min(
+            candidates,
+            key=lambda i: (
+                _affinity(profiles[ordered[i - 1]], profiles[ordered[i]]) if 0 < i < len(ordered) else (False, 0),
+                abs(cumulated[i] - ideal),
+                i,
+            ),
+        ))
+    cuts.append(len(ordered))
+    return [sorted(ordered[start:end]) for start, end in zip(cuts, cuts[1:])]
+
+
+def shard_targets(
+        config: core.Configuration,
+        targets: T.List[T.Text],
+        root: pathlib.Path,
+        extra_include: T.List[T.Text],
+        shard: Shard,
+        costs: T.Optional[T.Mapping[T.Text, float]] = None,
+) -> T.List[T.Text]:
+    """The targets to handle on a shard."""
+    profiles = {
+        target: core.defconfig_for_target(config=config, target=target, root=root, extra_include=extra_include)
+        for target in targets
+    }
+    return assign_shards(profiles, shard.total, costs)[shard.number - 1]
@@ -0,0 +1,176 @@
+"""Kernel sources from archives or git revisions.
+
+kconfiglib only needs the Kconfig files of a kernel tree (and the scripts
+they may call through $(shell,...)): those are extracted from a tarball, or
+read from a git revision, into a minimal tree. With a cache directory, that
+tree is kept, keyed by the archive's hash or the git tree id.
+
+A kernel source is one of:
+
+- a directory;
+- a ``.tar``, ``.tar.gz``, ``.tar.bz2`` or ``.tar.xz`` archive (a single
+  top-level directory, as in kernel.org tarballs, is skipped);
+- ``REV:PATH``: the revision REV of PATH, a directory in a git repository.
+"""
+
+import atexit
+import os
+import pathlib
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import typing as T
+
+from .cache import PickleStore, file_digest, text_digest
+from .git import GitError, GitRepository
+
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def is_kconfig_file(path: T.Text) -> bool:
+    """Whether a file (relative to the top of the kernel tree, '/'-separated) is needed to parse Kconfig."""
+    return posixpath.basename(path).startswith('Kconfig') or path.startswith('scripts/')
+
+
+def _safe_path(name: T.Text) -> T.Optional[T.Text]:
+    """Normalized relative path of an archive member; None if it would escape the tree."""
+    path = posixpath.normpath(name.lstrip('/'))
+    if path == '.' or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+
+def _write(dest: pathlib.Path, path: T.Text, contents: T.Union[bytes, T.IO[bytes]], executable: bool) -> None:
+    target = dest.joinpath(*path.split('/'))
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with target.open('wb') as f:
+        if isinstance(contents, bytes):
+            f.write(contents)
+        else:
+            shutil.copyfileobj(contents, f)
+    if executable:
+        target.chmod(0o755)
+
+
+def extract_archive(archive: pathlib.Path, dest: pathlib.Path) -> int:
+    """Extract the Kconfig files of an archive, streaming through it; returns the number of files."""
+    count = 0
+    with tarfile.open(str(archive), mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            path = _safe_path(member.name)
+            if path is None:
+                continue
+            # Kernel tarballs hold a single top-level directory.
+            relative = path.split('/', 1)[1] if '/' in path else path
+            if not (is_kconfig_file(path) or is_kconfig_file(relative)):
+                continue
+            contents = tar.extractfile(member)
+            assert contents is not None
+            _write(dest, path, contents, executable=bool(member.mode & 0o111))
+            count += 1
+    return count
+
+
+def extract_git(repository: GitRepository, tree: T.Text, dest: pathlib.Path) -> int:
+    """Write the Kconfig files of a git tree to dest; returns the number of files."""
+    count = 0
+    for entry in repository.ls_tree(tree):
+        if entry.type != 'blob' or entry.mode == '120000' or not is_kconfig_file(entry.path):
+            continue
+        contents = repository.read(entry.oid)
+        if contents is None:
+            raise GitError("Missing object {} for {}".format(entry.oid, entry.path))
+        _write(dest, entry.path, contents, executable=entry.mode == '100755')
+        count += 1
+    return count
+
+
+def _top(dest: pathlib.Path) -> pathlib.Path:
+    """The root of the kernel tree within an extracted archive."""
+    if (dest / 'Kconfig').exists():
+        return dest
+    entries = list(dest.iterdir())
+    if len(entries) == 1 and entries[0].is_dir():
+        return entries[0]
+    return dest
+
+
+_temporary_trees: T.List[T.Text] = []
+
+
+@atexit.register
+def _cleanup() -> None:
+    for path in _temporary_trees:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _materialize(
+        key: T.Text,
+        cache_dir: T.Optional[pathlib.Path],
+        extract: T.Callable[[pathlib.Path], T.Any],
+) -> pathlib.Path:
+    """A tree filled by extract(), cached under key."""
+    if cache_dir is None:
+        path = tempfile.mkdtemp(prefix='kconfgen-{}-'.format(key[:16]))
+        _temporary_trees.append(path)
+        extract(pathlib.Path(path))
+        return pathlib.Path(path)
+
+    final = pathlib.Path(cache_dir) / 'sources' / key
+    if not final.exists():
+        final.parent.mkdir(parents=True, exist_ok=True)
+        # Extract next to the final location, then move it in place:
+        # concurrent runs never see a partial tree.
+        tmp = tempfile.mkdtemp(dir=str(final.parent), prefix='.{}.'.format(key))
+        try:
+            extract(pathlib.Path(tmp))
+            os.rename(tmp, str(final))
+        except OSError:
+            if not final.exists():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return final
+
+
+def _archive_digest(archive: pathlib.Path, cache_dir: T.Optional[pathlib.Path]) -> T.Text:
+    """Hash of an archive; remembered by path, mtime and size to avoid hashing large files again."""
+    stat = archive.stat()
+    stamps = PickleStore(pathlib.Path(cache_dir) / 'sources' / 'digests') if cache_dir is not None else None
+    stamp = text_digest(str(archive.absolute()), str(stat.st_mtime_ns), str(stat.st_size))
+    if stamps is not None:
+        digest = stamps.get(stamp)
+        if isinstance(digest, str):
+            return digest
+    digest = file_digest(archive)
+    if stamps is not None:
+        stamps.put(stamp, digest)
+    return digest
+
+
+def resolve_kernel_source(spec: T.Text, cache_dir: T.Optional[pathlib.Path] = None) -> pathlib.Path:
+    """Directory holding the Kconfig files for a kernel source spec (directory, archive, REV:PATH)."""
+    path = pathlib.Path(spec)
+    if path.is_dir():
+        return path
+
+    if path.is_file():
+        if not spec.endswith(ARCHIVE_SUFFIXES):
+            raise ValueError("Unsupported kernel source {}: expected a directory or a {} archive".format(
+                spec, '/'.join(ARCHIVE_SUFFIXES),
+            ))
+        digest = _archive_digest(path, cache_dir)
+        return _top(_materialize('tar-{}'.format(digest), cache_dir, lambda dest: extract_archive(path, dest)))
+
+    if ':' in spec:
+        rev, _, directory = spec.rpartition(':')
+        with GitRepository(directory or '.') as repository:
+            tree = repository.rev_parse('{}:{}'.format(rev, repository.prefix()))
+            return _materialize('git-{}'.format(tree), cache_dir, lambda dest: extract_git(repository, tree, dest))
+
+    # Let the caller report a missing directory.
+    return path
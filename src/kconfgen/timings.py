@@ -0,0 +1,183 @@
+"""Instrumentation of a run: wall time, CPU time and peak memory per phase."""
+
+import contextlib
+import sys
+import time
+import typing as T
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+
+def max_rss() -> T.Optional[int]:
+    """Peak resident memory of the current process, in bytes."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the current process; Linux only.
+
+    This also resets the ru_maxrss reported by max_rss().
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> T.Optional[int]:
+    """Peak resident memory of the current process since the last reset, in bytes; Linux only."""
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class PhaseTotals:
+    __slots__ = ['count', 'wall', 'cpu', 'peak_rss']
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss: T.Optional[int] = None
+
+    def add(self, count: int, wall: float, cpu: float, peak_rss: T.Optional[int] = None) -> None:
+        self.count += count
+        self.wall += wall
+        self.cpu += cpu
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+
+    def as_dict(self) -> T.Dict[T.Text, T.Any]:
+        return {
+            'count': self.count,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'peak_rss': self.peak_rss,
+        }
+
+
+class Timings:
+    """Time spent in each phase of a run, summed over repeated phases.
+
+    Phases are named (parse_kconfig, load_fragment, min_config, ...); the time
+    spent loading each fragment, and assembling each profile, is also kept.
+    Timings collected in worker processes are folded in with merge().
+
+    The peak resident memory of each phase is the highest of its runs: the
+    peak is reset as a phase starts, and read as it ends (Linux only; None
+    elsewhere). Phases running in several threads at once share their peaks.
+    max_rss is the largest peak resident memory of the processes of the run.
+    """
+
+    enabled = True
+
+    def __init__(self) -> None:
+        self.phases: T.Dict[T.Text, PhaseTotals] = {}
+        self.fragments: T.Dict[T.Text, float] = {}
+        self.profiles: T.Dict[T.Text, float] = {}
+        self.max_rss: T.Optional[int] = None
+        # Peak memory of each open phase so far, innermost last
+        self._peaks: T.List[T.Optional[int]] = []
+
+    def _fold_peak(self) -> None:
+        # The peak since the last reset belongs to all open phases, and to the run.
+        peak = peak_rss()
+        self._peaks = [None if current is None or peak is None else max(current, peak) for current in self._peaks]
+        self.add_max_rss(peak)
+
+    @contextlib.contextmanager
+    def phase(self, name: T.Text) -> T.Iterator[None]:
+        self._fold_peak()
+        self._peaks.append(0 if reset_peak_rss() else None)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self._fold_peak()
+            self.add_phase(name, wall=wall, cpu=cpu, peak_rss=self._peaks.pop())
+            self.add_max_rss(max_rss())
+
+    def add_phase(
+            self,
+            name: T.Text,
+            wall: float,
+            cpu: float,
+            count: int = 1,
+            peak_rss: T.Optional[int] = None,
+    ) -> None:
+        self.phases.setdefault(name, PhaseTotals()).add(count, wall, cpu, peak_rss)
+
+    def add_max_rss(self, value: T.Optional[int]) -> None:
+        if value is not None:
+            self.max_rss = max(self.max_rss or 0, value)
+
+    def add_fragment(self, path: T.Text, duration: float) -> None:
+        self.fragments[path] = self.fragments.get(path, 0.0) + duration
+
+    def add_profile(self, name: T.Text, duration: float) -> None:
+        self.profiles[name] = duration
+
+    def merge(self, other: 'Timings') -> None:
+        for name, totals in other.phases.items():
+            self.add_phase(name, wall=totals.wall, cpu=totals.cpu, count=totals.count, peak_rss=totals.peak_rss)
+        self.add_max_rss(other.max_rss)
+        for path, duration in other.fragments.items():
+            self.add_fragment(path, duration)
+        self.profiles.update(other.profiles)
+
+    def as_dict(self) -> T.Dict[T.Text, T.Any]:
+        return {
+            'phases': {name: totals.as_dict() for name, totals in sorted(self.phases.items())},
+            'fragments': dict(sorted(self.fragments.items())),
+            'profiles': dict(sorted(self.profiles.items())),
+            'max_rss': self.max_rss,
+        }
+
+
+class _NoTimings(Timings):
+    """Drop-in Timings which records nothing."""
+
+    enabled = False
+
+    @contextlib.contextmanager
+    def phase(self, name: T.Text) -> T.Iterator[None]:
+        yield
+
+    def add_phase(
+            self,
+            name: T.Text,
+            wall: float,
+            cpu: float,
+            count: int = 1,
+            peak_rss: T.Optional[int] = None,
+    ) -> None:
+        pass
+
+    def add_max_rss(self, value: T.Optional[int]) -> None:
+        pass
+
+    def add_fragment(self, path: T.Text, duration: float) -> None:
+        pass
+
+    def add_profile(self, name: T.Text, duration: float) -> None:
+        pass
+
+
+NO_TIMINGS = _NoTimings()
@@ -0,0 +1,344 @@
+"""Regenerate defconfigs as fragments change.
+
+A Session keeps Kconfig trees warm, and a reverse index from each fragment
+(and profiles.toml, or the files of profiles.d) to the profiles using it;
+when files change, only the affected profiles are assembled again.
+
+Changes are detected with inotify where available (Linux), by polling the
+mtime of watched files otherwise. Watched directories are reported as
+changed when entries are added to, removed from or modified within them.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
+import time
+import typing as T
+
+import kconfiglib
+
+from . import core
+from .cache import write_if_changed
+
+
+# {{{1 File watchers
+# =================
+
+
+def _key(path: T.Union[T.Text, pathlib.Path]) -> T.Text:
+    return os.path.normpath(os.path.abspath(str(path)))
+
+
+class PollingWatcher:
+    """Detect changes by comparing the mtime and size of watched files.
+
+    The mtime of a directory changes when entries are added or removed.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._stamps: T.Dict[T.Text, T.Optional[T.Tuple[int, int]]] = {}
+
+    @staticmethod
+    def _stamp(path: T.Text) -> T.Optional[T.Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def set_paths(self, paths: T.Iterable[T.Text]) -> None:
+        self._stamps = {path: self._stamps.get(path) or self._stamp(path) for path in paths}
+
+    def wait(self, timeout: T.Optional[float]) -> T.Set[T.Text]:
+        """Changed paths; waits up to timeout (None: forever) for a change."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed: T.Set[T.Text] = set()
+            for path, stamp in self._stamps.items():
+                current = self._stamp(path)
+                if current != stamp:
+                    self._stamps[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self) -> None:
+        pass
+
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct('iIII')
+_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class InotifyWatcher:
+    """Detect changes with inotify.
+
+    Directories holding watched files are watched, rather than the files
+    themselves: editors often save by replacing files. Watched directories
+    are watched themselves as well.
+    """
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library('c')
+        if sys.platform != 'linux' or libc_name is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths: T.Set[T.Text] = set()
+        self._directories: T.Dict[int, T.Text] = {}
+
+    def set_paths(self, paths: T.Iterable[T.Text]) -> None:
+        self._paths = set(paths)
+        watched = set(self._directories.values())
+        directories = {os.path.dirname(path) for path in self._paths}
+        directories.update(path for path in self._paths if os.path.isdir(path))
+        for directory in sorted(directories - watched):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue
+                raise OSError(err, os.strerror(err), directory)
+            self._directories[wd] = directory
+
+    def _read(self) -> T.Set[T.Text]:
+        changed: T.Set[T.Text] = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: assume everything changed.
+                    changed.update(self._paths)
+                elif wd in self._directories:
+                    directory = self._directories[wd]
+                    if directory in self._paths:
+                        changed.add(directory)
+                    path = os.path.join(directory, os.fsdecode(name))
+                    if name and path in self._paths:
+                        changed.add(path)
+
+    def wait(self, timeout: T.Optional[float]) -> T.Set[T.Text]:
+        """Changed paths; waits up to timeout (None: forever) for a change."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            changed = self._read() if readable else set()
+            if changed or not readable:
+                return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+Watcher = T.Union[InotifyWatcher, PollingWatcher]
+
+
+def make_watcher(polling: bool = False, interval: float = 0.5) -> Watcher:
+    """An inotify watcher if possible, a polling one otherwise."""
+    if not polling:
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher(interval=interval)
+
+
+# {{{1 Incremental assembly
+# ========================
+
+
+def fragment_index(
+        config: core.Configuration,
+        targets: T.Iterable[T.Text],
+        root: pathlib.Path,
+        extra_include: T.List[T.Text],
+) -> T.Dict[T.Text, T.Set[T.Text]]:
+    """Map each fragment (absolute path) to the profiles using it."""
+    index: T.Dict[T.Text, T.Set[T.Text]] = {}
+    for target in targets:
+        profile = core.defconfig_for_target(config=config, target=target, root=root, extra_include=extra_include)
+        for path in profile.files:
+            index.setdefault(_key(path), set()).add(target)
+    return index
+
+
+class Session:
+    """Profiles assembled on warm trees, regenerated when their inputs change."""
+
+    def __init__(
+            self,
+            root: pathlib.Path,
+            kernel_sources: pathlib.Path,
+            output: T.Callable[[T.Text, T.Text], pathlib.Path],
+            profiles: T.Optional[T.List[T.Text]] = None,
+            fail_on_unknown: bool = False,
+            extra_include: T.Optional[T.List[T.Text]] = None,
+            pool: T.Optional[core.KconfPool] = None,
+            log: T.Optional[T.TextIO] = None,
+    ):
+        self.root = root
+        self.kernel_sources = kernel_sources
+        self.output = output
+        self.selected = profiles
+        self.fail_on_unknown = fail_on_unknown
+        self.extra_include = extra_include or []
+        self.pool = pool or core.KconfPool()
+        self.log = log or sys.stderr
+        self.config_paths = self._config_paths()
+        self.config: T.Optional[core.Configuration] = None
+        self.resolved: T.Dict[T.Text, core.Profile] = {}
+        self.index: T.Dict[T.Text, T.Set[T.Text]] = {}
+
+    def paths(self) -> T.Set[T.Text]:
+        """Files to watch."""
+        return set(self.index) | self.config_paths
+
+    def _config_paths(self) -> T.Set[T.Text]:
+        index = core.profiles_index(self.root)
+        if index is None:
+            return {_key(self.root / core.PROFILES_FILENAME)}
+        # Directories are watched as well, to notice new profiles and groups.
+        directories = [index.path, index.path / 'profile', index.path / 'include']
+        files = [index.core] + list(index.profiles.values()) + list(index.includes.values())
+        return {_key(path) for path in directories + files}
+
+    def _load(self) -> T.List[T.Text]:
+        """(Re)load the profiles; returns profiles whose files changed."""
+        # Files may have been added to profiles.d.
+        self.config_paths = self._config_paths()
+        try:
+            config = core.load_profiles(self.root, targets=self.selected, extra_include=self.extra_include)
+            targets = self.selected if self.selected is not None else sorted(config.profiles)
+            resolved = {
+                target: core.defconfig_for_target(
+                    config=config, target=target, root=self.root, extra_include=self.extra_include,
+                )
+                for target in targets
+            }
+        except (OSError, ValueError, KeyError, core.InvalidConfiguration) as e:
+            self._error(str(self.root), e)
+            return []
+
+        changed = [target for target in targets if resolved[target] != self.resolved.get(target)]
+        self.config = config
+        self.resolved = resolved
+        self.index = fragment_index(config, targets, self.root, self.extra_include)
+        return changed
+
+    def _error(self, source: T.Text, error: Exception) -> None:
+        self.log.write("!!! {}: {}: {}\n".format(source, type(error).__name__, error))
+
+    def start(self) -> T.List[core.ProfileResult]:
+        """Load the configuration, and assemble all profiles."""
+        return self.assemble(self._load())
+
+    def update(self, changed: T.Iterable[T.Text]) -> T.List[core.ProfileResult]:
+        """Assemble profiles affected by changes to some files."""
+        paths = {_key(path) for path in changed}
+        targets: T.Set[T.Text] = set()
+        if paths & self.config_paths:
+            targets.update(self._load())
+        for path in paths:
+            targets.update(self.index.get(path, ()))
+        return self.assemble(sorted(targets))
+
+    def _assemble(self, targets: T.List[T.Text]) -> T.Iterator[core.ProfileResult]:
+        assert self.config is not None
+        return core.assemble_profiles(
+            config=self.config,
+            targets=targets,
+            root=self.root,
+            kernel_sources=self.kernel_sources,
+            fail_on_unknown=self.fail_on_unknown,
+            extra_include=self.extra_include,
+            pool=self.pool,
+        )
+
+    def assemble(self, targets: T.List[T.Text]) -> T.List[core.ProfileResult]:
+        try:
+            results = list(self._assemble(targets))
+        except (OSError, ValueError, kconfiglib.KconfigError) as e:
+            if len(targets) == 1:
+                self._error(targets[0], e)
+                return []
+            # Find out which profiles fail.
+            results = []
+            for target in targets:
+                results.extend(self.assemble([target]))
+            return results
+
+        for item in results:
+            output = self.output(item.target, item.profile.arch)
+            if write_if_changed(output, item.result.output):
+                self.log.write(">>> Written {ns} symbols for {t}.\n".format(
+                    ns=item.result.stats.nb_symbols,
+                    t=item.target,
+                ))
+            else:
+                self.log.write(">>> {t} is unchanged.\n".format(t=item.target))
+        return results
+
+    def run(
+            self,
+            watcher: Watcher,
+            stop: T.Optional[threading.Event] = None,
+            settle: float = 0.02,
+            tick: T.Optional[float] = None,
+    ) -> None:
+        """Watch for changes until stop is set.
+
+        Changes arriving within `settle` seconds of each other (e.g. a
+        `git checkout`) are handled together.
+        """
+        stop = stop or threading.Event()
+        self.start()
+        watcher.set_paths(self.paths())
+        while not stop.is_set():
+            changed = watcher.wait(tick)
+            if not changed:
+                continue
+            while True:
+                more = watcher.wait(settle)
+                if not more:
+                    break
+                changed |= more
+            self.update(changed)
+            # Fragments may have been added or removed.
+            watcher.set_paths(self.paths())
@@ -1,20 +1,62 @@
+import ast
+import concurrent.futures
+import http.server
 import io
+import json
 import os.path
 import pathlib
+import pstats
+import shutil
+import socketserver
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import typing as T
 import unittest
+from unittest import mock
 
 import toml
 
 import kconfgen
+import kconfgen.cache
+import kconfgen.check
+import kconfgen.core
+import kconfgen.depfile
+import kconfgen.git
+import kconfgen.matrix
+import kconfgen.query
+import kconfgen.revision
+import kconfgen.server
+import kconfgen.shard
+import kconfgen.sources
+import kconfgen.watch
 
 
 TESTS_ROOT = os.path.abspath(os.path.dirname(__file__))
 KCONF_ROOT = os.path.join(TESTS_ROOT, 'kconf')
 
 
+def prepare_profiles(
+        workdir: pathlib.Path,
+        config: T.Text,
+        defconfigs: T.Dict[T.Text, T.Text],
+        fragments_dir: T.Text = '',
+):
+    with open(workdir / kconfgen.PROFILES_FILENAME, 'w') as f:
+        f.write(config)
+
+    fragments_path = workdir
+    if fragments_dir:
+        fragments_path = fragments_path / fragments_dir
+        fragments_path.mkdir()
+
+    for fname, contents in defconfigs.items():
+        with open(fragments_path / 'defconfig.{}'.format(fname), 'w') as f:
+            f.write(contents)
+
+
 class KConfGenTestCase(unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -48,6 +90,39 @@ class CoreCliTests(unittest.TestCase):
         self.assertIn(' version', res.stdout)
         self.assertIn(' help', res.stdout)
 
+    def test_lazy_imports(self):
+        res = subprocess.run(
+            [
+                sys.executable, '-c',
+                "import sys; sys.argv = ['kconfgen', 'version']; import kconfgen.cli; kconfgen.cli.main(); "
+                "print(); print(sorted({'kconfiglib', 'toml', 'kconfgen.core'} & set(sys.modules)))",
+            ],
+            stdout=subprocess.PIPE,
+            encoding='utf-8',
+            check=True,
+        )
+        self.assertEqual("kconfgen v{}\n[]\n".format(kconfgen.__version__), res.stdout)
+        # Names are still available from the package.
+        self.assertIs(kconfgen.core.load_configuration, kconfgen.load_configuration)
+
+    def test_exports(self):
+        # The static imports read by type checkers list the same names as _EXPORTS.
+        with open(kconfgen.__file__, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        block = next(
+            node for node in tree.body
+            if isinstance(node, ast.If) and 'TYPE_CHECKING' in ast.dump(node.test)
+        )
+        imported = {
+            node.module: {alias.name for alias in node.names}
+            for node in block.body
+            if isinstance(node, ast.ImportFrom)
+        }
+        self.assertEqual({module: set(names) for module, names in kconfgen._EXPORTS.items()}, imported)
+        for names in kconfgen._EXPORTS.values():
+            for name in names:
+                self.assertTrue(hasattr(kconfgen, name), name)
+
     def test_version(self):
         res = subprocess.run(
             ['kconfgen', 'version'],
@@ -118,25 +193,83 @@ files = ["defconfig.net", "defconfig.net_netfilter"]
                         files=['defconfig.net', 'defconfig.net_netfilter'],
                     ),
                 },
+                groups={
+                    'core': ['defconfig.crypto', 'defconfig.fs'],
+                    'server': ['defconfig.net', 'defconfig.net_netfilter'],
+                },
             ),
             loaded,
         )
 
-    def prepare(self, config: T.Text, defconfigs: T.Dict[T.Text, T.Text], fragments_dir: T.Text = ''):
-        with open(self.workdir / kconfgen.PROFILES_FILENAME, 'w') as f:
-            f.write(config)
+    def test_nested_includes(self):
+        raw = """
+[include.base]
+files = ["crypto", "fs"]
 
-        fragments_path = self.workdir
-        if fragments_dir:
-            fragments_path = fragments_path / fragments_dir
-            fragments_path.mkdir()
+[include.net]
+include = ["base"]
+files = ["net"]
 
-        for fname, contents in defconfigs.items():
-            with open(fragments_path / 'defconfig.{}'.format(fname), 'w') as f:
-                f.write(contents)
+[include.server]
+include = ["base", "net"]
+files = ["fs", "server"]
+
+[profile.example]
+arch = "x86"
+include = ["server", "net"]
+extras = ["example", "crypto"]
+"""
+        config = kconfgen.load_configuration(toml.loads(raw))
+        self.assertEqual(
+            {
+                'base': ['crypto', 'fs'],
+                'net': ['crypto', 'fs', 'net'],
+                'server': ['crypto', 'fs', 'net', 'server'],
+            },
+            config.groups,
+        )
+
+        profile = kconfgen.defconfig_for_target(config, 'example', pathlib.Path('/root'), extra_include=[])
+        self.assertEqual(
+            [
+                pathlib.Path('/root', name)
+                for name in ['crypto', 'fs', 'net', 'server', 'example']
+            ],
+            profile.files,
+        )
+
+        # Configurations built by hand are resolved as well.
+        built = config._replace(groups={})
+        self.assertEqual(profile, kconfgen.defconfig_for_target(built, 'example', pathlib.Path('/root'), []))
+
+    def test_invalid_includes(self):
+        raw = """
+[include.a]
+include = ["b"]
+
+[include.b]
+include = ["c"]
+files = ["defconfig.b"]
+
+[include.c]
+include = ["b"]
+
+[profile.example]
+arch = "x86"
+include = ["a"]
+"""
+        with self.assertRaises(kconfgen.core.InvalidConfiguration) as cm:
+            kconfgen.load_configuration(toml.loads(raw))
+        self.assertEqual((["Include cycle: b -> c -> b"],), cm.exception.args)
+
+        missing = raw.replace('[include.c]\ninclude = ["b"]', '[include.c]\ninclude = ["d"]')
+        with self.assertRaises(kconfgen.core.InvalidConfiguration) as cm:
+            kconfgen.load_configuration(toml.loads(missing))
+        self.assertEqual((["Reference to missing group d in include group c"],), cm.exception.args)
 
     def test_assemble(self):
-        self.prepare(
+        prepare_profiles(
+            self.workdir,
             config="""
 [profile.example]
 arch = "x86"
@@ -173,7 +306,8 @@ CONFIG_PICKLES=y
         self.assertEqual(expected, results)
 
     def test_assemble_subdif(self):
-        self.prepare(
+        prepare_profiles(
+            self.workdir,
             config="""
 [core]
 fragments_dir = "fragments"
@@ -214,7 +348,8 @@ CONFIG_PICKLES=y
         self.assertEqual(expected, results)
 
     def test_assemble_extra_include(self):
-        self.prepare(
+        prepare_profiles(
+            self.workdir,
             config="""
 [profile.example]
 arch = "x86"
@@ -254,8 +389,225 @@ CONFIG_PICKLES=y
 
         self.assertEqual(expected, results)
 
+    MULTI_PROFILES = """
+[profile.vegan]
+arch = "x86"
+include = [ "base" ]
+extras = [ "defconfig.vegan" ]
+
+[profile.cheesy]
+arch = "x86"
+include = [ "base" ]
+extras = [ "defconfig.cheesy" ]
+
+[profile.plain]
+arch = "x86"
+include = [ "base" ]
+
+[include.base]
+files = [ "defconfig.base" ]
+"""
+
+    MULTI_DEFCONFIGS = {
+        'base': "CONFIG_BREAD_POTATO=y\n",
+        'vegan': "CONFIG_DIET_VEGAN=y\nCONFIG_STEAK_SOJA=y\n",
+        'cheesy': "CONFIG_EXTRA_CHEDDAR=y\nCONFIG_SAUCE_BLUE_CHEESE=y\n",
+    }
+
+    MULTI_EXPECTED = {
+        'vegan': "CONFIG_DIET_VEGAN=y\nCONFIG_BREAD_POTATO=y\n",
+        'cheesy': "CONFIG_BREAD_POTATO=y\nCONFIG_EXTRA_CHEDDAR=y\nCONFIG_SAUCE_BLUE_CHEESE=y\n",
+        'plain': "CONFIG_BREAD_POTATO=y\n",
+    }
+
+    def test_assemble_profiles_reuse(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+        config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+        pool = kconfgen.KconfPool()
+
+        results = kconfgen.assemble_profiles(
+            config=config,
+            targets=['vegan', 'cheesy', 'plain'],
+            root=self.workdir,
+            kernel_sources=KCONF_ROOT,
+            fail_on_unknown=True,
+            extra_include=[],
+            pool=pool,
+        )
+        outputs = {item.target: item.result.output for item in results}
+
+        self.assertEqual(self.MULTI_EXPECTED, outputs)
+        # A single tree was parsed for all profiles.
+        self.assertEqual(1, len(pool.trees))
+
+    def test_pool_reset(self):
+        pool = kconfgen.KconfPool()
+        kconf = pool.get(pathlib.Path(KCONF_ROOT), 'x86')
+        kconf.warn_to_stderr = False
+        with open(self.workdir / 'malformed', 'w', encoding='utf-8') as f:
+            f.write("not a valid line\n")
+        kconfgen.defconfig_merge(kconf=kconf, fail_on_unknown=False, sources=[self.workdir / 'malformed'])
+        self.assertNotEqual([], kconf.warnings)
+        # Warnings of a request don't leak into the next one.
+        self.assertEqual([], pool.get(pathlib.Path(KCONF_ROOT), 'x86').warnings)
+
+    def test_pool_eviction(self):
+        pool = kconfgen.KconfPool(max_trees=1)
+        x86 = pool.get(pathlib.Path(KCONF_ROOT), 'x86')
+        self.assertIs(x86, pool.get(pathlib.Path(KCONF_ROOT), 'x86'))
+
+        pool.get(pathlib.Path(KCONF_ROOT), 'arm')
+        self.assertEqual([(KCONF_ROOT, 'arm')], list(pool.trees))
+        self.assertIsNot(x86, pool.get(pathlib.Path(KCONF_ROOT), 'x86'))
+
+    @unittest.skipUnless(sys.platform == 'linux', "Resident memory is only measured on Linux")
+    def test_pool_memory_eviction(self):
+        # Any process is above 1 MiB: only the most recent tree is kept.
+        pool = kconfgen.KconfPool(max_memory=1024 * 1024)
+        for arch in ['x86', 'arm', 'x86', 'arm']:
+            pool.get(pathlib.Path(KCONF_ROOT), arch)
+            self.assertEqual([(KCONF_ROOT, arch)], list(pool.trees))
+
+    def test_assemble_profiles_parallel(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+        config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+
+        results = list(kconfgen.assemble_profiles(
+            config=config,
+            targets=sorted(config.profiles),
+            root=self.workdir,
+            kernel_sources=KCONF_ROOT,
+            fail_on_unknown=True,
+            extra_include=[],
+            jobs=2,
+        ))
+
+        self.assertEqual(
+            self.MULTI_EXPECTED,
+            {item.target: item.result.output for item in results},
+        )
+        for item in results:
+            self.assertNotEqual(os.getpid(), item.worker)
+
+    def test_assemble_all(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+
+        subprocess.check_call([
+            'kconfgen', 'assemble',
+            '--kernel-source', KCONF_ROOT,
+            '--fail-on-unknown',
+            '--root', self.workdir,
+            '--output-dir', self.workdir / 'out',
+            '--output-template', '{arch}-{profile}.defconfig',
+            '--jobs', '2',
+            '--all',
+        ])
+
+        self.assertEqual(
+            {'x86-{}.defconfig'.format(name) for name in self.MULTI_EXPECTED},
+            set(os.listdir(self.workdir / 'out')),
+        )
+        for name, expected in self.MULTI_EXPECTED.items():
+            with open(self.workdir / 'out' / 'x86-{}.defconfig'.format(name), 'r') as f:
+                self.assertEqual(expected, f.read())
+
+    def test_assemble_artifacts(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+        command = [
+            'kconfgen', 'assemble',
+            '--kernel-source', KCONF_ROOT,
+            '--root', self.workdir,
+            '--output-dir', self.workdir / 'out',
+            '--full-config', '{profile}/.config',
+            '--autoconf', '{profile}/autoconf.h',
+            '--depfile', self.workdir / 'out' / 'deps.d',
+            '--no-defconfig',
+            'vegan', 'cheesy',
+        ]
+        subprocess.check_call(command)
+
+        self.assertEqual({'vegan', 'cheesy', 'deps.d'}, set(os.listdir(self.workdir / 'out')))
+        for name in ['vegan', 'cheesy']:
+            self.assertEqual({'.config', 'autoconf.h'}, set(os.listdir(self.workdir / 'out' / name)))
+        with open(self.workdir / 'out' / 'vegan' / 'autoconf.h', 'r') as f:
+            self.assertIn("#define CONFIG_BREAD_POTATO 1\n", f.read())
+        with open(self.workdir / 'out' / 'cheesy' / '.config', 'r') as f:
+            self.assertIn("CONFIG_BREAD_POTATO=y\n", f.read())
+        deps = kconfgen.depfile.read_depfile(self.workdir / 'out' / 'deps.d')
+        self.assertIn(str(self.workdir / 'out' / 'vegan' / 'autoconf.h'), deps.targets())
+
+        res = subprocess.run(
+            [arg if arg != '{profile}/.config' else '.config' for arg in command],
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(2, res.returncode)
+
+    def assemble_with_depfile(self) -> T.Text:
+        return subprocess.run(
+            [
+                'kconfgen', 'assemble',
+                '--kernel-source', KCONF_ROOT,
+                '--root', self.workdir,
+                '--output-dir', self.workdir / 'out',
+                '--depfile', self.workdir / 'out' / 'deps.d',
+                '--if-changed',
+                'vegan', 'cheesy',
+            ],
+            check=True,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        ).stderr
+
+    def test_depfile(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+        self.assemble_with_depfile()
+
+        deps = kconfgen.depfile.read_depfile(self.workdir / 'out' / 'deps.d')
+        vegan = deps.dependencies(str(self.workdir / 'out' / 'vegan_defconfig'))
+        self.assertEqual(
+            [str(self.workdir / name) for name in ['profiles.toml', 'defconfig.base', 'defconfig.vegan']],
+            vegan[:3],
+        )
+        self.assertIn(os.path.join(KCONF_ROOT, 'fillings', 'extras', 'Kconfig'), vegan)
+
+    def test_if_changed(self):
+        prepare_profiles(self.workdir, config=self.MULTI_PROFILES, defconfigs=self.MULTI_DEFCONFIGS)
+        self.assemble_with_depfile()
+        outputs = {
+            name: (self.workdir / 'out' / '{}_defconfig'.format(name)).stat().st_mtime_ns
+            for name in ['vegan', 'cheesy']
+        }
+
+        stderr = self.assemble_with_depfile()
+        self.assertIn("2 profiles up to date", stderr)
+
+        # Only cheesy depends on defconfig.cheesy; its contents don't change.
+        modified = (self.workdir / 'out' / 'deps.d').stat().st_mtime_ns + 1
+        os.utime(self.workdir / 'defconfig.cheesy', ns=(modified, modified))
+        stderr = self.assemble_with_depfile()
+        self.assertIn("1 profiles up to date: vegan", stderr)
+        self.assertIn("Written 3 symbols for cheesy", stderr)
+        self.assertEqual(
+            outputs,
+            {
+                name: (self.workdir / 'out' / '{}_defconfig'.format(name)).stat().st_mtime_ns
+                for name in ['vegan', 'cheesy']
+            },
+        )
+
+        self.assertIn("2 profiles up to date", self.assemble_with_depfile())
+
+    def test_depfile_escape(self):
+        deps = kconfgen.depfile.DepFile(
+            key='k',
+            rules=[(['out put', 'b#'], ['$dep', 'a\\b']), (['c'], [])],
+        )
+        kconfgen.depfile.write_depfile(self.workdir / 'deps.d', deps)
+        self.assertEqual(deps, kconfgen.depfile.read_depfile(self.workdir / 'deps.d'))
+
     def test_bad_config(self):
-        self.prepare(
+        prepare_profiles(
+            self.workdir,
             # Invalid config: no quotes
             config="[profile.example]\narch = x86\nextras=[ defconfig.cheesy ]",
             defconfigs={
@@ -277,6 +629,298 @@ CONFIG_PICKLES=y
         self.assertFalse(os.path.exists(self.workdir / 'output'))
 
 
+class CheckTests(KConfGenTestCase):
+    def check(self, **kwargs):
+        config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+        return kconfgen.check.check_profiles(
+            config=config,
+            targets=sorted(config.profiles),
+            root=self.workdir,
+            kernel_sources=KCONF_ROOT,
+            **kwargs
+        )
+
+    def test_issues(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=dict(
+            AssembleTests.MULTI_DEFCONFIGS,
+            base="CONFIG_BREAD_POTATO=y\nCONFIG_UNKNOWN=y\n",
+            cheesy="CONFIG_EXTRA_CHEDDAR=y\nCONFIG_SAUCE_BLUE_CHEESE=y\nCONFIG_EXTRA_CHEDDAR=y\n",
+        ))
+
+        issues = self.check(jobs=2)
+        self.assertEqual(
+            [
+                ('unknown', 'defconfig.base', 2, 'UNKNOWN', ['cheesy', 'plain', 'vegan']),
+                ('overridden', 'defconfig.cheesy', 1, 'EXTRA_CHEDDAR', ['cheesy']),
+                ('redundant', 'defconfig.vegan', 2, 'STEAK_SOJA', ['vegan']),
+            ],
+            [
+                (issue.kind, os.path.basename(issue.path), issue.linenr, issue.symbol, issue.profiles)
+                for issue in issues
+            ],
+        )
+
+    def test_errors(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs={
+            'base': "CONFIG_BREAD_POTATO=y\n",
+            'vegan': "CONFIG_DIET_VEGAN=y\n",
+        })
+        (self.workdir / 'out').mkdir()
+        with open(self.workdir / 'out' / 'plain_defconfig', 'w', encoding='utf-8') as f:
+            f.write(AssembleTests.MULTI_EXPECTED['plain'])
+        with open(self.workdir / 'out' / 'vegan_defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_DIET_VEGETARIAN=y\n")
+
+        issues = self.check(outputs={
+            name: self.workdir / 'out' / '{}_defconfig'.format(name)
+            for name in ['plain', 'vegan']
+        })
+        self.assertEqual(
+            [
+                ('error', str(self.workdir / 'defconfig.cheesy'), ['cheesy']),
+                ('outdated', str(self.workdir / 'out' / 'vegan_defconfig'), ['vegan']),
+            ],
+            [(issue.kind, issue.path, issue.profiles) for issue in issues],
+        )
+
+    def test_cli(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=dict(
+            AssembleTests.MULTI_DEFCONFIGS,
+            vegan="CONFIG_DIET_VEGAN=y\n",
+        ))
+        subprocess.check_call(['kconfgen', 'check', '--kernel-source', KCONF_ROOT, '--root', self.workdir])
+
+        with open(self.workdir / 'defconfig.vegan', 'a', encoding='utf-8') as f:
+            f.write("# CONFIG_SIDE_FRIES_LOADED is not set\n")
+        res = subprocess.run(
+            ['kconfgen', 'check', '--kernel-source', KCONF_ROOT, '--root', self.workdir, '--format', 'json'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.assertEqual(1, res.returncode)
+        issues = json.loads(res.stdout)
+        self.assertEqual(['redundant'], [issue['kind'] for issue in issues])
+        self.assertEqual(2, issues[0]['linenr'])
+
+
+class MatrixTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        # A newer kernel: EXTRA_CHEDDAR was removed, SAUCE_KETCHUP depends on PICKLES, mayo is the default.
+        self.upgraded = self.workdir / 'linux'
+        shutil.copytree(KCONF_ROOT, str(self.upgraded))
+        for path, old, new in [
+                ('fillings/Kconfig', 'config EXTRA_CHEDDAR', 'config OTHER_CHEDDAR'),
+                ('fillings/extras/Kconfig', '"Ketchup"\n', '"Ketchup"\n    depends on PICKLES\n'),
+                ('fillings/extras/Kconfig', '"Mayo"\n    default n', '"Mayo"\n    default y'),
+        ]:
+            with open(self.upgraded / path, 'r', encoding='utf-8') as f:
+                contents = f.read()
+            with open(self.upgraded / path, 'w', encoding='utf-8') as f:
+                f.write(contents.replace(old, new))
+
+    def test_matrix(self):
+        config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+        kernels = [pathlib.Path(KCONF_ROOT), self.upgraded]
+        pool = kconfgen.KconfPool()
+        results = kconfgen.matrix.assemble_matrix(
+            config=config,
+            targets=['cheesy', 'plain'],
+            root=self.workdir,
+            kernel_sources=kernels,
+            fail_on_unknown=False,
+            extra_include=[],
+            pool=pool,
+        )
+        self.assertEqual(AssembleTests.MULTI_EXPECTED['cheesy'], results[KCONF_ROOT, 'cheesy'].output)
+        self.assertEqual(2, len(pool.trees))
+
+        changes = kconfgen.matrix.compare_matrix(results, ['cheesy', 'plain'], kernels)
+        self.assertEqual(
+            [
+                ('cheesy', 'unknown', 'EXTRA_CHEDDAR', 'y', None),
+                ('cheesy', 'vanished', 'SAUCE_KETCHUP', 'y', None),
+                ('cheesy', 'changed', 'SAUCE_MAYO', 'n', 'y'),
+                ('plain', 'vanished', 'SAUCE_KETCHUP', 'y', None),
+                ('plain', 'changed', 'SAUCE_MAYO', 'n', 'y'),
+            ],
+            [(change.target, change.kind, change.symbol, change.before, change.after) for change in changes],
+        )
+
+    def test_cli(self):
+        output = subprocess.check_output(
+            [
+                'kconfgen', 'matrix',
+                '--kernel-source', KCONF_ROOT,
+                '--kernel-source', self.upgraded,
+                '--root', self.workdir,
+                '--format', 'json',
+                '--jobs', '2',
+                'plain',
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+        self.assertEqual(
+            [('vanished', 'SAUCE_KETCHUP'), ('changed', 'SAUCE_MAYO')],
+            [(change['kind'], change['symbol']) for change in json.loads(output)],
+        )
+
+    def test_cli_fail_on_unknown(self):
+        # EXTRA_CHEDDAR is gone from the upgraded tree.
+        process = subprocess.run(
+            [
+                'kconfgen', 'matrix',
+                '--kernel-source', KCONF_ROOT,
+                '--kernel-source', self.upgraded,
+                '--root', self.workdir,
+                '--fail-on-unknown',
+                'cheesy',
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(1, process.returncode)
+        self.assertIn(b'Error: Unknown symbols', process.stderr)
+        self.assertNotIn(b'Traceback', process.stderr)
+
+
+class ShardTests(unittest.TestCase):
+    PROFILES = {
+        '{}-{}{}'.format(arch, family, i): kconfgen.core.Profile(
+            arch=arch,
+            files=[pathlib.Path('base'), pathlib.Path(family), pathlib.Path('extra{}'.format(i))],
+        )
+        for arch in ['arm', 'x86']
+        for family in ['a', 'b', 'c']
+        for i in range(4)
+    }
+
+    def test_partition(self):
+        shards = kconfgen.shard.assign_shards(self.PROFILES, 4)
+        self.assertEqual(sorted(self.PROFILES), sorted(target for shard in shards for target in shard))
+        self.assertEqual([6, 6, 6, 6], [len(shard) for shard in shards])
+        # Shards are cut between families.
+        for shard in shards:
+            self.assertLessEqual(len({target[:-1] for target in shard}), 2)
+        self.assertEqual(shards, kconfgen.shard.assign_shards(dict(reversed(list(self.PROFILES.items()))), 4))
+
+    def test_costs(self):
+        costs = {target: 1.0 for target in self.PROFILES}
+        costs['arm-a0'] = 11.0
+        shards = kconfgen.shard.assign_shards(self.PROFILES, 2, costs)
+        loads = [sum(costs[target] for target in shard) for shard in shards]
+        self.assertLessEqual(max(loads), 17 * (1 + kconfgen.shard.TOLERANCE))
+        # Without costs, the first shard would hold all 'arm' profiles.
+        self.assertLess(len(shards[0]), 12)
+        self.assertIn('arm-a1', [shard for shard in shards if 'arm-a0' in shard][0])
+
+    def test_parse(self):
+        self.assertEqual(kconfgen.shard.Shard(2, 3), kconfgen.shard.parse_shard('2/3'))
+        for invalid in ['0/3', '4/3', '1', 'a/b']:
+            with self.assertRaises(ValueError):
+                kconfgen.shard.parse_shard(invalid)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            self.workdir = pathlib.Path(workdir)
+            prepare_profiles(
+                self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS,
+            )
+            for index in [1, 2]:
+                subprocess.check_call([
+                    'kconfgen', 'assemble',
+                    '--kernel-source', KCONF_ROOT,
+                    '--root', self.workdir,
+                    '--output-dir', self.workdir / 'out{}'.format(index),
+                    '--shard', '{}/2'.format(index),
+                    '--all',
+                ])
+            generated = os.listdir(self.workdir / 'out1') + os.listdir(self.workdir / 'out2')
+            self.assertEqual(
+                sorted('{}_defconfig'.format(name) for name in AssembleTests.MULTI_EXPECTED),
+                sorted(generated),
+            )
+
+
+class WatchTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        self.log = io.StringIO()
+        self.session = kconfgen.watch.Session(
+            root=self.workdir,
+            kernel_sources=KCONF_ROOT,
+            output=lambda profile, arch: self.workdir / 'out' / profile,
+            log=self.log,
+        )
+
+    def test_update(self):
+        self.assertEqual(['cheesy', 'plain', 'vegan'], sorted(item.target for item in self.session.start()))
+        self.assertEqual(
+            {'cheesy', 'plain', 'vegan'},
+            self.session.index[str(self.workdir / 'defconfig.base')],
+        )
+
+        with open(self.workdir / 'defconfig.cheesy', 'a', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+        results = self.session.update([self.workdir / 'defconfig.cheesy'])
+        self.assertEqual(['cheesy'], [item.target for item in results])
+        with open(self.workdir / 'out' / 'cheesy', 'r', encoding='utf-8') as f:
+            self.assertIn("CONFIG_SIDE_SALAD=y\n", f.read())
+        # A single tree was parsed.
+        self.assertEqual(1, len(self.session.pool.trees))
+
+        # Errors are reported, without stopping the session.
+        os.unlink(self.workdir / 'defconfig.vegan')
+        results = self.session.update([self.workdir / 'defconfig.base', self.workdir / 'defconfig.vegan'])
+        self.assertEqual(['cheesy', 'plain'], sorted(item.target for item in results))
+        self.assertIn("!!! vegan: FileNotFoundError", self.log.getvalue())
+
+    def test_config_change(self):
+        self.session.start()
+        with open(self.workdir / kconfgen.PROFILES_FILENAME, 'a', encoding='utf-8') as f:
+            f.write('[profile.other]\narch = "x86"\nextras = [ "defconfig.other" ]\n')
+        with open(self.workdir / 'defconfig.other', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+
+        results = self.session.update([self.workdir / kconfgen.PROFILES_FILENAME])
+        self.assertEqual(['other'], [item.target for item in results])
+        self.assertIn(str(self.workdir / 'defconfig.other'), self.session.paths())
+
+    def assert_watcher(self, watcher):
+        path = str(self.workdir / 'defconfig.vegan')
+        directory = self.workdir / 'profiles.d'
+        directory.mkdir()
+        watcher.set_paths([path, str(self.workdir / 'defconfig.base')])
+        self.assertEqual(set(), watcher.wait(0.05))
+
+        # Editors often replace files
+        with open(self.workdir / 'defconfig.new', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_DIET_VEGAN=y\n")
+        os.replace(self.workdir / 'defconfig.new', path)
+        self.assertEqual({path}, watcher.wait(2))
+
+        # Directories report new entries
+        watcher.set_paths([path, str(directory)])
+        self.assertEqual(set(), watcher.wait(0.05))
+        with open(directory / 'new.toml', 'w', encoding='utf-8') as f:
+            f.write('arch = "x86"\n')
+        self.assertEqual({str(directory)}, watcher.wait(2))
+        watcher.close()
+
+    def test_polling(self):
+        self.assert_watcher(kconfgen.watch.PollingWatcher(interval=0.01))
+
+    def test_inotify(self):
+        try:
+            watcher = kconfgen.watch.InotifyWatcher()
+        except OSError:
+            self.skipTest("inotify is not available")
+        self.assert_watcher(watcher)
+
+
 class MergeTests(KConfGenTestCase):
     def assert_merge_result(
         self,
@@ -345,6 +989,259 @@ CONFIG_CHEDDAR=y""",
             generated = ''.join(f)
         self.assertEqual("CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n", generated)
 
+    def test_artifacts(self):
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n")
+
+        result = kconfgen.defconfig_merge(
+            kconf=self.kconf,
+            fail_on_unknown=True,
+            sources=[self.workdir / 'defconfig'],
+            artifacts=['config', 'autoconf', 'json'],
+        )
+        self.assertEqual('', result.output)
+        self.assertEqual({'config', 'autoconf', 'json'}, set(result.artifacts))
+
+        # Same contents as kconfiglib's own writers.
+        self.kconf.write_config(str(self.workdir / '.config'), header='')
+        self.kconf.write_autoconf(str(self.workdir / 'autoconf.h'), header='')
+        with open(self.workdir / '.config', 'r') as f:
+            self.assertEqual(f.read(), result.artifacts['config'])
+        with open(self.workdir / 'autoconf.h', 'r') as f:
+            self.assertEqual(f.read(), result.artifacts['autoconf'])
+
+        values = json.loads(result.artifacts['json'])
+        self.assertEqual('y', values['CONFIG_SIDE_SALAD'])
+        self.assertEqual('n', values['CONFIG_SIDE_FRIES'])
+
+        with self.assertRaises(ValueError):
+            kconfgen.defconfig_merge(kconf=self.kconf, fail_on_unknown=True, sources=[], artifacts=['autoconf.h'])
+
+    def test_cli_artifacts(self):
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+
+        command = [
+            'kconfgen', 'merge',
+            '--kernel-source', KCONF_ROOT,
+            '--arch', 'x86',
+            self.workdir / 'defconfig',
+            '--output', self.workdir / 'defconfig_merged',
+            '--autoconf', self.workdir / 'include' / 'generated' / 'autoconf.h',
+            '--symbols-json', self.workdir / 'symbols.json',
+        ]
+        subprocess.check_call(command)
+        with open(self.workdir / 'defconfig_merged', 'r') as f:
+            self.assertEqual("CONFIG_SIDE_SALAD=y\n", f.read())
+        with open(self.workdir / 'include' / 'generated' / 'autoconf.h', 'r') as f:
+            self.assertIn("#define CONFIG_SIDE_SALAD 1\n", f.read())
+        with open(self.workdir / 'symbols.json', 'r') as f:
+            self.assertEqual('y', json.load(f)['CONFIG_SIDE_SALAD'])
+
+        res = subprocess.run(command[:7] + ['--no-defconfig'], stderr=subprocess.PIPE)
+        self.assertEqual(2, res.returncode)
+
+    def test_timings(self):
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+        timings = kconfgen.Timings()
+
+        result = kconfgen.defconfig_merge(
+            kconf=self.kconf,
+            fail_on_unknown=True,
+            sources=[self.workdir / 'defconfig', self.workdir / 'defconfig'],
+            timings=timings,
+        )
+
+        self.assertIs(timings, result.stats.timings)
+        self.assertEqual(2, timings.phases['load_fragment'].count)
+        self.assertEqual(1, timings.phases['min_config'].count)
+        self.assertEqual([str(self.workdir / 'defconfig')], list(timings.fragments))
+
+    @unittest.skipUnless(sys.platform == 'linux', "Peak memory per phase is only measured on Linux")
+    def test_timings_memory(self):
+        size = 64 * 1024 * 1024
+        timings = kconfgen.Timings()
+        with timings.phase('outer'):
+            with timings.phase('allocate'):
+                data = b'x' * size
+            del data
+            with timings.phase('small'):
+                pass
+
+        phases = timings.phases
+        self.assertGreaterEqual(phases['allocate'].peak_rss, size)
+        # The peak of a phase covers the phases within it.
+        self.assertGreaterEqual(phases['outer'].peak_rss, phases['allocate'].peak_rss)
+        self.assertLess(phases['small'].peak_rss, phases['allocate'].peak_rss - size // 2)
+        self.assertGreaterEqual(timings.max_rss, phases['allocate'].peak_rss)
+
+    def test_cli_timings(self):
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+
+        subprocess.check_call([
+            'kconfgen', 'merge',
+            '--kernel-source', KCONF_ROOT,
+            '--arch', 'x86',
+            '--timings={}'.format(self.workdir / 'timings.json'),
+            '--profile-out', self.workdir / 'profile.pstats',
+            '--output', self.workdir / 'defconfig_merged',
+            self.workdir / 'defconfig',
+        ])
+
+        with open(self.workdir / 'timings.json', 'r') as f:
+            timings = json.load(f)
+        self.assertEqual(
+            {'apply_fragment', 'load_fragment', 'min_config', 'parse_kconfig', 'total', 'write_output'},
+            set(timings['phases']),
+        )
+        self.assertGreater(timings['phases']['total']['wall'], 0)
+        if sys.platform != 'win32':
+            self.assertGreater(timings['max_rss'], 0)
+        if sys.platform == 'linux':
+            self.assertGreater(timings['phases']['parse_kconfig']['peak_rss'], 0)
+            self.assertLessEqual(timings['phases']['parse_kconfig']['peak_rss'], timings['max_rss'])
+        self.assertIn(str(self.workdir / 'defconfig'), timings['fragments'])
+        self.assertTrue(pstats.Stats(str(self.workdir / 'profile.pstats')).total_calls)
+
+
+class ConfigFileTests(KConfGenTestCase):
+    SAMPLE = """
+# A comment
+CONFIG_DIET_VEGETARIAN=y
+CONFIG_STEAK_SOJA=y
+# CONFIG_CHEDDAR is not set
+CONFIG_EXTRA_CHEDDAR=y
+CONFIG_UNKNOWN=m
+CONFIG_PICKLES=maybe
+CONFIG_SAUCE_MAYO=y\t
+not a valid line
+"""
+
+    def test_parse(self):
+        parsed = kconfgen.parse_config(io.StringIO(self.SAMPLE))
+        self.assertEqual(
+            [
+                ('DIET_VEGETARIAN', 'y', 3),
+                ('STEAK_SOJA', 'y', 4),
+                ('CHEDDAR', None, 5),
+                ('EXTRA_CHEDDAR', 'y', 6),
+                ('UNKNOWN', 'm', 7),
+                ('PICKLES', 'maybe', 8),
+                ('SAUCE_MAYO', 'y', 9),
+            ],
+            parsed.assignments,
+        )
+        self.assertEqual([(10, 'not a valid line')], parsed.malformed)
+
+    def test_same_as_kconfiglib(self):
+        path = self.workdir / '.config'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.SAMPLE)
+
+        self.kconf.warn = False
+        self.kconf.load_config(str(path))
+        expected = (kconfgen.min_config(self.kconf), list(self.kconf.missing_syms))
+
+        kconfgen.reset_kconf(self.kconf)
+        kconfgen.apply_config(
+            self.kconf,
+            kconfgen.parse_config(io.StringIO(self.SAMPLE)),
+            filename=str(path),
+            replace=True,
+        )
+        self.assertEqual(expected, (kconfgen.min_config(self.kconf), self.kconf.missing_syms))
+        self.assertEqual("CONFIG_DIET_VEGETARIAN=y\n# CONFIG_CHEDDAR is not set\nCONFIG_SAUCE_MAYO=y\n", expected[0])
+
+
+class MergeManyTests(KConfGenTestCase):
+    FRAGMENTS = {
+        'base': "CONFIG_BREAD_POTATO=y\n",
+        'veggie': "CONFIG_DIET_VEGETARIAN=y\n",
+        'soja': "CONFIG_STEAK_SOJA=y\n",
+        'cheese': "CONFIG_EXTRA_CHEDDAR=y\nCONFIG_SIDE_FRIES_LOADED=y\n",
+        'sauces': "CONFIG_SAUCE_MAYO=y\n# CONFIG_SAUCE_KETCHUP is not set\n",
+    }
+
+    PROFILES = {
+        'veggie': ['base', 'veggie', 'soja'],
+        'veggie_sauces': ['base', 'veggie', 'soja', 'sauces'],
+        'veggie_cheese': ['base', 'veggie', 'cheese'],
+        'cheese': ['base', 'cheese'],
+        'cheese_sauces': ['base', 'cheese', 'sauces'],
+        'sauces': ['sauces'],
+        'base': ['base'],
+    }
+
+    def setUp(self):
+        super().setUp()
+        for name, contents in self.FRAGMENTS.items():
+            with open(self.workdir / name, 'w', encoding='utf-8') as f:
+                f.write(contents)
+        self.sources = {
+            profile: [self.workdir / name for name in names]
+            for profile, names in self.PROFILES.items()
+        }
+
+    def test_same_as_merge(self):
+        expected = {}
+        for profile, files in self.sources.items():
+            kconfgen.reset_kconf(self.kconf)
+            expected[profile] = kconfgen.defconfig_merge(self.kconf, files, fail_on_unknown=True)
+
+        with mock.patch.object(kconfgen.core, '_merge_file', wraps=kconfgen.core._merge_file) as merge_file:
+            results = dict(kconfgen.defconfig_merge_many(self.kconf, self.sources, fail_on_unknown=True))
+
+        self.assertEqual(expected, results)
+        # Shared prefixes are only merged once: base, veggie, soja, sauces, cheese, cheese, sauces, sauces
+        self.assertEqual(8, merge_file.call_count)
+
+    def test_snapshot(self):
+        kconfgen.defconfig_merge(self.kconf, self.sources['veggie_cheese'], fail_on_unknown=True)
+        snapshot = kconfgen.snapshot_kconf(self.kconf)
+        expected = kconfgen.min_config(self.kconf)
+
+        kconfgen.defconfig_merge(self.kconf, self.sources['sauces'], fail_on_unknown=True)
+        self.assertNotEqual(expected, kconfgen.min_config(self.kconf))
+
+        kconfgen.restore_kconf(self.kconf, snapshot)
+        self.assertEqual(expected, kconfgen.min_config(self.kconf))
+
+
+class FragmentCacheTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = self.workdir / 'defconfig.sides'
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+
+    def test_parsed_once(self):
+        fragments = kconfgen.FragmentCache()
+        with mock.patch.object(kconfgen.core, 'parse_config', wraps=kconfgen.core.parse_config) as parse:
+            for _i in range(3):
+                kconfgen.reset_kconf(self.kconf)
+                result = kconfgen.defconfig_merge(self.kconf, [self.path], fail_on_unknown=True, fragments=fragments)
+                self.assertEqual("CONFIG_SIDE_SALAD=y\n", result.output)
+        self.assertEqual(1, parse.call_count)
+
+    def test_changed(self):
+        fragments = kconfgen.FragmentCache()
+        fragments.get(self.path)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\nCONFIG_INVALID=y\n")
+
+        with self.assertRaises(ValueError):
+            kconfgen.defconfig_merge(self.kconf, [self.path], fail_on_unknown=True, fragments=fragments)
+
+    def test_on_disk(self):
+        cache_dir = self.workdir / 'cache'
+        expected = kconfgen.FragmentCache(cache_dir=cache_dir).get(self.path)
+
+        with mock.patch.object(kconfgen.core, 'parse_config', wraps=kconfgen.core.parse_config) as parse:
+            self.assertEqual(expected, kconfgen.FragmentCache(cache_dir=cache_dir).get(self.path))
+        self.assertEqual(0, parse.call_count)
+
 
 class SplitTests(KConfGenTestCase):
 
@@ -424,6 +1321,44 @@ CONFIG_STEAK_CHICKEN=y
             },
         )
 
+    def test_split_rules(self):
+        self.assert_category_expansion(
+            source="""CONFIG_SIDE_SALAD=y
+CONFIG_BREAD_POTATO=y
+CONFIG_STEAK_CHICKEN=y
+CONFIG_EXTRA_CHEDDAR=y
+CONFIG_SAUCE_MAYO=y
+CONFIG_PICKLES=y""",
+            categories=[
+                '# Comments are ignored',
+                '',
+                'toppings = fillings/*/Kconfig',
+                'sauces=symbol:SAUCE_*',
+                'fillings',
+            ],
+            expected={
+                'defconfig': 'CONFIG_SIDE_SALAD=y\nCONFIG_BREAD_POTATO=y\n',
+                'defconfig.fillings': 'CONFIG_EXTRA_CHEDDAR=y\nCONFIG_STEAK_CHICKEN=y\n',
+                'defconfig.sauces': 'CONFIG_SAUCE_MAYO=y\n',
+                'defconfig.toppings': 'CONFIG_PICKLES=y\n',
+            },
+        )
+
+    def test_category_index(self):
+        index = kconfgen.CategoryIndex([
+            'drivers', 'drivers/net', 'drivers/net/wireless', 'net', 'wifi=*/wireless/intel/*',
+        ])
+
+        self.assertEqual(['', 'drivers', 'drivers/net', 'drivers/net/wireless', 'net', 'wifi'], index.names)
+        self.assertEqual('', index.for_filename('Kconfig'))
+        self.assertEqual('', index.for_filename('arch/x86/Kconfig'))
+        self.assertEqual('drivers', index.for_filename('drivers/Kconfig'))
+        self.assertEqual('drivers/net', index.for_filename('drivers/net/Kconfig'))
+        self.assertEqual('drivers/net', index.for_filename('drivers/network/Kconfig'))
+        self.assertEqual('drivers/net/wireless', index.for_filename('drivers/net/wireless/Kconfig'))
+        self.assertEqual('wifi', index.for_filename('drivers/net/wireless/intel/iwlwifi/Kconfig'))
+        self.assertEqual('net', index.for_filename('net/Kconfig'))
+
     def test_cli(self):
         with open(self.workdir / 'categories', 'w', encoding='utf-8') as f:
             f.write('bread\nfillings/extras')
@@ -460,3 +1395,749 @@ CONFIG_PICKLES=y""")
             with open(self.workdir / 'generated' / filename, 'r') as f:
                 actual_contents = ''.join(f)
             self.assertEqual(contents, actual_contents)
+
+    def test_unchanged(self):
+        source = 'CONFIG_SIDE_SALAD=y\nCONFIG_PICKLES=y\n'
+        self.assert_category_expansion(
+            source=source,
+            categories=['fillings'],
+            expected={'defconfig': 'CONFIG_SIDE_SALAD=y\n', 'defconfig.fillings': 'CONFIG_PICKLES=y\n'},
+        )
+        os.utime(str(self.workdir / 'defconfig'), ns=(0, 0))
+        os.utime(str(self.workdir / 'defconfig.fillings'), ns=(0, 0))
+
+        stats = kconfgen.defconfig_split(
+            kconf=self.kconf,
+            fail_on_unknown=True,
+            categories=['fillings'],
+            destdir=self.workdir,
+            source=io.StringIO(source.replace('PICKLES', 'SAUCE_MAYO')),
+            prefix='defconfig',
+        )
+        self.assertEqual([self.workdir / 'defconfig'], stats.unchanged)
+        self.assertEqual(0, (self.workdir / 'defconfig').stat().st_mtime_ns)
+        self.assertNotEqual(0, (self.workdir / 'defconfig.fillings').stat().st_mtime_ns)
+
+    def test_split_many(self):
+        sources = {
+            'salad': 'CONFIG_SIDE_SALAD=y\nCONFIG_PICKLES=y\n',
+            'bread': 'CONFIG_BREAD_POTATO=y\n',
+            'cheese': 'CONFIG_EXTRA_CHEDDAR=y\n',
+        }
+        for name, contents in sources.items():
+            with open(self.workdir / name, 'w', encoding='utf-8') as f:
+                f.write(contents)
+        jobs = kconfgen.core.parse_split_jobs([
+            '# source arch destdir [prefix]',
+            'salad x86 out/salad',
+            '',
+            'bread x86 out/bread bread',
+            "cheese arm 'out/cheese board' ",
+        ])
+        jobs = [
+            job._replace(source=self.workdir / job.source, destdir=self.workdir / job.destdir)
+            for job in jobs
+        ]
+        with self.assertRaises(ValueError):
+            kconfgen.core.parse_split_jobs(['salad x86'])
+
+        pool = kconfgen.KconfPool()
+        for parallel in [1, 2]:
+            results = kconfgen.core.defconfig_split_many(
+                sources=jobs,
+                kernel_sources=KCONF_ROOT,
+                categories=['fillings'],
+                fail_on_unknown=True,
+                pool=pool,
+                jobs=parallel,
+            )
+            stats = {job.source.name: stats for job, stats in results}
+            self.assertEqual(
+                [self.workdir / 'out' / 'bread' / name for name in ['bread', 'bread.fillings']],
+                stats['bread'].files,
+            )
+            # Outputs were already up to date on the second run.
+            self.assertEqual(parallel > 1, bool(stats['bread'].unchanged))
+
+        with open(self.workdir / 'out' / 'salad' / 'defconfig.fillings', 'r', encoding='utf-8') as f:
+            self.assertEqual('CONFIG_PICKLES=y\n', f.read())
+        with open(self.workdir / 'out' / 'cheese board' / 'defconfig.fillings', 'r', encoding='utf-8') as f:
+            self.assertEqual('CONFIG_EXTRA_CHEDDAR=y\n', f.read())
+        self.assertEqual({KCONF_ROOT}, {kernel for kernel, _arch in pool.trees})
+        self.assertEqual(['arm', 'x86'], sorted(arch for _kernel, arch in pool.trees))
+
+    def test_cli_batch(self):
+        with open(self.workdir / 'categories', 'w', encoding='utf-8') as f:
+            f.write('fillings\n')
+        with open(self.workdir / 'salad', 'w', encoding='utf-8') as f:
+            f.write('CONFIG_SIDE_SALAD=y\nCONFIG_PICKLES=y\n')
+        with open(self.workdir / 'batch', 'w', encoding='utf-8') as f:
+            f.write('salad x86 out/a\nsalad arm out/b salad\n')
+
+        command = [
+            'kconfgen', 'split',
+            '--kernel-source', KCONF_ROOT,
+            '--categories', self.workdir / 'categories',
+            '--batch', self.workdir / 'batch',
+        ]
+        res = subprocess.run(command, cwd=str(self.workdir), stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(0, res.returncode, res.stderr)
+        self.assertEqual(
+            {'defconfig', 'defconfig.fillings'},
+            set(os.listdir(self.workdir / 'out' / 'a')),
+        )
+        self.assertEqual({'salad', 'salad.fillings'}, set(os.listdir(self.workdir / 'out' / 'b')))
+        self.assertIn("(0 unchanged)", res.stderr)
+
+        res = subprocess.run(command, cwd=str(self.workdir), stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertIn(">>> Written 2 symbols from salad to 2 files in out/b (2 unchanged).", res.stderr)
+
+        res = subprocess.run(
+            command + ['--arch', 'x86'], cwd=str(self.workdir), stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        self.assertEqual(2, res.returncode)
+
+
+class KconfCacheTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.kernel_sources = self.workdir / 'linux'
+        shutil.copytree(KCONF_ROOT, str(self.kernel_sources))
+        self.cache_dir = self.workdir / 'cache'
+
+    def load(self):
+        return kconfgen.load_kconf(
+            kernel_sources=self.kernel_sources,
+            arch='x86',
+            cache_dir=self.cache_dir,
+        )
+
+    def test_reuse(self):
+        kconf = self.load()
+        self.assertTrue(list(self.cache_dir.glob('kconf/*.pickle')))
+
+        cached = self.load()
+        self.assertIsNot(kconf, cached)
+        self.assertEqual(
+            [sym.name for sym in kconf.unique_defined_syms],
+            [sym.name for sym in cached.unique_defined_syms],
+        )
+
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n")
+        result = kconfgen.defconfig_merge(
+            kconf=cached,
+            fail_on_unknown=True,
+            sources=[self.workdir / 'defconfig'],
+        )
+        self.assertEqual("CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n", result.output)
+
+    def test_invalidation(self):
+        self.load()
+        with open(self.kernel_sources / 'fillings' / 'extras' / 'Kconfig', 'a', encoding='utf-8') as f:
+            f.write('\nconfig ONIONS\n    bool "Onions"\n')
+
+        kconf = self.load()
+        self.assertIn('ONIONS', kconf.syms)
+        self.assertTrue(kconf.syms['ONIONS'].nodes)
+
+    def test_corrupted(self):
+        self.load()
+        for path in self.cache_dir.glob('kconf/*.pickle'):
+            path.write_bytes(b'garbage')
+
+        kconf = self.load()
+        self.assertIn('PICKLES', kconf.syms)
+
+
+class ProfilesDirTests(KConfGenTestCase):
+    FILES = {
+        'core.toml': '[core]\nfragments_dir = "fragments"\n',
+        'profile/vegan.toml': 'arch = "x86"\ninclude = [ "sandwich" ]\nextras = [ "defconfig.vegan" ]\n',
+        'profile/cheesy.toml': 'arch = "x86"\ninclude = [ "base" ]\nextras = [ "defconfig.cheesy" ]\n',
+        'include/sandwich.toml': 'include = [ "base" ]\n',
+        'include/base.toml': 'files = [ "defconfig.base" ]\n',
+        # Broken, but not used by the profiles above
+        'profile/broken.toml': 'arch = "x86\n',
+        'include/dangling.toml': 'include = [ "missing" ]\n',
+    }
+
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config='', defconfigs=AssembleTests.MULTI_DEFCONFIGS, fragments_dir='fragments')
+        os.unlink(self.workdir / kconfgen.PROFILES_FILENAME)
+        for name, contents in self.FILES.items():
+            path = self.workdir / kconfgen.core.PROFILES_DIRNAME / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(contents)
+
+    def test_partial(self):
+        config = kconfgen.load_profiles(self.workdir, targets=['vegan'])
+        self.assertEqual(['vegan'], list(config.profiles))
+        self.assertEqual({'base', 'sandwich'}, set(config.includes))
+        self.assertEqual(
+            [self.workdir / 'fragments' / name for name in ['defconfig.base', 'defconfig.vegan']],
+            kconfgen.defconfig_for_target(config, 'vegan', self.workdir, extra_include=[]).files,
+        )
+        self.assertEqual(
+            [
+                self.workdir / kconfgen.core.PROFILES_DIRNAME / name
+                for name in ['core.toml', 'profile/vegan.toml', 'include/sandwich.toml', 'include/base.toml']
+            ],
+            kconfgen.core.profile_sources(self.workdir, config, 'vegan', extra_include=[]),
+        )
+
+        with self.assertRaises(kconfgen.core.InvalidConfiguration):
+            kconfgen.load_profiles(self.workdir, targets=['unknown'])
+
+    def test_full(self):
+        with self.assertRaises(kconfgen.core.InvalidConfiguration) as cm:
+            kconfgen.load_profiles(self.workdir)
+        errors = cm.exception.args[0]
+        self.assertEqual(1, len(errors))
+        self.assertIn('broken.toml', errors[0])
+
+        os.unlink(self.workdir / kconfgen.core.PROFILES_DIRNAME / 'profile' / 'broken.toml')
+        with self.assertRaises(kconfgen.core.InvalidConfiguration) as cm:
+            kconfgen.load_profiles(self.workdir)
+        self.assertEqual((["Reference to missing group missing in include group dangling"],), cm.exception.args)
+
+    def test_both_layouts(self):
+        with open(self.workdir / kconfgen.PROFILES_FILENAME, 'w', encoding='utf-8') as f:
+            f.write(AssembleTests.MULTI_PROFILES)
+        with self.assertRaises(kconfgen.core.InvalidConfiguration):
+            kconfgen.load_profiles(self.workdir, targets=['vegan'])
+
+    def test_watch(self):
+        directory = self.workdir / kconfgen.core.PROFILES_DIRNAME
+        os.unlink(directory / 'profile' / 'broken.toml')
+        os.unlink(directory / 'include' / 'dangling.toml')
+        session = kconfgen.watch.Session(
+            root=self.workdir,
+            kernel_sources=KCONF_ROOT,
+            output=lambda profile, arch: self.workdir / 'out' / profile,
+            log=io.StringIO(),
+        )
+        self.assertEqual(['cheesy', 'vegan'], sorted(item.target for item in session.start()))
+        self.assertIn(str(directory / 'profile'), session.paths())
+
+        # A new profile file is noticed through its directory.
+        with open(directory / 'profile' / 'plain.toml', 'w', encoding='utf-8') as f:
+            f.write('arch = "x86"\ninclude = [ "base" ]\n')
+        results = session.update([directory / 'profile'])
+        self.assertEqual(['plain'], [item.target for item in results])
+        self.assertIn(str(directory / 'profile' / 'plain.toml'), session.paths())
+
+    def test_cli(self):
+        subprocess.check_call([
+            'kconfgen', 'assemble',
+            '--kernel-source', KCONF_ROOT,
+            '--root', self.workdir,
+            '--output-dir', self.workdir / 'out',
+            '--depfile', self.workdir / 'out' / 'deps.d',
+            'vegan',
+        ])
+        with open(self.workdir / 'out' / 'vegan_defconfig', 'r', encoding='utf-8') as f:
+            self.assertEqual(AssembleTests.MULTI_EXPECTED['vegan'], f.read())
+        deps = kconfgen.depfile.read_depfile(self.workdir / 'out' / 'deps.d')
+        self.assertIn(
+            str(self.workdir / kconfgen.core.PROFILES_DIRNAME / 'include' / 'sandwich.toml'),
+            deps.dependencies(str(self.workdir / 'out' / 'vegan_defconfig')),
+        )
+
+        validate = ['kconfgen', 'validate', '--root', self.workdir]
+        res = subprocess.run(validate, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(1, res.returncode)
+        self.assertIn('broken.toml', res.stderr)
+
+        for name in ['profile/broken.toml', 'include/dangling.toml', '../fragments/defconfig.cheesy']:
+            os.unlink(self.workdir / kconfgen.core.PROFILES_DIRNAME / name)
+        res = subprocess.run(validate, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(1, res.returncode)
+        self.assertEqual(
+            "Missing fragment {} for profile cheesy\n".format(self.workdir / 'fragments' / 'defconfig.cheesy'),
+            res.stdout,
+        )
+        self.assertIn(">>> Validated 2 profiles and 2 include groups: 1 errors.", res.stderr)
+
+
+class ProfilesCacheTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs={})
+        self.cache_dir = self.workdir / 'cache'
+
+    def test_reuse(self):
+        config = kconfgen.load_profiles(self.workdir, cache_dir=self.cache_dir)
+        self.assertEqual(['cheesy', 'plain', 'vegan'], sorted(config.profiles))
+        self.assertTrue(list(self.cache_dir.glob('profiles/*/*.pickle')))
+
+        with mock.patch('toml.loads', side_effect=AssertionError("profiles.toml parsed")):
+            self.assertEqual(config, kconfgen.load_profiles(self.workdir, cache_dir=self.cache_dir))
+
+    def test_invalidation(self):
+        kconfgen.load_profiles(self.workdir, cache_dir=self.cache_dir)
+        with open(self.workdir / kconfgen.PROFILES_FILENAME, 'a', encoding='utf-8') as f:
+            f.write('[profile.bare]\narch = "x86"\ninclude = [ "base" ]\n')
+
+        config = kconfgen.load_profiles(self.workdir, cache_dir=self.cache_dir)
+        self.assertIn('bare', config.profiles)
+
+    def test_invalid(self):
+        with open(self.workdir / kconfgen.PROFILES_FILENAME, 'a', encoding='utf-8') as f:
+            f.write('[profile.broken]\n')
+        for _ in range(2):
+            with self.assertRaises(kconfgen.core.InvalidConfiguration):
+                kconfgen.load_profiles(self.workdir, cache_dir=self.cache_dir)
+
+
+class KernelSourcesTests(KConfGenTestCase):
+    def test_archive(self):
+        archive = self.workdir / 'linux-1.0.tar.gz'
+        with tarfile.open(str(archive), 'w:gz') as tar:
+            tar.add(KCONF_ROOT, arcname='linux-1.0')
+            readme = self.workdir / 'README'
+            readme.write_text("Not needed\n")
+            tar.add(str(readme), arcname='linux-1.0/README')
+
+        cache_dir = self.workdir / 'cache'
+        tree = kconfgen.sources.resolve_kernel_source(str(archive), cache_dir=cache_dir)
+        self.assertEqual('linux-1.0', tree.name)
+        self.assertTrue((tree / 'fillings' / 'extras' / 'Kconfig').exists())
+        self.assertFalse((tree / 'README').exists())
+        self.assertEqual(tree, kconfgen.sources.resolve_kernel_source(str(archive), cache_dir=cache_dir))
+
+        kconf = kconfgen.load_kconf(kernel_sources=tree, arch='x86')
+        self.assertIn('SAUCE_MAYO', kconf.syms)
+
+    def test_git(self):
+        repository = self.workdir / 'repo'
+        shutil.copytree(KCONF_ROOT, str(repository / 'linux'))
+        (repository / 'README').write_text("Not needed\n")
+
+        def git(*args):
+            subprocess.check_call(
+                ['git', '-C', str(repository), '-c', 'user.name=kconfgen', '-c', 'user.email=kconfgen@example.org']
+                + list(args),
+                stdout=subprocess.DEVNULL,
+            )
+
+        git('init')
+        git('add', '.')
+        git('commit', '-m', 'Initial')
+        with open(repository / 'linux' / 'Kconfig', 'a', encoding='utf-8') as f:
+            f.write('\nconfig NEW_SYMBOL\n    bool "New"\n')
+        git('commit', '-a', '-m', 'Add NEW_SYMBOL')
+
+        cache_dir = self.workdir / 'cache'
+        old = kconfgen.sources.resolve_kernel_source('HEAD~1:{}'.format(repository / 'linux'), cache_dir=cache_dir)
+        new = kconfgen.sources.resolve_kernel_source('HEAD:{}'.format(repository / 'linux'), cache_dir=cache_dir)
+        self.assertNotEqual(old, new)
+        self.assertEqual(['bread', 'fillings', 'Kconfig'], sorted(os.listdir(old), key=str.lower))
+        self.assertNotIn('NEW_SYMBOL', kconfgen.load_kconf(kernel_sources=old, arch='x86').syms)
+        self.assertIn('NEW_SYMBOL', kconfgen.load_kconf(kernel_sources=new, arch='x86').syms)
+
+        with self.assertRaises(kconfgen.git.GitError):
+            kconfgen.sources.resolve_kernel_source('HEAD~5:{}'.format(repository / 'linux'))
+
+    def test_invalid(self):
+        (self.workdir / 'linux.zip').write_text("")
+        with self.assertRaises(ValueError):
+            kconfgen.sources.resolve_kernel_source(str(self.workdir / 'linux.zip'))
+
+
+class QueryTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        self.config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+
+    def test_select(self):
+        self.assertEqual(['cheesy', 'plain', 'vegan'], kconfgen.query.select_profiles(self.config, []))
+        self.assertEqual(['plain', 'vegan'], kconfgen.query.select_profiles(self.config, ['*g?n', 'plain']))
+        with self.assertRaises(ValueError):
+            kconfgen.query.select_profiles(self.config, ['meaty*'])
+
+    def test_query(self):
+        expected = [
+            ('cheesy', {'CONFIG_DIET_VEGAN': 'n', 'EXTRA_CHEDDAR': 'y', 'STEAK_BEEF': 'y', 'NO_SUCH_SYMBOL': None}),
+            ('plain', {'CONFIG_DIET_VEGAN': 'n', 'EXTRA_CHEDDAR': 'n', 'STEAK_BEEF': 'y', 'NO_SUCH_SYMBOL': None}),
+            ('vegan', {'CONFIG_DIET_VEGAN': 'y', 'EXTRA_CHEDDAR': 'n', 'STEAK_BEEF': 'n', 'NO_SUCH_SYMBOL': None}),
+        ]
+        for jobs in [1, 2]:
+            pool = kconfgen.KconfPool()
+            results = kconfgen.query.query_profiles(
+                config=self.config,
+                targets=['vegan', 'cheesy', 'plain'],
+                symbols=['CONFIG_DIET_VEGAN', 'EXTRA_CHEDDAR', 'STEAK_BEEF', 'NO_SUCH_SYMBOL'],
+                root=self.workdir,
+                kernel_sources=KCONF_ROOT,
+                fail_on_unknown=True,
+                extra_include=[],
+                pool=pool,
+                jobs=jobs,
+            )
+            self.assertEqual(expected, [(item.target, item.values) for item in results])
+            # With workers, trees are parsed in the worker processes.
+            self.assertEqual(1 if jobs == 1 else 0, len(pool.trees))
+
+    def test_cli(self):
+        output = subprocess.check_output([
+            'kconfgen', 'query',
+            '--kernel-source', KCONF_ROOT,
+            '--root', self.workdir,
+            '--profile', 'v*',
+            '--profile', 'cheesy',
+            'DIET_VEGAN', 'CONFIG_EXTRA_CHEDDAR', 'NO_SUCH_SYMBOL',
+        ])
+        self.assertEqual(
+            "PROFILE  DIET_VEGAN  CONFIG_EXTRA_CHEDDAR  NO_SUCH_SYMBOL\n"
+            "cheesy   n           y                     -\n"
+            "vegan    y           n                     -\n",
+            output.decode('utf-8'),
+        )
+
+        output = subprocess.check_output([
+            'kconfgen', 'query',
+            '--kernel-source', KCONF_ROOT,
+            '--root', self.workdir,
+            '--format', 'json',
+            'DIET_VEGAN',
+        ])
+        self.assertEqual(
+            {'cheesy': {'DIET_VEGAN': 'n'}, 'plain': {'DIET_VEGAN': 'n'}, 'vegan': {'DIET_VEGAN': 'y'}},
+            json.loads(output.decode('utf-8')),
+        )
+
+
+class RevisionTests(KConfGenTestCase):
+    def git(self, *args):
+        subprocess.check_call(
+            ['git', '-C', str(self.workdir), '-c', 'user.name=kconfgen', '-c', 'user.email=kconfgen@example.org']
+            + list(args),
+            stdout=subprocess.DEVNULL,
+        )
+
+    def setUp(self):
+        super().setUp()
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        self.git('init')
+        self.git('add', '.')
+        self.git('commit', '-m', 'Initial')
+        with open(self.workdir / 'defconfig.vegan', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_DIET_VEGAN=y\nCONFIG_SIDE_SALAD=y\n")
+        self.git('commit', '-a', '-m', 'Salad')
+        # Uncommitted changes are ignored
+        os.unlink(self.workdir / 'defconfig.base')
+
+    def test_revisions(self):
+        pool = kconfgen.KconfPool()
+        outputs = {}
+        for rev in ['HEAD~1', 'HEAD']:
+            config, fragments = kconfgen.revision.load_revision(self.workdir, rev)
+            results = kconfgen.assemble_profiles(
+                config=config,
+                targets=['vegan'],
+                root=self.workdir,
+                kernel_sources=KCONF_ROOT,
+                fail_on_unknown=True,
+                extra_include=[],
+                pool=pool,
+                fragments=fragments,
+            )
+            outputs[rev] = [item.result.output for item in results]
+            fragments.repository.close()
+
+        self.assertEqual(
+            {
+                'HEAD~1': [AssembleTests.MULTI_EXPECTED['vegan']],
+                'HEAD': ["CONFIG_SIDE_SALAD=y\nCONFIG_DIET_VEGAN=y\nCONFIG_BREAD_POTATO=y\n"],
+            },
+            outputs,
+        )
+        self.assertEqual(1, len(pool.trees))
+
+    def test_missing(self):
+        _config, fragments = kconfgen.revision.load_revision(self.workdir, 'HEAD')
+        with self.assertRaises(FileNotFoundError):
+            fragments.get(self.workdir / 'defconfig.missing')
+        fragments.repository.close()
+
+    def test_cli(self):
+        subprocess.check_call([
+            'kconfgen', 'assemble',
+            '--kernel-source', KCONF_ROOT,
+            '--root', self.workdir,
+            '--output-dir', self.workdir / 'out',
+            '--output-template', '{revision}/{profile}',
+            '--revision', 'HEAD~1',
+            '--revision', 'HEAD',
+            '--all',
+        ])
+        for rev in ['HEAD~1', 'HEAD']:
+            self.assertEqual(['cheesy', 'plain', 'vegan'], sorted(os.listdir(self.workdir / 'out' / rev)))
+        with open(self.workdir / 'out' / 'HEAD' / 'vegan', 'r', encoding='utf-8') as f:
+            self.assertIn("CONFIG_SIDE_SALAD=y\n", f.read())
+
+
+class ResultCacheTests(KConfGenTestCase):
+    def assemble(self, store, kernel_sources=KCONF_ROOT):
+        config = kconfgen.load_configuration(toml.load(self.workdir / kconfgen.PROFILES_FILENAME))
+        results = kconfgen.assemble_profiles(
+            config=config,
+            targets=sorted(config.profiles),
+            root=self.workdir,
+            kernel_sources=kernel_sources,
+            fail_on_unknown=True,
+            extra_include=[],
+            result_cache=kconfgen.cache.ResultCache(store),
+        )
+        return {item.target: item.result.output for item in results}
+
+    def test_directory(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        store = kconfgen.cache.DirectoryStore(self.workdir / 'results')
+        self.assertEqual(AssembleTests.MULTI_EXPECTED, self.assemble(store))
+
+        with mock.patch.object(kconfgen.core, 'load_kconf', side_effect=AssertionError("Kconfig parsed")):
+            self.assertEqual(AssembleTests.MULTI_EXPECTED, self.assemble(store))
+
+        # Changing a fragment only invalidates the profiles using it.
+        with open(self.workdir / 'defconfig.vegan', 'a', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\n")
+        with mock.patch.object(kconfgen.core, 'load_kconf', wraps=kconfgen.core.load_kconf) as load_kconf:
+            outputs = self.assemble(store)
+        self.assertEqual(1, load_kconf.call_count)
+        self.assertEqual("CONFIG_SIDE_SALAD=y\nCONFIG_DIET_VEGAN=y\nCONFIG_BREAD_POTATO=y\n", outputs['vegan'])
+
+    def test_environment(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+        kernel = self.workdir / 'linux'
+        shutil.copytree(KCONF_ROOT, str(kernel))
+        with open(kernel / 'Kconfig', 'a', encoding='utf-8') as f:
+            f.write('\nconfig CC_VERSION_TEXT\n    string\n    default "$(shell,$(CC) --version)"\n')
+        (kernel / 'scripts').mkdir()
+        with open(kernel / 'scripts' / 'cc-version.sh', 'w', encoding='utf-8') as f:
+            f.write("#!/bin/sh\n")
+        store = kconfgen.cache.DirectoryStore(self.workdir / 'results')
+
+        def parses(**environ):
+            with mock.patch.dict(os.environ, environ), \
+                    mock.patch.object(kconfgen.core, 'load_kconf', wraps=kconfgen.core.load_kconf) as load_kconf:
+                self.assertEqual(AssembleTests.MULTI_EXPECTED, self.assemble(store, kernel_sources=kernel))
+            return load_kconf.call_count > 0
+
+        self.assertTrue(parses(CC='echo gcc'))
+        self.assertFalse(parses(CC='echo gcc', UNRELATED='1'))
+        # Another toolchain
+        self.assertTrue(parses(CC='echo clang'))
+        # Scripts $(shell,...) may run
+        with open(kernel / 'scripts' / 'cc-version.sh', 'a', encoding='utf-8') as f:
+            f.write("exit 1\n")
+        self.assertTrue(parses(CC='echo clang'))
+
+    def test_http(self):
+        contents = {}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in contents:
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(contents[self.path])
+                else:
+                    self.send_error(404)
+
+            def do_PUT(self):
+                contents[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(201)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/cache/'.format(server.server_port)
+            store = kconfgen.cache.open_result_store(url)
+            prepare_profiles(
+                self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS,
+            )
+            self.assertEqual(AssembleTests.MULTI_EXPECTED, self.assemble(store))
+            self.assertEqual(3, len(contents))
+            with mock.patch.object(kconfgen.core, 'load_kconf', side_effect=AssertionError("Kconfig parsed")):
+                self.assertEqual(AssembleTests.MULTI_EXPECTED, self.assemble(store))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # An unreachable server is a cache miss.
+        self.assertIsNone(store.get('0' * 64))
+
+    def test_http_errors(self):
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                method = self.rfile.readline().split(b' ')[0]
+                if method == b'GET':
+                    # Truncated body: IncompleteRead
+                    self.wfile.write(b'HTTP/1.0 200 OK\r\nContent-Length: 100\r\n\r\nshort')
+                else:
+                    # BadStatusLine
+                    self.wfile.write(b'garbage\r\n\r\n')
+
+        server = socketserver.TCPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            store = kconfgen.cache.HTTPStore('http://127.0.0.1:{}/'.format(server.server_address[1]))
+            self.assertIsNone(store.get('0' * 64))
+            store.put('0' * 64, b'{}')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class ThreadedLoadTests(unittest.TestCase):
+    TREES = 3
+    ARCHES = ['x86', 'arm64', 'riscv']
+
+    def setUp(self):
+        super().setUp()
+        self._workdir = tempfile.TemporaryDirectory()
+        self.workdir = pathlib.Path(self._workdir.name)
+        for tree in range(self.TREES):
+            root = self.workdir / 'linux{}'.format(tree)
+            (root / 'arch').mkdir(parents=True)
+            (root / 'Kconfig').write_text(
+                'config TREE_{}\n\tdef_bool y\n\nsource "arch/$(SRCARCH)/Kconfig"\n'.format(tree),
+            )
+            for arch in self.ARCHES:
+                (root / 'arch' / arch).mkdir()
+                (root / 'arch' / arch / 'Kconfig').write_text(
+                    'config ARCH_NAME\n\tstring\n\tdefault "{}"\n\n'.format(arch)
+                    # Make parsing long enough for threads to interleave.
+                    + ''.join('config {}_{}\n\tbool "{}"\n\n'.format(arch.upper(), i, i) for i in range(300))
+                )
+
+    def tearDown(self):
+        self._workdir.cleanup()
+        super().tearDown()
+
+    def test_parallel_load(self):
+        environ = dict(os.environ)
+        pairs = [
+            (tree, arch)
+            for tree in range(self.TREES)
+            for arch in self.ARCHES
+        ] * 4
+
+        def load(pair):
+            tree, arch = pair
+            return kconfgen.load_kconf(kernel_sources=self.workdir / 'linux{}'.format(tree), arch=arch)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(load, pairs))
+
+        for (tree, arch), kconf in zip(pairs, results):
+            self.assertEqual(str(self.workdir / 'linux{}'.format(tree)), kconf.srctree)
+            self.assertIn('TREE_{}'.format(tree), kconf.syms)
+            self.assertEqual(arch, kconf.syms['ARCH_NAME'].str_value)
+            self.assertTrue(kconf.syms['{}_299'.format(arch.upper())].nodes)
+        self.assertEqual(environ, dict(os.environ))
+
+    def test_old_style_source(self):
+        # Pre-4.18 kernels: $SRCARCH is expanded by os.path.expandvars, and $(shell,...) runs a command.
+        root = self.workdir / 'linux-old'
+        for arch in self.ARCHES:
+            (root / 'arch' / arch).mkdir(parents=True)
+            (root / 'arch' / arch / 'Kconfig').write_text('config ARCH_NAME\n\tstring\n\tdefault "{}"\n'.format(arch))
+        (root / 'Kconfig').write_text(
+            'config SHELL_ARCH\n\tstring\n\tdefault "$(shell,echo $SRCARCH)"\n\nsource "arch/$SRCARCH/Kconfig"\n',
+        )
+        environ = dict(os.environ)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(lambda arch: kconfgen.load_kconf(root, arch), self.ARCHES * 2))
+
+        for arch, kconf in zip(self.ARCHES * 2, results):
+            self.assertEqual(arch, kconf.syms['ARCH_NAME'].str_value)
+            self.assertEqual(arch, kconf.syms['SHELL_ARCH'].str_value)
+        self.assertEqual(environ, dict(os.environ))
+        # kconfiglib is left untouched once trees are loaded.
+        self.assertIs(os, kconfgen.core.kconfiglib.os)
+
+    def test_shared_pool(self):
+        pool = kconfgen.KconfPool()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(
+                lambda arch: pool.get(self.workdir / 'linux0', arch),
+                self.ARCHES * 3,
+            ))
+        self.assertEqual(
+            {arch: arch for arch in self.ARCHES},
+            {key[1]: kconf.syms['ARCH_NAME'].str_value for key, kconf in pool.trees.items()},
+        )
+
+
+class ServerTests(KConfGenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = self.workdir / 'kconfgen.sock'
+        self.pool = kconfgen.KconfPool()
+        self.server = kconfgen.server.Server(self.socket, self.pool)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super().tearDown()
+
+    def test_assemble(self):
+        prepare_profiles(self.workdir, config=AssembleTests.MULTI_PROFILES, defconfigs=AssembleTests.MULTI_DEFCONFIGS)
+
+        for name, expected in AssembleTests.MULTI_EXPECTED.items():
+            response = kconfgen.server.call(
+                self.socket, 'assemble',
+                root=str(self.workdir),
+                profile=name,
+                kernel_source=KCONF_ROOT,
+                fail_on_unknown=True,
+            )
+            self.assertEqual(expected, response['output'])
+        # The tree was kept warm across requests.
+        self.assertEqual(1, len(self.pool.trees))
+
+    def test_cli(self):
+        with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+            f.write("CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n")
+
+        output = subprocess.check_output([
+            'kconfgen', 'merge',
+            '--kernel-source', KCONF_ROOT,
+            '--arch', 'x86',
+            '--server', self.socket,
+            self.workdir / 'defconfig',
+            '--autoconf', self.workdir / 'autoconf.h',
+        ])
+        self.assertEqual(b"CONFIG_SIDE_SALAD=y\nCONFIG_EXTRA_CHEDDAR=y\n", output)
+        with open(self.workdir / 'autoconf.h', 'r') as f:
+            self.assertIn("#define CONFIG_EXTRA_CHEDDAR 1\n", f.read())
+
+    def test_error(self):
+        with self.assertRaisesRegex(kconfgen.server.ServerError, "UNKNOWN"):
+            with open(self.workdir / 'defconfig', 'w', encoding='utf-8') as f:
+                f.write("CONFIG_UNKNOWN=y\n")
+            kconfgen.server.call(
+                self.socket, 'merge',
+                kernel_source=KCONF_ROOT,
+                arch='x86',
+                sources=[str(self.workdir / 'defconfig')],
+                fail_on_unknown=True,
+            )